@@ -0,0 +1,161 @@
+"""
+Load test of the service against fake storage, Datastore and token
+validation. For every gunicorn worker and thread configuration the service is
+started, and the mix of operations is sent at every concurrency level.
+
+    cd app && python -m loadtest --workers 1,2 --threads 1,8 --concurrency 1,8,32
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from loadtest.backends import Backends
+from loadtest.runner import OPERATIONS, Run
+from loadtest.server import TOKEN
+
+BUCKET = 'loadtest-registrations'
+NONCE_BUCKET = 'loadtest-nonces'
+PROJECT = 'loadtest'
+
+CONFIG = f"""
+BUCKET = {BUCKET!r}
+NONCE_BUCKET = {NONCE_BUCKET!r}
+ORIGINS = []
+PREWARM_ENABLED = False
+"""
+
+
+def integers(value):
+    return [int(item) for item in value.split(',')]
+
+
+def operation_mix(value):
+    mix = {}
+    for item in value.split(','):
+        operation, _, weight = item.partition('=')
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {operation}, expected one of {OPERATIONS}")
+        mix[operation] = float(weight or 1)
+    return mix
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Service:
+    """
+    The service under gunicorn in a subprocess, configured for the backends
+    """
+
+    def __init__(self, backends, workers, threads, config_directory, log):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        app_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environment = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join([config_directory, app_directory]),
+            STORAGE_EMULATOR_HOST=backends.storage_url,
+            DATASTORE_EMULATOR_HOST=backends.datastore_host,
+            GOOGLE_CLOUD_DISABLE_GRPC='true',
+            GOOGLE_CLOUD_PROJECT=PROJECT,
+            PROJECT=PROJECT,
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'loadtest.server', '--bind', f"127.0.0.1:{self.port}",
+             '--workers', str(workers), '--threads', str(threads)],
+            cwd=app_directory, env=environment, stdout=log, stderr=subprocess.STDOUT,
+        )
+
+    def wait_until_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The service exited with {self.process.returncode}")
+            try:
+                requests.get(f"{self.url}/surveys", headers={'Authorization': f"Bearer {TOKEN}"}, timeout=30)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        raise RuntimeError(f"The service did not start within {timeout}s")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def milliseconds(seconds):
+    return '-' if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def print_results(results):
+    print(f"{'workers':>7} {'threads':>7} {'conc':>5} {'operation':<12} {'reqs':>6} {'errors':>6} "
+          f"{'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for result in results:
+        for operation, summary in result['operations'].items():
+            print(f"{result['workers']:>7} {result['threads']:>7} {result['concurrency']:>5} {operation:<12} "
+                  f"{summary['requests']:>6} {summary['errors']:>6} {summary['throughput']:>8.2f} "
+                  f"{milliseconds(summary['p50']):>9} {milliseconds(summary['p95']):>9} "
+                  f"{milliseconds(summary['p99']):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=integers, default=[1, 2], help="gunicorn worker counts, e.g. 1,2,4")
+    parser.add_argument('--threads', type=integers, default=[1, 8], help="Threads per worker, e.g. 1,4,8")
+    parser.add_argument('--concurrency', type=integers, default=[1, 8, 32], help="Concurrent clients, e.g. 1,8,32")
+    parser.add_argument('--duration', type=float, default=30, help="Measured seconds per concurrency level")
+    parser.add_argument('--warmup', type=float, default=5, help="Unmeasured seconds before each level")
+    parser.add_argument('--mix', type=operation_mix,
+                        default='list=4,registration=4,forms=4,csv=1,zip=1,images=1,nonce=1', help=f"Weights of the operations, of {', '.join(OPERATIONS)}")
+    parser.add_argument('--surveys', type=int, default=2, help="Number of surveys in the fixtures")
+    parser.add_argument('--registrations', type=int, default=500, help="Registrations per survey")
+    parser.add_argument('--attachments', type=int, default=3, help="Attachments of the registrations with images")
+    parser.add_argument('--json', help="Also write the results to this file")
+    parser.add_argument('--log', default=os.path.join(tempfile.gettempdir(), 'loadtest-service.log'),
+                        help="Output of the service")
+    args = parser.parse_args()
+
+    results = []
+    with Backends(BUCKET, args.surveys, args.registrations, args.attachments) as backends, \
+            tempfile.TemporaryDirectory() as config_directory, open(args.log, 'w') as log:
+        with open(os.path.join(config_directory, 'config.py'), 'w') as config_file:
+            config_file.write(CONFIG)
+
+        for workers in args.workers:
+            for threads in args.threads:
+                service = Service(backends, workers, threads, config_directory, log)
+                try:
+                    service.wait_until_ready()
+                    for concurrency in args.concurrency:
+                        print(f"workers={workers} threads={threads} concurrency={concurrency}", file=sys.stderr)
+                        run = Run(service.url, TOKEN, backends.with_attachments, args.mix, concurrency,
+                                  args.duration, args.warmup)
+                        results.append({
+                            'workers': workers,
+                            'threads': threads,
+                            'concurrency': concurrency,
+                            'operations': run.run(),
+                        })
+                finally:
+                    service.stop()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import multiprocessing
+import threading
+from http.server import ThreadingHTTPServer
+
+from loadtest.fake_datastore import FakeDatastoreHandler
+from loadtest.fake_storage import FakeStorageHandler, ObjectStore
+from loadtest.fixtures import seed
+
+
+def _serve(connection, bucket, surveys, registrations, attachments):
+    store = ObjectStore()
+    with_attachments = seed(store, bucket, surveys, registrations, attachments)
+
+    storage_handler = type('StorageHandler', (FakeStorageHandler,), {'store': store})
+    storage_server = ThreadingHTTPServer(('127.0.0.1', 0), storage_handler)
+    datastore_handler = type('DatastoreHandler', (FakeDatastoreHandler,), {'entities': {}, 'lock': threading.Lock()})
+    datastore_server = ThreadingHTTPServer(('127.0.0.1', 0), datastore_handler)
+    for server in (storage_server, datastore_server):
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    connection.send((storage_server.server_address[1], datastore_server.server_address[1], with_attachments))
+    # Serve until the harness closes its end
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+
+
+class Backends:
+    """
+    The fake storage and Datastore, seeded with fixtures and served from a
+    separate process so they do not compete with the load generator for the GIL
+    """
+
+    def __init__(self, bucket, surveys, registrations, attachments):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=_serve, args=(child, bucket, surveys, registrations, attachments), daemon=True,
+        )
+
+    def __enter__(self):
+        self.process.start()
+        storage_port, datastore_port, self.with_attachments = self.connection.recv()
+        self.storage_url = f"http://127.0.0.1:{storage_port}"
+        self.datastore_host = f"127.0.0.1:{datastore_port}"
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
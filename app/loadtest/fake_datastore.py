@@ -0,0 +1,65 @@
+import threading
+from http.server import BaseHTTPRequestHandler
+
+from google.cloud.datastore_v1.types import datastore as datastore_pb2
+from google.cloud.datastore_v1.types import entity as entity_pb2
+from google.cloud.datastore_v1.types import query as query_pb2
+
+
+def _key_path(key):
+    return tuple((element.kind, element.name or element.id) for element in key.path)
+
+
+class FakeDatastoreHandler(BaseHTTPRequestHandler):
+    """
+    The lookup and commit methods of the Datastore proto-over-HTTP API, which
+    the client uses with DATASTORE_EMULATOR_HOST and GOOGLE_CLOUD_DISABLE_GRPC
+    """
+
+    protocol_version = 'HTTP/1.1'
+    entities = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-protobuf')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        method = self.path.rsplit(':', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if method == 'lookup':
+            self._reply(200, self._lookup(datastore_pb2.LookupRequest.deserialize(body)))
+        elif method == 'commit':
+            self._reply(200, self._commit(datastore_pb2.CommitRequest.deserialize(body)))
+        else:
+            self._reply(501, b'')
+
+    def _lookup(self, request):
+        response = datastore_pb2.LookupResponse()
+        with self.lock:
+            for key in request.keys:
+                entity = self.entities.get(_key_path(key))
+                if entity is None:
+                    response.missing.append(query_pb2.EntityResult(entity=entity_pb2.Entity(key=key), version=1))
+                else:
+                    response.found.append(query_pb2.EntityResult(entity=entity, version=1))
+        return datastore_pb2.LookupResponse.serialize(response)
+
+    def _commit(self, request):
+        response = datastore_pb2.CommitResponse()
+        with self.lock:
+            for mutation in request.mutations:
+                for operation in ('insert', 'update', 'upsert'):
+                    if operation in mutation:
+                        entity = getattr(mutation, operation)
+                        self.entities[_key_path(entity.key)] = entity
+                if 'delete' in mutation:
+                    self.entities.pop(_key_path(mutation.delete), None)
+                response.mutation_results.append(datastore_pb2.MutationResult(version=1))
+        return datastore_pb2.CommitResponse.serialize(response)
@@ -0,0 +1,250 @@
+import base64
+import hashlib
+import json
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+import google_crc32c
+
+PAGE_SIZE = 1000
+
+
+class StorageObject:
+    def __init__(self, bucket, name, data, content_type, generation, content_encoding=None):
+        self.bucket = bucket
+        self.name = name
+        self.data = data
+        self.content_type = content_type
+        self.generation = generation
+        self.content_encoding = content_encoding
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        self.crc32c = base64.b64encode(google_crc32c.value(data).to_bytes(4, 'big')).decode()
+
+    def resource(self):
+        resource = {
+            'kind': 'storage#object',
+            'id': f"{self.bucket}/{self.name}/{self.generation}",
+            'bucket': self.bucket,
+            'name': self.name,
+            'generation': str(self.generation),
+            'metageneration': '1',
+            'contentType': self.content_type,
+            'size': str(len(self.data)),
+            'md5Hash': self.md5_hash,
+            'crc32c': self.crc32c,
+        }
+        if self.content_encoding:
+            resource['contentEncoding'] = self.content_encoding
+        return resource
+
+
+class ObjectStore:
+    """
+    The objects of all buckets, in memory
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self._generation = 1000
+
+    def put(self, bucket, name, data, content_type='application/octet-stream', content_encoding=None,
+            if_generation_match=None):
+        with self.lock:
+            existing = self.objects.get((bucket, name))
+            if if_generation_match is not None:
+                if int(if_generation_match) != (existing.generation if existing else 0):
+                    return None
+            self._generation += 1
+            stored = StorageObject(bucket, name, data, content_type, self._generation, content_encoding)
+            self.objects[(bucket, name)] = stored
+            return stored
+
+    def get(self, bucket, name):
+        with self.lock:
+            return self.objects.get((bucket, name))
+
+    def delete(self, bucket, name):
+        with self.lock:
+            return self.objects.pop((bucket, name), None)
+
+    def list(self, bucket, prefix):
+        with self.lock:
+            return sorted(
+                (stored for (stored_bucket, name), stored in self.objects.items()
+                 if stored_bucket == bucket and name.startswith(prefix)),
+                key=lambda stored: stored.name,
+            )
+
+
+class FakeStorageHandler(BaseHTTPRequestHandler):
+    """
+    The part of the storage JSON API the service uses: listing, metadata,
+    media downloads, multipart and resumable uploads, rewrite, compose and
+    delete, with generation preconditions
+    """
+
+    protocol_version = 'HTTP/1.1'
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self):
+        self._reply(404, {'error': {'code': 404, 'message': 'No such object'}})
+
+    def _precondition_failed(self):
+        self._reply(412, {'error': {'code': 412, 'message': 'Precondition Failed'}})
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _route(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        return url.path.split('/'), query
+
+    def do_GET(self):
+        segments, query = self._route()
+        if segments[1:3] == ['download', 'storage']:
+            return self._download(unquote(segments[5]), unquote(segments[7]), query)
+        if segments[1:3] == ['storage', 'v1'] and len(segments) == 5:
+            return self._reply(200, {'kind': 'storage#bucket', 'name': unquote(segments[4])})
+        if segments[1:3] == ['storage', 'v1'] and len(segments) == 6:
+            return self._list(unquote(segments[4]), query)
+        if segments[1:3] == ['storage', 'v1'] and len(segments) == 7:
+            stored = self.store.get(unquote(segments[4]), unquote(segments[6]))
+            if stored is None:
+                return self._not_found()
+            if query.get('alt') == 'media':
+                return self._download(stored.bucket, stored.name, query)
+            return self._reply(200, stored.resource())
+        self._reply(400, {'error': {'code': 400, 'message': f"Unsupported {self.path}"}})
+
+    def _list(self, bucket, query):
+        objects = self.store.list(bucket, query.get('prefix', ''))
+        start = int(query.get('pageToken', 0))
+        page_size = min(int(query.get('maxResults', PAGE_SIZE)), PAGE_SIZE)
+        page = objects[start:start + page_size]
+        listing = {'kind': 'storage#objects'}
+        if page:
+            listing['items'] = [stored.resource() for stored in page]
+        if start + page_size < len(objects):
+            listing['nextPageToken'] = str(start + page_size)
+        self._reply(200, listing)
+
+    def _download(self, bucket, name, query):
+        stored = self.store.get(bucket, name)
+        if stored is None:
+            return self._not_found()
+        for parameter in ('generation', 'ifGenerationMatch'):
+            if parameter in query and int(query[parameter]) != stored.generation:
+                return self._not_found() if parameter == 'generation' else self._precondition_failed()
+        headers = {'x-goog-generation': str(stored.generation)}
+        if stored.content_encoding:
+            headers['Content-Encoding'] = stored.content_encoding
+        ranged = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if ranged:
+            start = int(ranged.group(1))
+            end = int(ranged.group(2)) + 1 if ranged.group(2) else len(stored.data)
+            headers['Content-Range'] = f"bytes {start}-{end - 1}/{len(stored.data)}"
+            return self._reply(206, stored.data[start:end], stored.content_type, headers)
+        headers['x-goog-hash'] = f"crc32c={stored.crc32c},md5={stored.md5_hash}"
+        self._reply(200, stored.data, stored.content_type, headers)
+
+    def do_POST(self):
+        segments, query = self._route()
+        if segments[1:3] == ['upload', 'storage']:
+            bucket = unquote(segments[5])
+            if query.get('uploadType') == 'multipart':
+                return self._multipart_upload(bucket, query)
+            return self._start_resumable_upload(bucket, query)
+        if len(segments) == 12 and segments[7] == 'rewriteTo':
+            return self._rewrite(unquote(segments[4]), unquote(segments[6]), unquote(segments[9]), unquote(segments[11]))
+        if len(segments) == 8 and segments[7] == 'compose':
+            return self._compose(unquote(segments[4]), unquote(segments[6]), json.loads(self._body()))
+        self._reply(400, {'error': {'code': 400, 'message': f"Unsupported {self.path}"}})
+
+    def _store(self, bucket, metadata, data, query):
+        stored = self.store.put(
+            bucket, metadata['name'], data,
+            metadata.get('contentType') or 'application/octet-stream',
+            metadata.get('contentEncoding'),
+            query.get('ifGenerationMatch'),
+        )
+        if stored is None:
+            return self._precondition_failed()
+        self._reply(200, stored.resource())
+
+    def _multipart_upload(self, bucket, query):
+        boundary = self.headers.get_param('boundary').encode()
+        parts = self._body().split(b'--' + boundary)
+        metadata_part, media_part = parts[1], parts[2]
+        metadata = json.loads(metadata_part.split(b'\r\n\r\n', 1)[1])
+        data = media_part.split(b'\r\n\r\n', 1)[1][:-2]
+        self._store(bucket, metadata, data, query)
+
+    def _start_resumable_upload(self, bucket, query):
+        upload_id = uuid.uuid4().hex
+        self.store.uploads[upload_id] = (bucket, json.loads(self._body() or b'{}'), bytearray(), query)
+        location = f"http://{self.headers['Host']}/upload/storage/v1/b/{quote(bucket, safe='')}/o" \
+                   f"?uploadType=resumable&upload_id={upload_id}"
+        self._reply(200, headers={'Location': location})
+
+    def do_PUT(self):
+        _, query = self._route()
+        upload = self.store.uploads.get(query.get('upload_id'))
+        if upload is None:
+            return self._not_found()
+        bucket, metadata, data, upload_query = upload
+        data.extend(self._body())
+        total = self.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+        if total == '*' or int(total) > len(data):
+            return self._reply(308, headers={'Range': f"bytes=0-{len(data) - 1}"})
+        del self.store.uploads[query['upload_id']]
+        self._store(bucket, metadata, bytes(data), upload_query)
+
+    def _rewrite(self, source_bucket, source_name, bucket, name):
+        source = self.store.get(source_bucket, source_name)
+        if source is None:
+            return self._not_found()
+        stored = self.store.put(bucket, name, source.data, source.content_type, source.content_encoding)
+        self._reply(200, {
+            'kind': 'storage#rewriteResponse',
+            'totalBytesRewritten': str(len(source.data)),
+            'objectSize': str(len(source.data)),
+            'done': True,
+            'resource': stored.resource(),
+        })
+
+    def _compose(self, bucket, name, request):
+        sources = [self.store.get(bucket, source['name']) for source in request['sourceObjects']]
+        if None in sources:
+            return self._not_found()
+        destination = request.get('destination', {})
+        stored = self.store.put(
+            bucket, name, b''.join(source.data for source in sources),
+            destination.get('contentType') or 'application/octet-stream', destination.get('contentEncoding'),
+        )
+        self._reply(200, stored.resource())
+
+    def do_DELETE(self):
+        segments, _ = self._route()
+        if self.store.delete(unquote(segments[4]), unquote(segments[6])) is None:
+            return self._not_found()
+        self._reply(204)
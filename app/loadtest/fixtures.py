@@ -0,0 +1,71 @@
+import json
+import random
+
+FIRST_SURVEY_ID = 7001
+# A minimal JPEG, the content of attachments is never decoded in these operations
+JPEG = bytes.fromhex('ffd8ffe000104a46494600010100000100010000ffd9')
+
+
+def survey_ids(surveys):
+    return [str(FIRST_SURVEY_ID + index) for index in range(surveys)]
+
+
+def registration(survey_id, serial_number, rng):
+    """
+    A registration like those of the snapshots, with a few answers, a sub
+    form and a location
+    """
+    return {
+        'meta': {
+            'serialNumber': serial_number,
+            'registrationDate': str(1600000000000 + serial_number * 1000),
+        },
+        'info': {
+            'formId': survey_id,
+            'formName': f"Survey {survey_id}",
+        },
+        'data': {
+            'siteID': f"S{rng.randrange(100000):05d}",
+            'tMNLLocationID': {'CITY': rng.choice(['Amsterdam', 'Rotterdam', 'Utrecht']), 'STREET': 'Main'},
+            'remarks': ' '.join(rng.choice(['mast', 'cable', 'cabinet', 'antenna']) for _ in range(8)),
+            'checks': [
+                {'item': f"check {index}", 'passed': rng.random() > 0.2, 'value': rng.randrange(100)}
+                for index in range(3)
+            ],
+            'inspection': {'inspector': 'loadtest', 'duration': rng.randrange(3600), 'approved': True},
+        },
+    }
+
+
+def seed(store, bucket, surveys=2, registrations=500, attachments=3, seed=0):
+    """
+    Fill the fake storage with a surveys snapshot, a registrations snapshot
+    per survey and the attachments of the first registrations
+    :param store: The loadtest.fake_storage.ObjectStore
+    :param bucket: The bucket of config.BUCKET
+    :param surveys: Number of surveys
+    :param registrations: Number of registrations per survey
+    :param attachments: Number of attachments per registration, for the first 10 registrations
+    :param seed: Seed of the generated answers
+    :return: dict of survey ID to the serial numbers of its registrations with attachments
+    """
+    rng = random.Random(seed)
+    ids = survey_ids(surveys)
+    folders = {
+        'Loadtest': [
+            {'id': survey_id, 'meta': {'name': f"Survey {survey_id}", 'description': 'Generated'}}
+            for survey_id in ids
+        ]
+    }
+    store.put(bucket, 'source/surveys/folders-000001.json', json.dumps(folders).encode(), 'application/json')
+
+    with_attachments = {}
+    for survey_id in ids:
+        snapshot = {'elements': [registration(survey_id, serial_number, rng) for serial_number in range(registrations)]}
+        store.put(bucket, f"source/registrations/{survey_id}/registrations-000001.json",
+                  json.dumps(snapshot).encode(), 'application/json')
+        with_attachments[survey_id] = list(range(min(10, registrations))) if attachments else []
+        for serial_number in with_attachments[survey_id]:
+            for index in range(attachments):
+                store.put(bucket, f"attachments/{survey_id}/{serial_number}/photo-{index}", JPEG, 'image/jpeg')
+    return with_attachments
@@ -0,0 +1,194 @@
+import random
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+OPERATIONS = ('list', 'registration', 'forms', 'csv', 'zip', 'images', 'volumes', 'nonce')
+
+
+def percentile(latencies, fraction):
+    """
+    Nearest-rank percentile of sorted latencies
+    """
+    if not latencies:
+        return None
+    rank = max(1, int(-(-fraction * len(latencies) // 1)))
+    return latencies[rank - 1]
+
+
+class Client:
+    """
+    Sends the operations of the mix to the service with its own HTTP session
+    """
+
+    def __init__(self, base_url, token, surveys, rng, nonces):
+        self.base_url = base_url
+        self.surveys = surveys
+        self.rng = rng
+        self.nonces = nonces
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f"Bearer {token}"
+
+    def _get(self, path, **kwargs):
+        return self.session.get(f"{self.base_url}{path}", timeout=300, **kwargs)
+
+    def _survey(self):
+        return self.rng.choice(list(self.surveys))
+
+    def _export(self, path):
+        response = self._get(path)
+        if response.ok:
+            self.nonces.put(response.json()['nonce'])
+        return response
+
+    def list(self):
+        return self._get(f"/surveys/{self._survey()}/registrations")
+
+    def registration(self):
+        survey_id = self.rng.choice([survey_id for survey_id, serials in self.surveys.items() if serials])
+        return self._get(f"/surveys/{survey_id}/registrations/{self.rng.choice(self.surveys[survey_id])}")
+
+    def forms(self):
+        return self._get("/surveys")
+
+    def csv(self):
+        return self._export(f"/surveys/{self._survey()}/registrations/csvfiles")
+
+    def zip(self):
+        return self._export(f"/surveys/{self._survey()}/registrations/archives")
+
+    def images(self):
+        survey_id = self.rng.choice([survey_id for survey_id, serials in self.surveys.items() if serials])
+        serial_number = self.rng.choice(self.surveys[survey_id])
+        return self._export(f"/surveys/{survey_id}/registrations/{serial_number}/images/archives")
+
+    def volumes(self):
+        survey_id = self.rng.choice([survey_id for survey_id, serials in self.surveys.items() if serials])
+        response = self._get(f"/surveys/{survey_id}/registrations/images/archives", params={'max_registrations': 2})
+        if response.ok:
+            for volume in response.json()['volumes']:
+                self.nonces.put(volume['nonce'])
+        return response
+
+    def nonce(self, nonce):
+        return self._get(f"/surveys/{nonce}", allow_redirects=False)
+
+
+class NoncePool:
+    """
+    The nonces of exports made during the run, each can be downloaded once
+    """
+
+    def __init__(self):
+        self._nonces = []
+        self._lock = threading.Lock()
+
+    def put(self, nonce):
+        with self._lock:
+            self._nonces.append(nonce)
+
+    def take(self):
+        with self._lock:
+            return self._nonces.pop() if self._nonces else None
+
+
+class Run:
+    """
+    A weighted random mix of operations sent by concurrent clients for a
+    fixed duration, after a warmup of which the results are discarded
+    :param base_url: URL of the service
+    :param token: Bearer token accepted by the service
+    :param surveys: dict of survey ID to the serial numbers of registrations with attachments
+    :param mix: dict of operation name to weight
+    :param concurrency: Number of concurrent clients
+    """
+
+    def __init__(self, base_url, token, surveys, mix, concurrency, duration, warmup=0, seed=0):
+        self.base_url = base_url
+        self.token = token
+        self.surveys = surveys
+        self.mix = {operation: weight for operation, weight in mix.items() if weight}
+        self.concurrency = concurrency
+        self.duration = duration
+        self.warmup = warmup
+        self.seed = seed
+        self.nonces = NoncePool()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _request(self, client, operation):
+        """
+        :return: A function that sends the request of the operation, None if it cannot be sent
+        """
+        if operation != 'nonce':
+            return getattr(client, operation)
+        nonce = self.nonces.take()
+        if nonce is None:
+            # Nothing exported yet, this export is not measured
+            client.csv()
+            nonce = self.nonces.take()
+            if nonce is None:
+                return None
+        return lambda: client.nonce(nonce)
+
+    def _work(self, index, measure_from, stop_at):
+        rng = random.Random(f"{self.seed}-{index}")
+        client = Client(self.base_url, self.token, self.surveys, rng, self.nonces)
+        operations, weights = zip(*self.mix.items())
+        while time.perf_counter() < stop_at:
+            operation = rng.choices(operations, weights)[0]
+            try:
+                request = self._request(client, operation)
+            except requests.RequestException:
+                request = None
+            begin = time.perf_counter()
+            try:
+                ok = request is not None and request().status_code < 400
+            except requests.RequestException:
+                ok = False
+            end = time.perf_counter()
+            if begin >= measure_from:
+                with self._lock:
+                    self.latencies[operation].append(end - begin)
+                    if not ok:
+                        self.errors[operation] += 1
+
+    def run(self):
+        """
+        :return: dict of operation name (and 'total') to its results
+        """
+        measure_from = time.perf_counter() + self.warmup
+        stop_at = measure_from + self.duration
+        workers = [
+            threading.Thread(target=self._work, args=(index, measure_from, stop_at))
+            for index in range(self.concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.results()
+
+    def results(self):
+        results = {}
+        everything = []
+        for operation in OPERATIONS:
+            if operation in self.latencies:
+                results[operation] = self._summary(self.latencies[operation], self.errors[operation])
+                everything.extend(self.latencies[operation])
+        results['total'] = self._summary(everything, sum(self.errors.values()))
+        return results
+
+    def _summary(self, latencies, errors):
+        latencies = sorted(latencies)
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / self.duration,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+        }
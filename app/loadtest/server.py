@@ -0,0 +1,72 @@
+"""
+Serve main.app with gunicorn against the fake backends, with the token
+validator replaced by one that accepts the load-test token. The harness runs
+it as `python -m loadtest.server`, with the environment pointing the clients
+at the fakes and a generated config module on the path.
+"""
+import argparse
+import os
+
+from gunicorn.app.base import BaseApplication
+
+TOKEN = 'loadtest-token'
+TOKEN_INFO = {'scopes': ['surveys.read'], 'sub': 'loadtest', 'upn': 'loadtest'}
+
+
+class FakeTokenValidator:
+    """
+    Stand-in of the JWKaas validator of security_controller_
+    """
+
+    @staticmethod
+    def get_connexion_token_info(token):
+        return dict(TOKEN_INFO) if token == TOKEN else None
+
+
+def _anonymous_credentials(*args, **kwargs):
+    from google.auth.credentials import AnonymousCredentials
+
+    return AnonymousCredentials(), os.environ.get('GOOGLE_CLOUD_PROJECT')
+
+
+class LoadTestApplication(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import google.auth
+
+        google.auth.default = _anonymous_credentials
+
+        import main
+        from openapi_server.controllers import security_controller_
+
+        security_controller_.my_jwkaas = FakeTokenValidator()
+        return main.app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bind', default='127.0.0.1:8080')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--timeout', type=int, default=120)
+    args = parser.parse_args()
+    LoadTestApplication({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'timeout': args.timeout,
+        'accesslog': None,
+        'loglevel': 'warning',
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,68 @@
-import logging
-import os
+import time
 
-import config
+STARTUP_BEGIN = time.perf_counter()
 
-import connexion
-from Flask_AuditLog import AuditLog
-from Flask_No_Cache import CacheControl
-from flask_cors import CORS
-from flask_sslify import SSLify
+import logging  # noqa: E402
+import os  # noqa: E402
+
+import config  # noqa: E402
+
+import connexion  # noqa: E402
+from Flask_AuditLog import AuditLog  # noqa: E402
+from Flask_No_Cache import CacheControl  # noqa: E402
+from flask_cors import CORS  # noqa: E402
+from flask_sslify import SSLify  # noqa: E402
+from openapi_server.compression import CompressResponse  # noqa: E402
+from openapi_server.conditional import RevalidateCacheControl  # noqa: E402
+from openapi_server.encoder import JSONEncoder  # noqa: E402
+from openapi_server.specification import load_specification  # noqa: E402
+from settings.prewarm import start_watcher  # noqa: E402
+
+logging.basicConfig(level=logging.INFO)
+
+startup_timings = {'imports': time.perf_counter() - STARTUP_BEGIN}
 
 app = connexion.App(__name__, specification_dir='./openapi_server/openapi/')
-app.add_api('openapi.yaml',
+app.app.json_encoder = JSONEncoder
+
+stage_begin = time.perf_counter()
+specification = load_specification('openapi.yaml')
+startup_timings['specification'] = time.perf_counter() - stage_begin
+
+stage_begin = time.perf_counter()
+app.add_api(specification,
             arguments={'title': 'nssurveyapi'},
             pythonic_params=True)
+startup_timings['add_api'] = time.perf_counter() - stage_begin
+
+stage_begin = time.perf_counter()
 if 'GAE_INSTANCE' in os.environ:
     CORS(app.app, origins=config.ORIGINS)
 else:
     CORS(app.app)
 
-logging.basicConfig(level=logging.INFO)
-
 AuditLog(app)
 CacheControl(app)
+# Must wrap the application after CacheControl, see RevalidateCacheControl
+app.app.wsgi_app = RevalidateCacheControl(app.app.wsgi_app)
+app.app.wsgi_app = CompressResponse(app.app.wsgi_app)
 if 'GAE_INSTANCE' in os.environ:
     SSLify(app.app, permanent=True)
+startup_timings['middleware'] = time.perf_counter() - stage_begin
+
+start_watcher()
+startup_timings['total'] = time.perf_counter() - STARTUP_BEGIN
+
+logging.info(f"Startup timings (s): {startup_timings}")
+
+
+@app.app.after_request
+def report_first_response(response):
+    if 'first_response' not in startup_timings:
+        startup_timings['first_response'] = time.perf_counter() - STARTUP_BEGIN
+        logging.info(f"Cold start to first response took {startup_timings['first_response']:.3f}s")
+    return response
+
 
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080)
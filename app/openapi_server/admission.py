@@ -0,0 +1,190 @@
+import functools
+import logging
+import threading
+import time
+
+import config
+from flask import Response, abort
+
+logger = logging.getLogger(__name__)
+
+# Requests of an operation that run at the same time, per process
+ADMISSION_LIMITS = getattr(config, 'ADMISSION_LIMITS', {
+    'get_registrations_as_csv': 4,
+    'get_registrations_as_zip': 2,
+    'get_bulk_registrations_as_zip': 1,
+    'get_single_images_archive': 2,
+    'get_images_archive_volumes': 1,
+})
+# Requests of an operation that wait for a slot, more are rejected with 429
+ADMISSION_QUEUE_SIZE = getattr(config, 'ADMISSION_QUEUE_SIZE', 8)
+# Seconds a request waits for a slot before it is rejected with 503
+ADMISSION_QUEUE_TIMEOUT = getattr(config, 'ADMISSION_QUEUE_TIMEOUT', 30)
+ADMISSION_RETRY_AFTER = getattr(config, 'ADMISSION_RETRY_AFTER', 10)
+# Threads of a server process, keep it equal to --threads of the entrypoint in app.yaml
+ADMISSION_SERVER_THREADS = getattr(config, 'ADMISSION_SERVER_THREADS', 8)
+# Threads that limited operations, in flight or queued, leave for other requests
+ADMISSION_RESERVED_THREADS = getattr(config, 'ADMISSION_RESERVED_THREADS', 2)
+
+
+class Rejected(Exception):
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class ThreadBudget:
+    """
+    The server threads that the limited operations of all gates may hold
+    together, by running or by waiting in a queue. What remains serves
+    the other requests, e.g. lists and lookups.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.held = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.held >= self.limit:
+                return False
+            self.held += 1
+            return True
+
+    def give(self):
+        with self._lock:
+            self.held -= 1
+
+
+thread_budget = ThreadBudget(max(1, ADMISSION_SERVER_THREADS - ADMISSION_RESERVED_THREADS))
+
+
+class AdmissionGate:
+    """
+    Admits at most limit requests at a time. Others wait in a queue of at
+    most queue_size requests, in arrival order, for at most timeout seconds.
+    Running and waiting requests hold a thread of the shared budget, a
+    request is rejected right away when it is used up.
+    """
+
+    def __init__(self, name, limit, queue_size=ADMISSION_QUEUE_SIZE, timeout=ADMISSION_QUEUE_TIMEOUT,
+                 budget=thread_budget):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.budget = budget
+        self.in_flight = 0
+        self._queue = []
+        self._condition = threading.Condition()
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def acquire(self):
+        """
+        Wait for a slot
+        :raise Rejected: With 429 when the queue is full, 503 when the wait times
+            out or the thread budget is used up
+        """
+        if not self.budget.take():
+            raise Rejected(503, f"All {self.budget.limit} threads for limited operations are in use")
+        try:
+            self._acquire()
+        except Rejected:
+            self.budget.give()
+            raise
+
+    def _acquire(self):
+        with self._condition:
+            if self.in_flight < self.limit and not self._queue:
+                self.in_flight += 1
+                return
+            if len(self._queue) >= self.queue_size:
+                raise Rejected(429, f"Too many {self.name} requests")
+            ticket = object()
+            self._queue.append(ticket)
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self._queue[0] is ticket and self.in_flight < self.limit, self.timeout,
+                )
+            finally:
+                self._queue.remove(ticket)
+                # The next in the queue may be admitted now, or move up
+                self._condition.notify_all()
+            if not admitted:
+                raise Rejected(503, f"No capacity for {self.name} requests within {self.timeout}s")
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+        self.budget.give()
+
+    def status(self):
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'queued': len(self._queue),
+                'queue_size': self.queue_size,
+            }
+
+
+gates = {name: AdmissionGate(name, limit) for name, limit in ADMISSION_LIMITS.items()}
+
+
+def admission_status():
+    """
+    The in-flight requests and queue depth of every limited operation, and
+    of all of them together against the thread budget under 'all'
+    :return: dict of operation to its status
+    """
+    status = {name: gate.status() for name, gate in gates.items()}
+    status['all'] = {
+        'limit': thread_budget.limit,
+        'in_flight': sum(gate_status['in_flight'] for gate_status in status.values()),
+        'queued': sum(gate_status['queued'] for gate_status in status.values()),
+    }
+    return status
+
+
+def admission_controlled(function):
+    """
+    Limit the concurrent requests of a controller operation to its limit in
+    ADMISSION_LIMITS. Operations without a limit are not affected.
+    """
+    gate = gates.get(function.__name__)
+    if gate is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        began = time.monotonic()
+        try:
+            gate.acquire()
+        except Rejected as rejected:
+            status = gate.status()
+            logger.warning(f"Rejected {gate.name} with {rejected.status}: {rejected.reason} ({status})")
+            abort(Response(
+                status=rejected.status,
+                response=rejected.reason,
+                headers={
+                    'Retry-After': str(ADMISSION_RETRY_AFTER),
+                    'X-In-Flight': str(status['in_flight']),
+                    'X-Queue-Depth': str(status['queued']),
+                },
+            ))
+        waited = time.monotonic() - began
+        if waited > 1:
+            logger.info(f"Admitted {gate.name} after waiting {waited:.1f}s")
+        try:
+            return function(*args, **kwargs)
+        finally:
+            gate.release()
+
+    return wrapper
@@ -0,0 +1,135 @@
+import zlib
+
+import config
+from werkzeug.http import parse_accept_header
+
+COMPRESSION_MIN_SIZE = getattr(config, 'COMPRESSION_MIN_SIZE', 1024)
+COMPRESSION_GZIP_LEVEL = getattr(config, 'COMPRESSION_GZIP_LEVEL', 6)
+COMPRESSION_BROTLI_QUALITY = getattr(config, 'COMPRESSION_BROTLI_QUALITY', 5)
+COMPRESSIBLE_CONTENT_TYPES = getattr(config, 'COMPRESSIBLE_CONTENT_TYPES', ['application/json'])
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Choose the content encoding of a response from an Accept-Encoding header,
+    brotli when it is available and preferred at least as much as gzip
+    :param accept_encoding: Value of the Accept-Encoding request header
+    :return: 'br', 'gzip' or None
+    """
+    accepted = parse_accept_header(accept_encoding)
+    gzip_quality = accepted.quality('gzip')
+    brotli_quality = accepted.quality('br') if _brotli() else 0
+    if brotli_quality and brotli_quality >= gzip_quality:
+        return 'br'
+    if gzip_quality:
+        return 'gzip'
+    return None
+
+
+def encoded_etag(etag, encoding):
+    """
+    The ETag of an encoded representation, which has to differ from the ETag
+    of the identity representation
+    """
+    return f"{etag}-{encoding}"
+
+
+def _compressor(encoding):
+    if encoding == 'br':
+        compressor = _brotli().Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+class CompressResponse:
+    """
+    WSGI middleware that compresses responses of the compressible content
+    types with the encoding the client prefers. The body is compressed while
+    it is sent, a chunk at a time. The ETag of a compressed response gets the
+    encoding as suffix, which conditional_response accepts as well. Every
+    response that could have been compressed varies on Accept-Encoding,
+    whether it was compressed or not.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    @staticmethod
+    def _negotiable(status, headers):
+        if status.startswith('304'):
+            # Revalidates a representation that may have been compressed
+            return 'etag' in headers
+        if not status.startswith('200'):
+            return False
+        content_type = headers.get('content-type', '').split(';')[0].strip()
+        return content_type in COMPRESSIBLE_CONTENT_TYPES and 'content-encoding' not in headers
+
+    @staticmethod
+    def _should_compress(status, headers):
+        if not status.startswith('200'):
+            return False
+        content_length = headers.get('content-length')
+        return content_length is None or int(content_length) >= COMPRESSION_MIN_SIZE
+
+    @staticmethod
+    def _vary(headers):
+        vary = [value for name, value in headers if name.lower() == 'vary']
+        if any('accept-encoding' in value.lower() for value in vary):
+            return headers
+        return [(name, value) for name, value in headers if name.lower() != 'vary'] + [
+            ('Vary', ', '.join(vary + ['Accept-Encoding']))
+        ]
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            encoding = None
+
+        compress = []
+
+        def compress_start_response(status, headers, exc_info=None):
+            names = {name.lower(): value for name, value in headers}
+            if not self._negotiable(status, names):
+                return start_response(status, headers, exc_info)
+            headers = self._vary(headers)
+            if encoding is not None and self._should_compress(status, names):
+                # Only the ETag of an encoded body gets the suffix, a 304 keeps the one conditional_response matched
+                headers = [
+                    (name, f'"{encoded_etag(value.strip(chr(34)), encoding)}"' if name.lower() == 'etag' else value)
+                    for name, value in headers
+                    if name.lower() != 'content-length'
+                ]
+                headers.append(('Content-Encoding', encoding))
+                compress.append(encoding)
+            return start_response(status, headers, exc_info)
+
+        body = self.wsgi_app(environ, compress_start_response)
+        if not compress:
+            return body
+        return self._compressed(body, compress[0])
+
+    @staticmethod
+    def _compressed(body, encoding):
+        process, finish = _compressor(encoding)
+        try:
+            for data in body:
+                view = memoryview(data)
+                for offset in range(0, len(view), CHUNK_SIZE):
+                    chunk = process(view[offset:offset + CHUNK_SIZE])
+                    if chunk:
+                        yield chunk
+            yield finish()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
@@ -0,0 +1,65 @@
+import hashlib
+
+from flask import Response, request
+from openapi_server.compression import encoded_etag
+
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+
+
+def snapshot_etag(kind, snapshot, *extra):
+    """
+    Create a strong ETag for a response that is derived from a snapshot blob
+    :param kind: Name of the representation, e.g. 'registrations'
+    :param snapshot: The (listed) blob of the snapshot
+    :param extra: Other values the representation depends on
+    :return:
+    """
+    parts = [kind, snapshot.name, str(snapshot.generation), *map(str, extra)]
+    return hashlib.sha1(':'.join(parts).encode('utf-8')).hexdigest()
+
+
+def etag_variants(etag):
+    return [etag, encoded_etag(etag, 'gzip'), encoded_etag(etag, 'br')]
+
+
+def conditional_response(etag, build, headers=None):
+    """
+    Return a 304 Not Modified when the client already has the representation
+    identified by etag, otherwise build the body and return it with its ETag
+    :param etag: The strong ETag of the representation
+    :param build: Function returning the response body
+    :param headers: Headers of a full response
+    :return:
+    """
+    # A compressed response carried the ETag with the encoding as suffix, a
+    # 304 returns the ETag of the representation the client has
+    matched = next((variant for variant in etag_variants(etag) if request.if_none_match.contains(variant)), None)
+    if matched is not None:
+        response = Response(status=304)
+        response.set_etag(matched)
+    else:
+        response = Response(build(), headers=headers)
+        response.set_etag(etag)
+    return response
+
+
+class RevalidateCacheControl:
+    """
+    WSGI middleware that allows clients to store responses carrying an ETag,
+    so they can revalidate them with If-None-Match. Other responses keep the
+    Cache-Control set by the application (Flask_No_Cache). It has to wrap the
+    application after CacheControl has been installed.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        def revalidate_start_response(status, headers, exc_info=None):
+            if any(name.lower() == 'etag' for name, _ in headers):
+                headers = [(name, value) for name, value in headers
+                           if name.lower() not in ('cache-control', 'pragma', 'expires')]
+                headers.append(('Cache-Control', REVALIDATE_CACHE_CONTROL))
+            return start_response(status, headers, exc_info)
+
+        return self.wsgi_app(environ, revalidate_start_response)
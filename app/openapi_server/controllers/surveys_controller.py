@@ -1,5 +1,4 @@
 import datetime
-import json
 import logging
 import mimetypes
 import os
@@ -8,16 +7,68 @@ import tempfile
 import threading
 import time
 import uuid
-import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import Response, abort, redirect
-from google.cloud import datastore, storage
-from settings import create_csv_file, create_zip_file, get_batch_registrations
+from openapi_server.admission import admission_controlled, admission_status
+from openapi_server.conditional import conditional_response, snapshot_etag
+from settings import codec
+from settings import (create_bulk_zip_file, create_registration_list, create_zip_file,
+                      get_batch_registrations, get_latest_snapshot, write_csv_file)
+from settings.archive import ArchiveWriter, plan_volumes
+from settings.attachments import attachment_index
+from settings.blob_cache import attachment_cache
+from settings.forms_catalog import forms_catalog
+from settings.offsets import read_registration
+from settings.derivatives import PREVIEW_SIZES, ensure_previews
+from settings.memory import in_memory_profile, memory_profiled, memory_stage, recent_profiles
+from settings.prewarm import PREBUILT_CSV, PREBUILT_LIST, PREBUILT_ZIP, find_prebuilt
+from settings.query import ExportQuery, QueryError, split_filters
+from settings.registrations import load_registrations
+from settings.storage_io import storage_io
+from settings.upload import upload_file
 
 import config
 
 logger = logging.getLogger(__name__)
 
+SIGNED_URL_EXPIRATION = getattr(config, "SIGNED_URL_EXPIRATION", 300)
+# URLs signed at the same time through the IAM API, for all requests of the instance
+SIGNED_URL_CONCURRENCY = getattr(config, "SIGNED_URL_CONCURRENCY", 8)
+BULK_EXPORT_CONCURRENCY = getattr(config, "BULK_EXPORT_CONCURRENCY", 4)
+# Exports of these types are written and stored compressed, storage decompresses
+# them when downloaded. Supported for text/csv.
+GZIP_STORED_CONTENT_TYPES = getattr(config, "GZIP_STORED_CONTENT_TYPES", ["text/csv"])
+# Defaults of the bounds of image archive volumes, the size in MB
+IMAGE_ARCHIVE_VOLUME_SIZE = getattr(config, "IMAGE_ARCHIVE_VOLUME_SIZE", 512)
+IMAGE_ARCHIVE_VOLUME_REGISTRATIONS = getattr(config, "IMAGE_ARCHIVE_VOLUME_REGISTRATIONS", None)
+# Volumes of a request that are built and uploaded at the same time
+IMAGE_ARCHIVE_VOLUME_CONCURRENCY = getattr(config, "IMAGE_ARCHIVE_VOLUME_CONCURRENCY", 2)
+
+
+url_signing_executor = ThreadPoolExecutor(max_workers=SIGNED_URL_CONCURRENCY, thread_name_prefix="sign-url")
+_signing_credentials = None
+_signing_lock = threading.Lock()
+
+
+def get_signing_credentials():
+    """
+    The default credentials, shared by all requests. Credentials without a
+    private key have a valid access token, to sign through the IAM API.
+    :return:
+    """
+    import google.auth
+    from google.auth.transport.requests import Request
+
+    global _signing_credentials
+    with _signing_lock:
+        if _signing_credentials is None:
+            _signing_credentials, _ = google.auth.default()
+        if not hasattr(_signing_credentials, "sign_bytes") and not _signing_credentials.valid:
+            _signing_credentials.refresh(Request())
+        return _signing_credentials
+
 
 class Registration:
     """
@@ -32,64 +83,102 @@ class Registration:
 
         self.bucket = bucket
 
-    def get_registrations(self, prefix):
+    def get_snapshot(self, prefix):
         """
-        Get all registrations
+        Get the latest snapshot blob without downloading it
         :return:
         """
-        registrations = {}
-        batch = get_batch_registrations(self.bucket, prefix)
-        if batch and batch["elements"]:
-            for registration in batch["elements"]:
-                registrations[registration["meta"]["serialNumber"]] = registration
-            # self.registrations = registrations
-            return registrations
-        else:
+        snapshot = get_latest_snapshot(self.bucket, prefix)
+        if snapshot is None:
             abort(
                 Response(status=404, response=f"No registrations found using: {prefix}")
             )
+        return snapshot
 
-    def get_csv(self, survey_id):
+    def get_registrations(self, prefix, snapshot=None):
         """
-        Return a csv file of all registrations
+        Get all registrations by serial number, in their compact form
         :return:
         """
-        registrations = self.get_registrations(prefix=survey_id)
-        return create_csv_file(registrations)
+        with memory_stage('decode'):
+            registrations = load_registrations(self.bucket, prefix, snapshot=snapshot)
+        if registrations:
+            return registrations
+        else:
+            abort(
+                Response(status=404, response=f"No registrations found using: {prefix}")
+            )
 
-    def get_zip(self, survey_id):
+    def get_csv(self, survey_id, snapshot=None, query=None, compress=False):
+        """
+        Return a csv file of all registrations, or of the fields and registrations selected by query
+        :param compress: Write it gzip compressed
+        :return: The path of the csv file
+        """
+        registrations = self.get_registrations(prefix=survey_id, snapshot=snapshot)
+        if query:
+            with memory_stage('query'):
+                registrations = query.apply(registrations)
+        csv_file_name = f"{tempfile.gettempdir()}/{self.request_id}/blobs.csv{'.gz' if compress else ''}"
+        os.makedirs(os.path.dirname(csv_file_name))
+        return write_csv_file(registrations, csv_file_name, compress=compress)
+
+    def get_zip(self, survey_id, snapshot=None, query=None):
         """
-        Return a zip file of all registrations
+        Return a zip file of all registrations, or of the fields and registrations selected by query
 
         :return:
         """
-        registrations = self.get_registrations(prefix=survey_id)
+        registrations = self.get_registrations(prefix=survey_id, snapshot=snapshot)
+        if query:
+            with memory_stage('query'):
+                registrations = query.apply(registrations)
         return create_zip_file(registrations, self.request_id)
 
-    def get_list(self, survey_id):
+    def get_bulk_zip(self, survey_ids, query=None):
+        """
+        Return a zip file of the registrations of several surveys. Snapshots
+        are downloaded concurrently, a few ahead of the survey being written.
+        :param survey_ids: The surveys to export
+        :param query: The fields and registrations to export of every survey
+        :return:
+        """
+
+        def get_registrations(survey_id):
+            registrations = self.get_registrations(survey_id)
+            return query.apply(registrations) if query else registrations
+
+        def surveys_per_id(executor):
+            pending = deque()
+            decode = in_memory_profile(get_registrations)
+            for survey_id in survey_ids:
+                pending.append((survey_id, executor.submit(decode, survey_id)))
+                if len(pending) > BULK_EXPORT_CONCURRENCY:
+                    survey_id, future = pending.popleft()
+                    yield survey_id, future.result()
+            while pending:
+                survey_id, future = pending.popleft()
+                yield survey_id, future.result()
+
+        with ThreadPoolExecutor(max_workers=BULK_EXPORT_CONCURRENCY) as executor:
+            return create_bulk_zip_file(surveys_per_id(executor), self.request_id)
+
+    def get_list(self, survey_id, snapshot=None):
         """
         Get a list of all registrations meta information
         :return:
         """
-        registrations = self.get_registrations(prefix=survey_id)
-        registration_list = {}
-        for key in registrations:
-            registration_list[registrations[key]["info"]["formId"]] = [
-                dict(
-                    serial_number=k,
-                    date_of_registration=int(v["meta"]["registrationDate"]),
-                    site_location=v["data"]["tMNLLocationID"]["CITY"]
-                    if "tMNLLocationID" in v["data"].keys()
-                    else "",
-                    site_id=v["data"]["siteID"]
-                    if "siteID" in v["data"].keys()
-                    else "".join(n for n in v["info"]["formName"] if n.isdigit()),
-                )
-                for k, v in registrations.items()
-            ]
+        registrations = self.get_registrations(prefix=survey_id, snapshot=snapshot)
+        return create_registration_list(registrations)
 
-        # self.registration_list = registration_list
-        return json.dumps(registration_list)
+    def get_attachments(self, survey_id, registration_id):
+        """
+        Return the attachment index entries of a registration, or of all
+        registrations of the survey if no registration is given
+        """
+        if registration_id:
+            return attachment_index.registration(self.bucket, survey_id, registration_id)
+        return attachment_index.survey(self.bucket, survey_id)
 
     def get_attachment_list(self, survey_id, registration_id):
         """
@@ -98,18 +187,10 @@ class Registration:
         :param registration_id: An int value to represent which registration is in qtn e.g e213424jfsdkfh234
         :return:
         """
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(self.bucket)
-        blobs = bucket.list_blobs(
-            prefix=f'attachments/{survey_id}/{registration_id if registration_id else ""}'
-        )
-        images = {}
-        for blob in blobs:
-            images[
-                blob.name
-            ] = (
-                blob.content_type
-            )  # Future: Other detail neccessary for front end i.v.m type
+        images = {
+            entry.name: entry.content_type  # Future: Other detail neccessary for front end i.v.m type
+            for entry in self.get_attachments(survey_id, registration_id)
+        }
 
         if images:
             # self.images = images
@@ -122,33 +203,166 @@ class Registration:
                 )
             )
 
-    def get_images(self, survey_id, registration_id):
+    def get_images(self, survey_id, registration_id, registration_ids=None, location=None):
         """
         Retrieves a list single image of a file to a temporary directory
+        :param registration_ids: Only these registrations of the survey, when no registration_id is given
+        :param location: The directory, a directory of the request by default
         """
-        images = self.get_attachment_list(survey_id, registration_id)
-        logger.warning(f"Images collection: {images}")
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(self.bucket)
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+
+        self.get_attachment_list(survey_id, registration_id)
 
-        location = f"{tempfile.gettempdir()}/images/{self.request_id}/{registration_id if registration_id else survey_id}/"
+        if location is None:
+            location = f"{tempfile.gettempdir()}/images/{self.request_id}/{registration_id if registration_id else survey_id}/"
         logger.warning(location)
         try:
             os.makedirs(location)
         except FileExistsError:
             pass
 
-        for key in images:
-            mime_type = images[key]
-            blob = bucket.blob(key)
-            logger.warning(f"Downloading {blob.name} to {location}")
-            blob.download_to_filename(
-                f'{location}/{survey_id}-{registration_id if registration_id else ""}-{blob.name.split("/")[-1]}'
-                f"{mimetypes.guess_extension(mime_type)}"
+        def file_name(entry):
+            # attachments/{survey_id}/{registration_id}/{name}, file names of registrations may be the same
+            return (
+                f'{location}/{survey_id}-{entry.name.split("/")[2]}-{entry.name.split("/")[-1]}'
+                f"{mimetypes.guess_extension(entry.content_type)}"
             )
 
+        downloaded = set()
+        for attempt in range(2):
+            attachments = [
+                entry for entry in self.get_attachments(survey_id, registration_id)
+                if entry.name not in downloaded
+            ]
+            if registration_ids is not None:
+                attachments = [entry for entry in attachments if entry.name.split("/")[2] in registration_ids]
+            # Unchanged attachments are taken from the local cache
+            cached = [entry for entry in attachments if attachment_cache.fetch(self.bucket, entry, file_name(entry))]
+            downloaded.update(entry.name for entry in cached)
+            attachments = [entry for entry in attachments if entry.name not in downloaded]
+            logger.warning(f"Downloading {[entry.name for entry in attachments]} to {location}, {len(cached)} cached")
+            results = storage_io.download_many(self.bucket, [
+                (entry.name, file_name(entry), entry.generation) for entry in attachments
+            ])
+            for entry, error in zip(attachments, results):
+                if error is None:
+                    downloaded.add(entry.name)
+                    attachment_cache.store(self.bucket, entry, file_name(entry))
+            errors = [error for error in results if error is not None]
+            if not errors:
+                break
+            outdated = [error for error in errors if isinstance(error, (NotFound, PreconditionFailed))]
+            if attempt or len(outdated) < len(errors):
+                raise errors[0]
+            logger.info(f"Attachment index of survey {survey_id} is outdated ({outdated[0]}), listing again")
+            attachment_index.invalidate(self.bucket, survey_id)
+
+        attachment_cache.trim()
         return location
 
+    def get_url_signer(self):
+        """
+        Return a function that creates short-lived V4 signed URLs for blobs
+        in the bucket. URLs are signed locally when the credentials of this
+        instance hold a private key. Other credentials (e.g. App Engine and
+        Compute Engine default) sign through the IAM signBlob API, a round
+        trip per URL, so those are signed concurrently. That requires the
+        service account to have the Service Account Token Creator role
+        (roles/iam.serviceAccountTokenCreator) on itself.
+        :return: Function of blob names to a dict of name to URL
+        """
+        from google.cloud import storage
+
+        credentials = get_signing_credentials()
+        signing = {}
+        if not hasattr(credentials, "sign_bytes"):
+            signing = dict(
+                service_account_email=credentials.service_account_email,
+                access_token=credentials.token,
+            )
+
+        storage_client = storage.Client(credentials=credentials)
+        bucket = storage_client.bucket(self.bucket)
+        expiration = datetime.timedelta(seconds=SIGNED_URL_EXPIRATION)
+
+        def sign_one(name):
+            return bucket.blob(name).generate_signed_url(
+                version="v4",
+                expiration=expiration,
+                method="GET",
+                **signing,
+            )
+
+        def sign(names):
+            names = list(names)
+            if not signing:
+                return {name: sign_one(name) for name in names}
+            return dict(zip(names, url_signing_executor.map(sign_one, names)))
+
+        return sign
+
+    def get_signed_urls(self, survey_id, registration_id):
+        """
+        Return short-lived V4 signed URLs for all attachments of a registration,
+        so browsers can download the attachments directly from storage.
+        :param survey_id: A form or survey ID
+        :param registration_id: A registration ID
+        :return:
+        """
+        attachments = self.get_attachments(survey_id, registration_id)
+        if not attachments:
+            abort(
+                Response(
+                    status=404,
+                    response=f"No registrations found using: {survey_id} and {registration_id}",
+                )
+            )
+
+        urls = self.get_url_signer()(entry.name for entry in attachments)
+        expires = int(time.time()) + SIGNED_URL_EXPIRATION
+        return codec.dumps(
+            {
+                entry.name: dict(
+                    url=urls[entry.name],
+                    mime_type=entry.content_type,
+                    size=entry.size,
+                    expires=expires,
+                )
+                for entry in attachments
+            }
+        )
+
+    def get_previews(self, survey_id, registration_id, size):
+        """
+        Return signed URLs of resized previews of the images of a registration.
+        Missing previews are generated first and kept under the derivatives prefix.
+        :param survey_id: A form or survey ID
+        :param registration_id: A registration ID
+        :param size: Maximum width and height of the previews
+        :return:
+        """
+        from google.cloud import storage
+
+        attachments = self.get_attachments(survey_id, registration_id)
+        storage_client = storage.Client()
+        previews = ensure_previews(storage_client.bucket(self.bucket), attachments, size)
+        if not previews:
+            abort(
+                Response(
+                    status=404,
+                    response=f"No images found using: {survey_id} and {registration_id}",
+                )
+            )
+
+        urls = self.get_url_signer()(previews.values())
+        expires = int(time.time()) + SIGNED_URL_EXPIRATION
+        return codec.dumps(
+            {
+                name: dict(url=urls[preview], mime_type="image/jpeg", expires=expires)
+                for name, preview in previews.items()
+            }
+        )
+
     @staticmethod
     def clean_images(location):
         logger.warning(f"Cleanup {location}")
@@ -163,19 +377,15 @@ class Registration:
         Compress a directory (ZIP file).
         """
         if os.path.exists(directory):
-            batch_images_file_archive = zipfile.ZipFile(
-                zip_file_name, "w", zipfile.ZIP_DEFLATED
-            )
-
             rootdir = os.path.basename(directory)
 
-            for dirpath, dirnames, filenames in os.walk(directory):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    parentpath = os.path.relpath(filepath, directory)
-                    arcname = os.path.join(rootdir, parentpath)
-                    batch_images_file_archive.write(filepath, arcname)
-            batch_images_file_archive.close()
+            with ArchiveWriter(zip_file_name) as batch_images_file_archive:
+                for dirpath, dirnames, filenames in os.walk(directory):
+                    for filename in filenames:
+                        filepath = os.path.join(dirpath, filename)
+                        parentpath = os.path.relpath(filepath, directory)
+                        arcname = os.path.join(rootdir, parentpath)
+                        batch_images_file_archive.write(filepath, arcname)
 
     def get_registrations_images_archive(self, survey_id):
         """
@@ -183,51 +393,112 @@ class Registration:
         :param survey_id: A form or survey ID
         :return:
         """
-        location = self.get_images(survey_id, registration_id=False)
+        with memory_stage('download'):
+            location = self.get_images(survey_id, registration_id=False)
         images_file = f"{tempfile.gettempdir()}/img-{self.request_id}.zip"
 
-        self.zip_image_dir(location, images_file)
+        with memory_stage('archive'):
+            self.zip_image_dir(location, images_file)
         self.clean_images(location)
         return images_file
 
+    def get_registrations_images_volumes(self, survey_id, max_size=None, max_registrations=None, volumes=None):
+        """
+        Archive all registration images of a survey in volumes of a bounded
+        size, built and uploaded concurrently. The volumes are the same for
+        the same attachments and bounds, so a client can request again only
+        the volumes it could not download.
+        :param survey_id: A form or survey ID
+        :param max_size: Maximum size of the images in a volume, in bytes
+        :param max_registrations: Maximum number of registrations in a volume
+        :param volumes: Numbers of the volumes to build, counting from 1, all by default
+        :return: The manifest, with the nonce of every volume
+        """
+        plan = plan_volumes(attachment_index.get(self.bucket, survey_id).registrations, max_size, max_registrations)
+        if not plan:
+            abort(Response(status=404, response=f"No images found using: {survey_id}"))
+        numbers = list(dict.fromkeys(volumes)) if volumes else range(1, len(plan) + 1)
+        if any(number < 1 or number > len(plan) for number in numbers):
+            abort(Response(status=400, response=f"The images of {survey_id} fit in {len(plan)} volumes"))
+
+        def build(number):
+            file_name = f"images-{survey_id}-{number:03d}-of-{len(plan):03d}.zip"
+            with memory_stage('download'):
+                location = self.get_images(
+                    survey_id, registration_id=False, registration_ids=set(plan[number - 1]),
+                    location=f"{tempfile.gettempdir()}/images/{self.request_id}/{survey_id}-{number}/",
+                )
+            images_file = f"{tempfile.gettempdir()}/img-{self.request_id}-{number}.zip"
+            try:
+                with memory_stage('archive'):
+                    self.zip_image_dir(location, images_file)
+                size = os.path.getsize(images_file)
+                nonce = store_nonce_download(
+                    "zip",
+                    {
+                        "Content-Type": "application/zip",
+                        "Content-Disposition": f'attachment; filename="{file_name}"',
+                    },
+                    file_name=images_file,
+                )
+            finally:
+                self.clean_images(location)
+                if os.path.exists(images_file):
+                    os.remove(images_file)
+            return dict(volume=number, nonce=nonce, file_name=file_name, size=size, registrations=plan[number - 1])
+
+        with ThreadPoolExecutor(max_workers=IMAGE_ARCHIVE_VOLUME_CONCURRENCY) as executor:
+            built = list(executor.map(in_memory_profile(build), numbers))
+        return codec.dumps(dict(survey_id=survey_id, volume_count=len(plan), volumes=built))
+
     def get_single_registration_images_archive(self, survey_id, registration_id):
         """
         Download a Zip file archive for a single registration
         :return:
         """
-        location = self.get_images(survey_id, registration_id)
+        with memory_stage('download'):
+            location = self.get_images(survey_id, registration_id)
         images_file = (
             f"{tempfile.gettempdir()}/{self.request_id}/img-{registration_id}.zip"
         )
         os.makedirs(os.path.dirname(images_file))
 
-        self.zip_image_dir(location, images_file)
+        with memory_stage('archive'):
+            self.zip_image_dir(location, images_file)
         self.clean_images(location)
         return images_file
 
-    def has_registration_images(self, view_id):
+    def has_registration_images(self, view_ids):
         """
-        Get a list of Registrations with an image saved in the storage
-        :return:
+        Check which of the forms have a registration with an image saved in the
+        storage. Forms that are not in the attachment index are checked concurrently.
+        :param view_ids: The form IDs
+        :return: dict of form ID to True or False
         """
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(self.bucket)
-        list_blobs = list(
-            bucket.list_blobs(prefix=f"attachments/{view_id}", max_results=1)
-        )
-        return True if list_blobs else False
-
-    def get_survey_forms_list(self):
+        has_images = {}
+        for view_id in view_ids:
+            survey_attachments = attachment_index.cached(self.bucket, view_id)
+            if survey_attachments is not None:
+                has_images[view_id] = bool(survey_attachments)
+
+        unknown = {f"attachments/{view_id}/": view_id for view_id in view_ids if view_id not in has_images}
+        if unknown:
+            for prefix, has_blobs in storage_io.has_blobs(self.bucket, list(unknown)).items():
+                has_images[unknown[prefix]] = has_blobs
+        return has_images
+
+    def get_survey_forms_list(self, snapshot=None):
         """
         Return all forms available
-        :return:
+        :return: JSON of the forms per folder, None if there are none
         """
-        forms_list = get_batch_registrations(self.bucket, "surveys")
+        forms_list = get_batch_registrations(self.bucket, "surveys", snapshot=snapshot)
         forms = {}
 
         if not forms_list:
-            abort(Response(status=404, response="No registrations found"))
+            return None
 
+        has_images = self.has_registration_images([form["id"] for value in forms_list.values() for form in value])
         for key, value in forms_list.items():
             forms[key] = []
             for form in value:
@@ -235,78 +506,177 @@ class Registration:
                     dict(
                         survey_id=form["id"],
                         name=form["meta"]["name"],
-                        has_images=self.has_registration_images(form["id"]),
+                        has_images=has_images[form["id"]],
                         description_text=form["meta"].get("description", ""),
                     )
                 )
-        return json.dumps(forms)
+        return codec.dumps(forms)
 
 
-def get_registrations_as_csv(survey_id):
+def store_nonce_download(extension, headers, data=None, file_name=None, source_blob=None, content_encoding=None):
     """
-    This aims to create a csv file from all
-    the registrations that have been downloaded
+    Upload an export to the nonce bucket and register it as a download,
+    to be picked up by get_surveys_nonce
+    :param extension: Extension of the blob, e.g. csv
+    :param headers: Headers of the download, Content-Type is used for the upload
+    :param data: Content of the export
+    :param file_name: Path of the export, when not given as data
+    :param source_blob: A prebuilt export to copy, when not given as data or file
+    :param content_encoding: 'gzip' when the file was written compressed
+    :return: The nonce
     """
+    from google.cloud import datastore, storage
+
     store_client = storage.Client()
-    nonce_bucket = store_client.get_bucket(config.NONCE_BUCKET)
+    nonce_bucket = store_client.bucket(config.NONCE_BUCKET)
     nonce = str(uuid.uuid4())
-    nonce_blob = nonce_bucket.blob(f"{nonce}.csv")
-    registration_instance = Registration(bucket=config.BUCKET)
-    nonce_blob.upload_from_string(
-        registration_instance.get_csv(survey_id), content_type="text/csv"
-    )
+    if file_name is not None:
+        with memory_stage('upload'):
+            upload_file(
+                nonce_bucket, f"{nonce}.{extension}", file_name, headers["Content-Type"],
+                content_encoding=content_encoding,
+            )
+    elif source_blob is not None:
+        # Copied within storage, large objects take several rewrite calls
+        nonce_blob = nonce_bucket.blob(f"{nonce}.{extension}")
+        token, _, _ = nonce_blob.rewrite(source_blob)
+        while token is not None:
+            token, _, _ = nonce_blob.rewrite(source_blob, token=token)
+    else:
+        nonce_blob = nonce_bucket.blob(f"{nonce}.{extension}")
+        nonce_blob.upload_from_string(data, content_type=headers["Content-Type"])
+
     db_client = datastore.Client()
     downloads_key = db_client.key("Downloads", nonce)
     downloads = datastore.Entity(key=downloads_key)
     downloads.update(
         {
-            "created": datetime.datetime.now(),
-            "blob_name": f"{nonce}.csv",
-            "headers": {
-                "Content-Type": "text/csv",
-                "Content-Disposition": 'attachment; filename="~/blobs.csv"',
-            },
+            "created": datetime.datetime.utcnow(),
+            "blob_name": f"{nonce}.{extension}",
+            "headers": headers,
         }
     )
     db_client.put(downloads)
+    return downloads.key.id_or_name
+
+
+def create_nonce_download(extension, headers, data=None, file_name=None, source_blob=None, mime_type=None,
+                          content_encoding=None):
+    """
+    Store an export with store_nonce_download and respond with its nonce
+    :param mime_type: The mime_type returned to the client, Content-Type by default
+    :return:
+    """
+    nonce = store_nonce_download(extension, headers, data=data, file_name=file_name, source_blob=source_blob,
+                                 content_encoding=content_encoding)
     return Response(
-        json.dumps({"nonce": downloads.key.id_or_name, "mime_type": "text/csv"}),
+        codec.dumps({"nonce": nonce, "mime_type": mime_type or headers["Content-Type"]}),
         headers={"Content-Type": "application/json"},
     )
 
 
-def get_registrations_as_zip(survey_id):
+def remove_export(file_name):
+    os.remove(file_name)
+    os.removedirs(os.path.dirname(file_name))
+
+
+def get_export_query(fields=None, filters=None, query_string=False):
+    """
+    Parse the fields and filters of an export, abort when they are invalid
+    :param fields: Dotted paths of the data to export
+    :param filters: Conditions on meta, info or data values a registration should meet
+    :param query_string: The filters are the values of the filter query parameter, with escaped commas
+    :return:
+    """
+    try:
+        if query_string:
+            filters = split_filters(filters)
+        return ExportQuery(fields, filters)
+    except QueryError as e:
+        abort(Response(status=400, response=str(e)))
+
+
+@admission_controlled
+@memory_profiled("csv")
+def get_registrations_as_csv(survey_id, fields=None, filter_=None):
+    """
+    This aims to create a csv file from all
+    the registrations that have been downloaded
+    :param fields: Only export these (dotted) paths of the data
+    :param filter_: Only export the registrations that meet these conditions
+    """
+    headers = {
+        "Content-Type": "text/csv",
+        "Content-Disposition": 'attachment; filename="~/blobs.csv"',
+    }
+    query = get_export_query(fields, filter_, query_string=True)
+    registration_instance = Registration(bucket=config.BUCKET)
+    snapshot = registration_instance.get_snapshot(survey_id)
+    prebuilt = None if query else find_prebuilt(survey_id, snapshot, PREBUILT_CSV)
+    if prebuilt is not None:
+        return create_nonce_download("csv", headers, source_blob=prebuilt)
+
+    compress = headers["Content-Type"] in GZIP_STORED_CONTENT_TYPES
+    csv_file_name = registration_instance.get_csv(survey_id, snapshot=snapshot, query=query, compress=compress)
+    try:
+        return create_nonce_download(
+            "csv", headers, file_name=csv_file_name, content_encoding="gzip" if compress else None
+        )
+    finally:
+        remove_export(csv_file_name)
+
+
+@admission_controlled
+@memory_profiled("zip")
+def get_registrations_as_zip(survey_id, fields=None, filter_=None):
     """
     This aims to create a csv zip file from all
     the registrations that have been downloaded
+    :param fields: Only export these (dotted) paths of the data
+    :param filter_: Only export the registrations that meet these conditions
     """
-    store_client = storage.Client()
-    nonce_bucket = store_client.get_bucket(config.NONCE_BUCKET)
-    nonce = str(uuid.uuid4())
-    nonce_blob = nonce_bucket.blob(f"{nonce}.zip")
+    headers = {
+        "Content-Type": "application/zip",
+        "Content-Disposition": 'attachment; filename="~/surveys.zip"',
+    }
+    query = get_export_query(fields, filter_, query_string=True)
     registration_instance = Registration(bucket=config.BUCKET)
-    zip_file_name = registration_instance.get_zip(survey_id)
-    nonce_blob.upload_from_filename(zip_file_name, content_type="application/zip")
-    os.remove(zip_file_name)
-    os.removedirs(os.path.dirname(zip_file_name))
-    db_client = datastore.Client()
-    downloads_key = db_client.key("Downloads", nonce)
-    downloads = datastore.Entity(key=downloads_key)
-    downloads.update(
-        {
-            "created": datetime.datetime.utcnow(),
-            "blob_name": f"{nonce}.zip",
-            "headers": {
+    snapshot = registration_instance.get_snapshot(survey_id)
+    prebuilt = None if query else find_prebuilt(survey_id, snapshot, PREBUILT_ZIP)
+    if prebuilt is not None:
+        return create_nonce_download("zip", headers, source_blob=prebuilt)
+
+    zip_file_name = registration_instance.get_zip(survey_id, snapshot=snapshot, query=query)
+    try:
+        return create_nonce_download("zip", headers, file_name=zip_file_name)
+    finally:
+        remove_export(zip_file_name)
+
+
+@admission_controlled
+@memory_profiled("bulk_zip")
+def get_bulk_registrations_as_zip(body):
+    """
+    Create a single zip file with the registrations of several surveys,
+    a folder per survey
+    :param body: A dict with the survey_ids to export, and optionally the fields and filter of all of them
+    :return:
+    """
+    survey_ids = list(dict.fromkeys(body["survey_ids"]))
+    query = get_export_query(body.get("fields"), body.get("filter"))
+    registration_instance = Registration(bucket=config.BUCKET)
+    zip_file_name = registration_instance.get_bulk_zip(survey_ids, query=query)
+    try:
+        return create_nonce_download(
+            "zip",
+            {
                 "Content-Type": "application/zip",
                 "Content-Disposition": 'attachment; filename="~/surveys.zip"',
             },
-        }
-    )
-    db_client.put(downloads)
-    return Response(
-        json.dumps({"nonce": downloads.key.id_or_name, "mime_type": "application/zip"}),
-        headers={"Content-Type": "application/json"},
-    )
+            file_name=zip_file_name,
+        )
+    finally:
+        remove_export(zip_file_name)
 
 
 def get_registrations_list(survey_id):
@@ -315,8 +685,42 @@ def get_registrations_list(survey_id):
     :return:
     """
     registration_instance = Registration(bucket=config.BUCKET)
-    return Response(
-        registration_instance.get_list(survey_id),
+    snapshot = registration_instance.get_snapshot(survey_id)
+
+    def build():
+        prebuilt = find_prebuilt(survey_id, snapshot, PREBUILT_LIST)
+        if prebuilt is not None:
+            return prebuilt.download_as_string()
+        return registration_instance.get_list(survey_id, snapshot=snapshot)
+
+    return conditional_response(
+        snapshot_etag("registrations", snapshot),
+        build,
+        headers={
+            "Content-Type": "application/json",
+        },
+    )
+
+
+def get_registration(survey_id, registration_id):
+    """
+    Return a single registration, read from the snapshot by its offset
+    :param survey_id: A form or survey ID
+    :param registration_id: The serial number of the registration
+    :return:
+    """
+    registration_instance = Registration(bucket=config.BUCKET)
+    snapshot = registration_instance.get_snapshot(survey_id)
+
+    def build():
+        registration = read_registration(config.BUCKET, snapshot, registration_id)
+        if registration is None:
+            abort(Response(status=404, response=f"No registration found using: {survey_id} and {registration_id}"))
+        return registration
+
+    return conditional_response(
+        snapshot_etag("registration", snapshot, registration_id),
+        build,
         headers={
             "Content-Type": "application/json",
         },
@@ -329,8 +733,14 @@ def get_forms_list():
     :return:
     """
     registration_instance = Registration(bucket=config.BUCKET)
-    return Response(
-        registration_instance.get_survey_forms_list(),
+    # Served from the catalog of this process, refreshed in the background
+    # once it passed its TTL, so storage is only waited for by the first request
+    catalog = forms_catalog.get(config.BUCKET, registration_instance.get_survey_forms_list)
+    if catalog is None:
+        abort(Response(status=404, response="No registrations found"))
+    return conditional_response(
+        catalog.etag,
+        lambda: catalog.body,
         headers={
             "Content-Type": "application/json",
         },
@@ -348,6 +758,46 @@ def get_registrations_attachments(survey_id, registration_id):
     return registration_instance.get_attachment_list(survey_id, registration_id)
 
 
+def get_registrations_attachments_urls(survey_id, registration_id):
+    """
+    Get signed URLs of all attachments of a registration
+    :param survey_id: An integer that represents a form or a survey eg e34njedjsfh4jk5
+    :param registration_id: An integer that represents a Registration e.g => 7
+    :return:
+    """
+    registration_instance = Registration(bucket=config.BUCKET)
+    return Response(
+        registration_instance.get_signed_urls(survey_id, registration_id),
+        headers={
+            "Content-Type": "application/json",
+        },
+    )
+
+
+def get_registrations_attachments_previews(survey_id, registration_id, size=None):
+    """
+    Get signed URLs of previews of all images of a registration
+    :param survey_id: An integer that represents a form or a survey eg e34njedjsfh4jk5
+    :param registration_id: An integer that represents a Registration e.g => 7
+    :param size: Maximum width and height of the previews
+    :return:
+    """
+    if size is None:
+        size = PREVIEW_SIZES[0]
+    if size not in PREVIEW_SIZES:
+        abort(Response(status=400, response=f"Preview size should be one of: {PREVIEW_SIZES}"))
+
+    registration_instance = Registration(bucket=config.BUCKET)
+    return Response(
+        registration_instance.get_previews(survey_id, registration_id, size),
+        headers={
+            "Content-Type": "application/json",
+        },
+    )
+
+
+@admission_controlled
+@memory_profiled("images")
 def get_single_images_archive(survey_id, registration_id):
     """
     Download a zip archive of a single registration
@@ -355,48 +805,79 @@ def get_single_images_archive(survey_id, registration_id):
     :param registration_id: An integer that represents a Registration e.g => 7
     :return:
     """
-    store_client = storage.Client()
-    nonce_bucket = store_client.get_bucket(config.NONCE_BUCKET)
-    nonce = str(uuid.uuid4())
-    nonce_blob = nonce_bucket.blob(f"{nonce}.zip")
     logger.warning("Single image archive before generation")
     registration_instance = Registration(bucket=config.BUCKET)
     zip_filename = registration_instance.get_single_registration_images_archive(
         survey_id, registration_id
     )
-    nonce_blob.upload_from_filename(zip_filename, content_type="application/zip")
-    os.remove(zip_filename)
-    os.removedirs(os.path.dirname(zip_filename))
     logger.warning("Single image archive generated")
-    db_client = datastore.Client()
-    downloads_key = db_client.key("Downloads", nonce)
-    downloads = datastore.Entity(key=downloads_key)
-    downloads.update(
-        {
-            "created": datetime.datetime.utcnow(),
-            "blob_name": f"{nonce}.zip",
-            "headers": {
+    try:
+        return create_nonce_download(
+            "zip",
+            {
                 "Content-Type": "application/zip",
                 "Content-Disposition": f'attachment; filename="image-{survey_id}-{registration_id}.zip"',
             },
-        }
-    )
-    db_client.put(downloads)
-    logger.warning("Single image archive nonce stored")
+            file_name=zip_filename,
+            mime_type="application/json",
+        )
+    finally:
+        remove_export(zip_filename)
+        logger.warning("Single image archive nonce stored")
+
+
+@admission_controlled
+@memory_profiled("image_volumes")
+def get_images_archive_volumes(survey_id, max_size=None, max_registrations=None, volumes=None):
+    """
+    Archive the images of all registrations of a survey in volumes, each
+    downloaded with its own nonce
+    :param survey_id: A form or survey ID
+    :param max_size: Maximum size of the images in a volume, in MB
+    :param max_registrations: Maximum number of registrations in a volume
+    :param volumes: Numbers of the volumes to build, all by default
+    :return:
+    """
+    registration_instance = Registration(bucket=config.BUCKET)
     return Response(
-        json.dumps(
-            {"nonce": downloads.key.id_or_name, "mime_type": "application/json"}
+        registration_instance.get_registrations_images_volumes(
+            survey_id,
+            max_size=(max_size or IMAGE_ARCHIVE_VOLUME_SIZE) * 1024 * 1024,
+            max_registrations=max_registrations or IMAGE_ARCHIVE_VOLUME_REGISTRATIONS,
+            volumes=volumes,
         ),
-        headers={"Content-Type": "application/json"},
+        headers={
+            "Content-Type": "application/json",
+        },
     )
 
 
+def get_admission_status():
+    """
+    The in-flight requests and queue depth of the export operations with a
+    concurrency limit, in this instance
+    :return:
+    """
+    return Response(codec.dumps(admission_status()), headers={"Content-Type": "application/json"})
+
+
+def get_memory_profiles():
+    """
+    The memory profiles of the most recent exports of this instance, when
+    MEMORY_PROFILING is enabled
+    :return:
+    """
+    return Response(codec.dumps(recent_profiles()), headers={"Content-Type": "application/json"})
+
+
 def get_surveys_nonce(nonce):
     """
     Perform actual download operation of already prepared data
     :param nonce:
     :return:
     """
+    from google.cloud import datastore, storage
+
     db_client = datastore.Client()
     downloads_key = db_client.key("Downloads", nonce)
     downloads = db_client.get(downloads_key)
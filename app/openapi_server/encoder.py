@@ -2,6 +2,7 @@ from connexion.apps.flask_app import FlaskJSONEncoder
 import six
 
 from openapi_server.models.base_model_ import Model
+from settings.codec import OrjsonCodec, codec
 
 
 class JSONEncoder(FlaskJSONEncoder):
@@ -18,3 +19,17 @@ class JSONEncoder(FlaskJSONEncoder):
                 dikt[attr] = value
             return dikt
         return FlaskJSONEncoder.default(self, o)
+
+    def encode(self, o):
+        # Indented output is left to the json module. Dates and dataclasses
+        # are passed to default, so they are written like Flask writes them.
+        if isinstance(codec, OrjsonCodec) and self.indent is None:
+            orjson = codec.orjson
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            try:
+                return orjson.dumps(o, default=self.default, option=option).decode('utf-8')
+            except TypeError:
+                pass
+        return FlaskJSONEncoder.encode(self, o)
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import os
+from tempfile import gettempdir
+
+logger = logging.getLogger(__name__)
+
+SPECIFICATION_DIR = os.path.join(os.path.dirname(__file__), 'openapi')
+
+
+def _specification_digest(raw):
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _compiled_locations(name, digest):
+    """
+    Locations where a compiled specification may be found. The first one is
+    committed next to the YAML source and deployed with it, the second one
+    lives in the writable temp directory of the instance, for when the
+    committed one is outdated.
+    """
+    base_name = os.path.splitext(name)[0]
+    return [
+        os.path.join(SPECIFICATION_DIR, f"{base_name}.json"),
+        os.path.join(gettempdir(), f"{base_name}-{digest[:16]}.json"),
+    ]
+
+
+def _read_compiled(location, digest):
+    try:
+        with open(location, "r") as compiled_file:
+            compiled = json.load(compiled_file)
+    except (OSError, ValueError):
+        return None
+    if compiled.get("digest") != digest:
+        return None
+    return compiled["specification"]
+
+
+def _write_compiled(location, digest, specification):
+    try:
+        with open(f"{location}.{os.getpid()}", "w") as compiled_file:
+            json.dump({"digest": digest, "specification": specification}, compiled_file)
+        os.replace(f"{location}.{os.getpid()}", location)
+    except OSError as e:
+        logger.info(f"Could not store compiled specification {location}: {e.strerror}")
+
+
+def load_specification(name='openapi.yaml'):
+    """
+    Return the OpenAPI specification as a dict. Parsing YAML is the slowest
+    part of loading the specification, so the parsed result is stored as JSON
+    keyed by the digest of the YAML source and reused on next boots.
+    :param name: Name of the specification file in the openapi directory
+    :return:
+    """
+    with open(os.path.join(SPECIFICATION_DIR, name), "rb") as source_file:
+        raw = source_file.read()
+    digest = _specification_digest(raw)
+
+    locations = _compiled_locations(name, digest)
+    for location in locations:
+        specification = _read_compiled(location, digest)
+        if specification is not None:
+            return specification
+
+    import yaml
+
+    specification = yaml.safe_load(raw)
+    _write_compiled(locations[-1], digest, specification)
+    return specification
+
+
+def compile_specification(name='openapi.yaml'):
+    """
+    Write the compiled specification next to the YAML source. Run it and
+    commit openapi.json whenever openapi.yaml changes, so instances never
+    parse YAML on a cold start.
+    :param name: Name of the specification file in the openapi directory
+    :return:
+    """
+    import yaml
+
+    with open(os.path.join(SPECIFICATION_DIR, name), "rb") as source_file:
+        raw = source_file.read()
+    digest = _specification_digest(raw)
+    location = _compiled_locations(name, digest)[0]
+    _write_compiled(location, digest, yaml.safe_load(raw))
+    return location
+
+
+if __name__ == '__main__':
+    print(compile_specification())
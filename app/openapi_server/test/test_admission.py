@@ -0,0 +1,136 @@
+# coding: utf-8
+
+import threading
+import unittest
+from unittest import mock
+
+from flask import Flask
+from openapi_server import admission
+from openapi_server.admission import AdmissionGate, Rejected, ThreadBudget, admission_controlled
+from werkzeug.exceptions import HTTPException
+
+
+def wait_for(condition, timeout=5):
+    event = threading.Event()
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        event.wait(0.01)
+    raise AssertionError("Timed out")
+
+
+class TestAdmissionGate(unittest.TestCase):
+    """AdmissionGate unit tests"""
+
+    def test_queue_admits_next_request(self):
+        """A second request waits in the queue of the default budget and is admitted"""
+        gate = AdmissionGate("export", 1, queue_size=1, timeout=5)
+        gate.acquire()
+        admitted = threading.Event()
+
+        def second():
+            gate.acquire()
+            admitted.set()
+
+        thread = threading.Thread(target=second)
+        thread.start()
+        wait_for(lambda: gate.queued == 1)
+        self.assertFalse(admitted.is_set())
+
+        gate.release()
+        thread.join(5)
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(gate.status()["in_flight"], 1)
+        gate.release()
+        self.assertEqual(gate.budget.held, 0)
+
+    def test_queue_full(self):
+        """A request is rejected with 429 when the queue is full"""
+        gate = AdmissionGate("export", 1, queue_size=0, timeout=5, budget=ThreadBudget(4))
+        gate.acquire()
+        with self.assertRaises(Rejected) as rejected:
+            gate.acquire()
+        self.assertEqual(rejected.exception.status, 429)
+        gate.release()
+        self.assertEqual(gate.budget.held, 0)
+
+    def test_queue_timeout(self):
+        """A request that waits too long is rejected with 503"""
+        gate = AdmissionGate("export", 1, queue_size=1, timeout=0.05, budget=ThreadBudget(4))
+        gate.acquire()
+        with self.assertRaises(Rejected) as rejected:
+            gate.acquire()
+        self.assertEqual(rejected.exception.status, 503)
+        self.assertEqual(gate.queued, 0)
+        gate.release()
+        self.assertEqual(gate.budget.held, 0)
+
+    def test_budget_used_up(self):
+        """A request is rejected with 503 right away when the shared budget is used up"""
+        budget = ThreadBudget(1)
+        csv = AdmissionGate("csv", 1, queue_size=1, timeout=5, budget=budget)
+        zip_ = AdmissionGate("zip", 1, queue_size=1, timeout=5, budget=budget)
+        csv.acquire()
+        with self.assertRaises(Rejected) as rejected:
+            zip_.acquire()
+        self.assertEqual(rejected.exception.status, 503)
+        self.assertEqual(zip_.status()["in_flight"], 0)
+        csv.release()
+        zip_.acquire()
+        zip_.release()
+
+    def test_arrival_order(self):
+        """Queued requests are admitted in the order they arrived"""
+        gate = AdmissionGate("export", 1, queue_size=3, timeout=5, budget=ThreadBudget(4))
+        gate.acquire()
+        admitted = []
+
+        def queued(number):
+            gate.acquire()
+            admitted.append(number)
+            gate.release()
+
+        threads = []
+        for number in range(3):
+            thread = threading.Thread(target=queued, args=(number,))
+            thread.start()
+            threads.append(thread)
+            wait_for(lambda: gate.queued == number + 1)
+        gate.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(admitted, [0, 1, 2])
+        self.assertEqual(gate.budget.held, 0)
+
+
+class TestAdmissionControlled(unittest.TestCase):
+    """admission_controlled unit tests"""
+
+    def test_rejected_response(self):
+        """A rejected request is answered with its status and Retry-After"""
+        gate = AdmissionGate("get_registrations_as_zip", 1, queue_size=0, timeout=5, budget=ThreadBudget(4))
+        with mock.patch.dict(admission.gates, {"get_registrations_as_zip": gate}):
+            @admission_controlled
+            def get_registrations_as_zip():
+                return "zip"
+
+            self.assertEqual(get_registrations_as_zip(), "zip")
+            gate.acquire()
+            with Flask(__name__).test_request_context():
+                with self.assertRaises(HTTPException) as rejected:
+                    get_registrations_as_zip()
+            gate.release()
+        response = rejected.exception.response
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], str(admission.ADMISSION_RETRY_AFTER))
+        self.assertEqual(response.headers["X-In-Flight"], "1")
+
+    def test_not_limited(self):
+        def get_forms_list():
+            return "forms"
+
+        self.assertIs(admission_controlled(get_forms_list), get_forms_list)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+# coding: utf-8
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from settings import archive
+from settings.archive import ArchiveWriter, plan_volumes
+from settings.attachments import AttachmentEntry
+
+
+def entries(*sizes):
+    return [AttachmentEntry("photo{}.jpg".format(index), "image/jpeg", size, None, 1)
+            for index, size in enumerate(sizes)]
+
+
+class TestPlanVolumes(unittest.TestCase):
+    """plan_volumes unit tests"""
+
+    def test_unbounded(self):
+        """Without bounds all registrations are in one volume, in numeric order"""
+        registrations = {"10": entries(1), "9": entries(1), "100": entries(1), "11": entries(1)}
+        self.assertEqual(plan_volumes(registrations), [["9", "10", "11", "100"]])
+
+    def test_max_size(self):
+        registrations = {"1": entries(40, 20), "2": entries(30), "3": entries(50), "4": entries(10)}
+        self.assertEqual(plan_volumes(registrations, max_size=100), [["1", "2"], ["3", "4"]])
+
+    def test_max_registrations(self):
+        registrations = {str(registration_id): entries(1) for registration_id in range(1, 6)}
+        self.assertEqual(plan_volumes(registrations, max_registrations=2), [["1", "2"], ["3", "4"], ["5"]])
+
+    def test_oversized_registration(self):
+        """A registration larger than max_size gets a volume of its own"""
+        registrations = {"1": entries(10), "2": entries(80, 80), "3": entries(10)}
+        self.assertEqual(plan_volumes(registrations, max_size=100), [["1"], ["2"], ["3"]])
+
+    def test_empty(self):
+        self.assertEqual(plan_volumes({}, max_size=100, max_registrations=2), [])
+
+
+class TestArchiveWriter(unittest.TestCase):
+    """ArchiveWriter unit tests"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = {
+            "registration.csv": b"siteID;remarks\n" + b"1234;looks fine\n" * 20000,
+            "small.json": b'{"siteID": "1234"}',
+            "photo.jpg": os.urandom(64 * 1024),
+            "empty.txt": b"",
+            "large.json": b'{"inspection": "ok"},' * 100000,
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.directory, name), "wb") as file:
+                file.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, names, workers):
+        output = io.BytesIO()
+        with mock.patch.object(archive, "ARCHIVE_PARALLEL_MIN_SIZE", 1024):
+            with ArchiveWriter(output, workers=workers) as writer:
+                for name in names:
+                    writer.write(os.path.join(self.directory, name), "1234/" + name)
+        return output.getvalue()
+
+    def test_valid_archive(self):
+        """Every entry is readable with its contents, stored or deflated"""
+        for workers in (1, 4):
+            data = self.write(self.files, workers)
+            with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                self.assertEqual(zip_file.namelist(), ["1234/" + name for name in self.files])
+                for name, contents in self.files.items():
+                    self.assertEqual(zip_file.read("1234/" + name), contents)
+                self.assertEqual(zip_file.getinfo("1234/photo.jpg").compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(zip_file.getinfo("1234/empty.txt").compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(zip_file.getinfo("1234/registration.csv").compress_type, zipfile.ZIP_DEFLATED)
+                self.assertEqual(zip_file.getinfo("1234/large.json").compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_parallel_like_sequential(self):
+        """Deflating on the pool gives the same archive as deflating inline"""
+        self.assertEqual(self.write(self.files, 4), self.write(self.files, 1))
+
+    def test_only_deflated_entries(self):
+        """An archive of only pre-deflated entries still gets its central directory"""
+        data = self.write(["registration.csv", "large.json"], 4)
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(len(zip_file.infolist()), 2)
+
+    def test_duplicate_name(self):
+        """Pre-deflated entries go through the same checks as ZipFile.write"""
+        with self.assertWarnsRegex(UserWarning, "Duplicate name"):
+            self.write(["registration.csv", "registration.csv"], 1)
+
+    def test_zipfile_internals(self):
+        """ZipFile still has the private members _append_deflated relies on"""
+        with zipfile.ZipFile(io.BytesIO(), "w") as zip_file:
+            for name in ("_writecheck", "_didModify", "fp", "filelist", "NameToInfo", "start_dir"):
+                self.assertTrue(hasattr(zip_file, name), name)
+
+
+if __name__ == "__main__":
+    unittest.main()
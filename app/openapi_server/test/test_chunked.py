@@ -0,0 +1,77 @@
+# coding: utf-8
+
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+from settings.chunked import Spill, flatten_record, write_normalized_csv
+
+ROWS = [
+    {"id": 1, "data": {"siteID": "1234", "inspection": {"a": 1, "b": 2.5}}, "ok": True},
+    {"id": 2, "data": {"siteID": "1235", "inspection": {}, "extra": None}, "ok": False},
+    {"id": 3, "data": {"siteID": None, "inspection": {"a": 2 ** 40}}, "remarks": "a;b\n\"c\""},
+    {"id": 4, "data": {}, "ok": None, "tags": ["x", "y"]},
+    {"id": 5, "data": {"inspection": {"b": "high"}}},
+]
+
+
+class TestFlattenRecord(unittest.TestCase):
+    """flatten_record unit tests"""
+
+    def test_like_json_normalize(self):
+        """Columns, order and values are those of json_normalize"""
+        for row in ROWS:
+            expected = pd.io.json.json_normalize(row, sep=".").to_dict(orient="records")[0]
+            flat = flatten_record(row)
+            self.assertEqual(list(flat), list(expected))
+            for column, value in flat.items():
+                if value is None:
+                    self.assertTrue(pd.isna(expected[column]))
+                else:
+                    self.assertEqual(value, expected[column])
+
+
+class TestWriteNormalizedCsv(unittest.TestCase):
+    """write_normalized_csv unit tests"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name)) as csv_file:
+            return csv_file.read()
+
+    def test_like_json_normalize(self):
+        """The CSV of rows spilled in chunks equals the CSV of json_normalize"""
+        rows = ROWS * 3
+        pd.io.json.json_normalize(rows, sep=".").to_csv(os.path.join(self.directory, "expected.csv"), sep=";")
+        for chunk_size in (1, 2, 7, 100):
+            write_normalized_csv(iter(rows), os.path.join(self.directory, "chunked.csv"), chunk_size, sep=";")
+            self.assertEqual(self.read("chunked.csv"), self.read("expected.csv"), f"chunk size {chunk_size}")
+
+    def test_without_index(self):
+        pd.io.json.json_normalize(ROWS, sep=".").to_csv(
+            os.path.join(self.directory, "expected.csv"), sep=";", index=None
+        )
+        write_normalized_csv(iter(ROWS), os.path.join(self.directory, "chunked.csv"), 2, sep=";", index=None)
+        self.assertEqual(self.read("chunked.csv"), self.read("expected.csv"))
+
+    def test_spill_directory(self):
+        """Rows are spilled to the given directory and removed afterwards"""
+        spill = Spill(2, self.directory)
+        for row in ROWS:
+            spill.append(row)
+        self.assertEqual(os.path.dirname(spill.name), self.directory)
+        self.assertEqual(list(spill), ROWS)
+        spill.remove()
+        self.assertFalse(os.path.exists(spill.name))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+# coding: utf-8
+
+import json
+import math
+import unittest
+
+from settings.codec import OrjsonCodec, StdlibCodec, create_codec
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+VALUES = [
+    {"meta": {"serialNumber": 1}, "data": {"city": "Zoë's café", "count": 2, "ratio": 0.5, "items": [True, None]}},
+    [],
+    {"nested": {"empty": {}, "list": [1, [2, [3]]]}},
+    "tekst met \"quotes\" en \\ backslash",
+]
+
+
+@unittest.skipIf(orjson is None, "orjson is not installed")
+class TestOrjsonCodec(unittest.TestCase):
+    """OrjsonCodec unit tests"""
+
+    def setUp(self):
+        self.codec = OrjsonCodec(orjson)
+
+    def test_same_output_as_stdlib(self):
+        """Both codecs write the same compact UTF-8 JSON"""
+        for value in VALUES:
+            self.assertEqual(self.codec.dumps(value), StdlibCodec.dumps(value))
+            self.assertEqual(json.loads(self.codec.dumps(value)), value)
+
+    def test_loads_bytes_and_str(self):
+        encoded = json.dumps(VALUES[0])
+        self.assertEqual(self.codec.loads(encoded), VALUES[0])
+        self.assertEqual(self.codec.loads(encoded.encode("utf-8")), VALUES[0])
+
+    def test_loads_falls_back(self):
+        """NaN is not JSON, the json module accepts it"""
+        self.assertTrue(math.isnan(self.codec.loads('{"value": NaN}')["value"]))
+
+    def test_dumps_falls_back(self):
+        """Integers beyond 64 bits are written by the json module"""
+        self.assertEqual(self.codec.dumps({"big": 2 ** 70}), '{"big":1180591620717411303424}')
+
+    def test_dumps_default(self):
+        self.assertEqual(self.codec.dumps({"set": {1}}, default=sorted), '{"set":[1]}')
+        with self.assertRaises(TypeError):
+            self.codec.dumps({"set": {1}})
+
+    def test_non_string_keys(self):
+        self.assertEqual(self.codec.dumps({1: "a"}), '{"1":"a"}')
+
+    def test_invalid_json(self):
+        with self.assertRaises(ValueError):
+            self.codec.loads("{")
+
+
+class TestCreateCodec(unittest.TestCase):
+    """create_codec unit tests"""
+
+    def test_stdlib(self):
+        self.assertEqual(create_codec("stdlib").name, "stdlib")
+
+    def test_auto(self):
+        self.assertEqual(create_codec("auto").name, "stdlib" if orjson is None else "orjson")
+
+
+if __name__ == "__main__":
+    unittest.main()
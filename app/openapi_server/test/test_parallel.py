@@ -0,0 +1,72 @@
+# coding: utf-8
+
+import filecmp
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import settings
+from settings import parallel
+from settings.parallel import EXPORT_CSV, flatten_in_parallel, remove_parts
+
+
+def registration(serial_number):
+    data = {"siteID": f"s{serial_number}", "inspection": {"a": serial_number, "b": "x" * (serial_number % 5)}}
+    if serial_number % 3:
+        data["remarks"] = serial_number / 3
+    if serial_number > 20:
+        data["extra"] = True
+    return {
+        "meta": {"serialNumber": serial_number, "registrationDate": 1609459200000 + serial_number},
+        "info": {"formId": "1"},
+        "data": data,
+    }
+
+
+class TestFlattenInParallel(unittest.TestCase):
+    """flatten_in_parallel unit tests, on a pool of two spawned workers"""
+
+    def setUp(self):
+        self.surveys = {serial_number: registration(serial_number) for serial_number in range(1, 31)}
+        self.directory = tempfile.mkdtemp()
+        patches = [
+            mock.patch.object(parallel, "EXPORT_WORKERS", 2),
+            # Partitions of three registrations
+            mock.patch.object(parallel, "export_chunk_size", lambda surveys: 6),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        executor, parallel._executor = parallel._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        shutil.rmtree(self.directory)
+
+    def test_partitions_in_order(self):
+        """Partitions are returned in the order of the registrations"""
+        parts = flatten_in_parallel(EXPORT_CSV, self.surveys, self.directory)
+        try:
+            self.assertEqual(len(parts), 10)
+            rows = [row for spilled, _ in parts for row in spilled]
+            self.assertEqual([row["siteID"] for row in rows], [f"s{serial_number}" for serial_number in self.surveys])
+        finally:
+            remove_parts(parts)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_same_csv_as_single_process(self):
+        """A CSV flattened in parallel equals one flattened in this process"""
+        single = os.path.join(self.directory, "single.csv")
+        in_parallel = os.path.join(self.directory, "parallel.csv")
+        with mock.patch.object(settings, "use_parallel", lambda surveys: False):
+            settings.write_csv_file(self.surveys, single)
+        with mock.patch.object(settings, "use_parallel", lambda surveys: True):
+            settings.write_csv_file(self.surveys, in_parallel)
+        self.assertTrue(filecmp.cmp(single, in_parallel, shallow=False))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+# coding: utf-8
+
+import unittest
+
+from settings.query import ExportQuery, Predicate, Projection, QueryError, split_filters
+from settings.registrations import CompactRegistration
+
+DATA = {
+    "siteID": "1234",
+    "tMNLLocationID": {"CITY": "Utrecht", "STREET": "Stationsplein"},
+    "locationSearch": {"name": "Utrecht Centraal", "address": {"name": "Stationsplein 1"}},
+    "photos": [{"name": "a.jpg", "size": 1}, {"size": 2}, "loose"],
+    "count": 12,
+    "approved": True,
+}
+
+
+class TestSplitFilters(unittest.TestCase):
+    """split_filters unit tests"""
+
+    def test_split_on_commas(self):
+        """Separate and repeated conditions arrive split on commas"""
+        self.assertEqual(
+            split_filters(["data.siteID=1234", "meta.registrationDate>=0"]),
+            ["data.siteID=1234", "meta.registrationDate>=0"],
+        )
+
+    def test_escaped_comma(self):
+        """A comma escaped with a backslash stays in its condition"""
+        self.assertEqual(split_filters(["data.remarks=a\\", "b", "data.siteID=1"]), ["data.remarks=a,b", "data.siteID=1"])
+
+    def test_escaped_backslash(self):
+        """An escaped backslash does not escape the comma after it"""
+        self.assertEqual(split_filters(["data.path=c:\\\\", "data.siteID=1"]), ["data.path=c:\\", "data.siteID=1"])
+
+    def test_trailing_escape(self):
+        """A filter cannot end with an escape character"""
+        with self.assertRaises(QueryError):
+            split_filters(["data.remarks=a\\"])
+
+    def test_no_filters(self):
+        self.assertEqual(split_filters(None), [])
+
+
+class TestProjection(unittest.TestCase):
+    """Projection unit tests"""
+
+    def test_dotted_path(self):
+        self.assertEqual(Projection(["tMNLLocationID.CITY"]).project(DATA), {"tMNLLocationID": {"CITY": "Utrecht"}})
+
+    def test_path_selects_everything_under_it(self):
+        self.assertEqual(Projection(["tMNLLocationID"]).project(DATA), {"tMNLLocationID": DATA["tMNLLocationID"]})
+
+    def test_wildcards(self):
+        self.assertEqual(
+            Projection(["locationSearch.*"]).project(DATA), {"locationSearch": DATA["locationSearch"]}
+        )
+        self.assertEqual(
+            Projection(["**.name"]).project(DATA),
+            {
+                "locationSearch": {"name": "Utrecht Centraal", "address": {"name": "Stationsplein 1"}},
+                "photos": [{"name": "a.jpg"}],
+            },
+        )
+
+    def test_several_fields(self):
+        self.assertEqual(Projection(["siteID", "count", "missing.path"]).project(DATA), {"siteID": "1234", "count": 12})
+
+    def test_no_fields(self):
+        with self.assertRaises(QueryError):
+            Projection(["", ""])
+
+
+class TestPredicate(unittest.TestCase):
+    """Predicate unit tests"""
+
+    def setUp(self):
+        self.registration = {"meta": {"serialNumber": 7, "registrationDate": 1609459200000}, "info": {}, "data": DATA}
+
+    def test_parse(self):
+        predicate = Predicate(" data.tMNLLocationID.CITY != Utrecht ")
+        self.assertEqual(predicate.path, ["data", "tMNLLocationID", "CITY"])
+        self.assertEqual(predicate.value, "Utrecht")
+        self.assertFalse(predicate(self.registration))
+
+    def test_numbers(self):
+        self.assertTrue(Predicate("meta.registrationDate>=1609459200000")(self.registration))
+        self.assertFalse(Predicate("meta.registrationDate>1609459200000")(self.registration))
+        # Compared as numbers, not as text
+        self.assertTrue(Predicate("data.count>9")(self.registration))
+        self.assertTrue(Predicate("data.siteID=1234.0")(self.registration))
+
+    def test_text_and_booleans(self):
+        self.assertTrue(Predicate("data.tMNLLocationID.CITY=Utrecht")(self.registration))
+        self.assertTrue(Predicate("data.tMNLLocationID.CITY<Zwolle")(self.registration))
+        self.assertTrue(Predicate("data.approved=true")(self.registration))
+        self.assertTrue(Predicate("data.remarks=a,b")({"data": {"remarks": "a,b"}}))
+
+    def test_missing_value(self):
+        self.assertFalse(Predicate("data.missing=1")(self.registration))
+        self.assertTrue(Predicate("data.missing!=1")(self.registration))
+        self.assertFalse(Predicate("data.siteID.deeper=1")(self.registration))
+
+    def test_invalid(self):
+        for expression in ("siteID", "data.siteID", "=1", "siteID=1", "data=1", "registration.siteID=1"):
+            with self.assertRaises(QueryError, msg=expression):
+                Predicate(expression)
+
+
+class TestExportQuery(unittest.TestCase):
+    """ExportQuery unit tests"""
+
+    def setUp(self):
+        self.registrations = {
+            serial_number: CompactRegistration({
+                "meta": {"serialNumber": serial_number},
+                "info": {"formId": "1"},
+                "data": {"siteID": str(serial_number), "inspection": {"ok": serial_number % 2 == 0, "note": "x"}},
+            })
+            for serial_number in range(1, 6)
+        }
+
+    def test_empty_query(self):
+        query = ExportQuery()
+        self.assertFalse(query)
+        self.assertIs(query.apply(self.registrations), self.registrations)
+
+    def test_filter_and_project(self):
+        query = ExportQuery(["inspection.ok"], ["data.inspection.ok=true", "meta.serialNumber>2"])
+        selected = query.apply(self.registrations)
+        self.assertEqual(list(selected), [4])
+        self.assertEqual(selected[4]["data"], {"inspection": {"ok": True}})
+        self.assertEqual(selected[4]["meta"]["serialNumber"], 4)
+
+    def test_project_only(self):
+        selected = ExportQuery(["siteID"]).apply(self.registrations)
+        self.assertEqual([registration["data"] for registration in selected.values()],
+                         [{"siteID": str(serial_number)} for serial_number in range(1, 6)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+# coding: utf-8
+
+import json
+import unittest
+
+from settings.registrations import (CompactRegistration, compact_registrations, compact_registrations_at,
+                                    iter_element_spans)
+
+SNAPSHOT = {
+    "survey": {"id": 1, "name": "Inspectie"},
+    "elements": [
+        {"meta": {"serialNumber": 1, "registrationDate": 1609459200000}, "info": {"formId": "1"},
+         "data": {"siteID": "1234", "remarks": "naïef, \"geciteerd\"", "inspection": {"items": [1, 2]}}},
+        {"meta": {"serialNumber": 2}, "info": {"formId": "1"}},
+        {"meta": {"serialNumber": 3}, "info": {"formId": "1"}, "data": {"siteID": None}},
+    ],
+    "count": 3,
+}
+
+
+class TestElementSpans(unittest.TestCase):
+    """iter_element_spans unit tests"""
+
+    def test_spans(self):
+        """Every element is decoded and found at its span, whatever the layout"""
+        for text in (json.dumps(SNAPSHOT), json.dumps(SNAPSHOT, indent=2, ensure_ascii=False)):
+            spans = list(iter_element_spans(text))
+            self.assertEqual([element for element, _, _ in spans], SNAPSHOT["elements"])
+            for element, start, end in spans:
+                self.assertEqual(json.loads(text[start:end]), element)
+
+    def test_empty(self):
+        self.assertEqual(list(iter_element_spans('{"elements": []}')), [])
+
+    def test_invalid(self):
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_element_spans('[{"meta": {}}]'))
+
+    def test_compact_registrations_at(self):
+        """Registrations decoded at byte spans equal those decoded in full"""
+        content = json.dumps(SNAPSHOT, ensure_ascii=False).encode("utf-8")
+        text = content.decode("utf-8")
+        spans = [
+            (len(text[:start].encode("utf-8")), len(text[:end].encode("utf-8")))
+            for _, start, end in iter_element_spans(text)
+        ]
+        at_spans = compact_registrations_at(content, spans)
+        in_full = compact_registrations(text)
+        self.assertEqual(list(at_spans), [1, 2, 3])
+        self.assertEqual(
+            {serial_number: dict(registration) for serial_number, registration in at_spans.items()},
+            {serial_number: dict(registration) for serial_number, registration in in_full.items()},
+        )
+
+
+class TestCompactRegistration(unittest.TestCase):
+    """CompactRegistration unit tests"""
+
+    def test_reads_like_the_element(self):
+        element = SNAPSHOT["elements"][0]
+        registration = CompactRegistration(element)
+        self.assertEqual(registration["meta"]["serialNumber"], 1)
+        self.assertEqual(dict(registration["info"]), element["info"])
+        self.assertEqual(registration["data"], element["data"])
+        self.assertEqual(list(registration), ["meta", "info", "data"])
+        self.assertEqual(len(registration), 3)
+        self.assertEqual({key: registration[key] for key in registration}, element)
+
+    def test_without_data(self):
+        registration = CompactRegistration(SNAPSHOT["elements"][1])
+        self.assertNotIn("data", registration)
+        self.assertEqual(len(registration), 2)
+        with self.assertRaises(KeyError):
+            registration["data"]
+
+    def test_shared_keys(self):
+        """Records with the same keys share a single tuple of keys"""
+        first = CompactRegistration(SNAPSHOT["elements"][1])
+        second = CompactRegistration(SNAPSHOT["elements"][2])
+        self.assertIs(first.info._keys, second.info._keys)
+        with self.assertRaises(KeyError):
+            first.meta["formId"]
+
+
+if __name__ == "__main__":
+    unittest.main()
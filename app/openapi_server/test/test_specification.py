@@ -0,0 +1,28 @@
+# coding: utf-8
+
+import json
+import os
+import unittest
+
+import yaml
+from openapi_server.specification import SPECIFICATION_DIR, _specification_digest
+
+
+class TestSpecification(unittest.TestCase):
+    """Compiled specification unit tests"""
+
+    def test_compiled_specification_is_current(self):
+        """openapi.json is compiled from the committed openapi.yaml"""
+        with open(os.path.join(SPECIFICATION_DIR, "openapi.yaml"), "rb") as source_file:
+            raw = source_file.read()
+        with open(os.path.join(SPECIFICATION_DIR, "openapi.json")) as compiled_file:
+            compiled = json.load(compiled_file)
+        self.assertEqual(
+            compiled["digest"], _specification_digest(raw),
+            "openapi.json is outdated, run python -m openapi_server.specification",
+        )
+        self.assertEqual(compiled["specification"], yaml.safe_load(raw))
+
+
+if __name__ == "__main__":
+    unittest.main()
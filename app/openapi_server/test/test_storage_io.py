@@ -0,0 +1,161 @@
+# coding: utf-8
+
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import google_crc32c
+from google.api_core.exceptions import NotFound
+from multidict import CIMultiDict
+from settings import storage_io
+from settings.storage_io import AsyncStorage, ChecksumMismatch, DownloadChecksum
+
+CONTENT = b"registration attachment " * 1000
+
+
+def crc32c(data):
+    return base64.b64encode(google_crc32c.Checksum(data).digest()).decode("ascii")
+
+
+def md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+class FakeStorage(HTTPServer):
+    """
+    Serves the responses queued per path, the last one is repeated
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeStorageHandler)
+        self.responses = {}
+        self.requests = []
+
+    def respond(self, path, *responses):
+        self.responses[path] = list(responses)
+
+
+class FakeStorageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append((url.path, parse_qs(url.query)))
+        responses = self.server.responses.get(url.path, [(404, {}, b"Not found")])
+        status, headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadChecksum(unittest.TestCase):
+    """DownloadChecksum unit tests"""
+
+    def check(self, headers, data):
+        checksum = DownloadChecksum(CIMultiDict(headers))
+        checksum.update(data[:10])
+        checksum.update(data[10:])
+        checksum.verify("bucket/blob")
+        return checksum.name
+
+    def test_crc32c(self):
+        headers = [("x-goog-hash", f"crc32c={crc32c(CONTENT)},md5={md5(CONTENT)}")]
+        self.assertEqual(self.check(headers, CONTENT), "crc32c")
+        with self.assertRaises(ChecksumMismatch):
+            self.check(headers, CONTENT[:-1])
+
+    def test_md5(self):
+        headers = [("x-goog-hash", f"md5={md5(CONTENT)}")]
+        self.assertEqual(self.check(headers, CONTENT), "md5")
+        with self.assertRaises(ChecksumMismatch):
+            self.check(headers, CONTENT + b"!")
+
+    def test_separate_headers(self):
+        headers = [("x-goog-hash", f"crc32c={crc32c(CONTENT)}"), ("x-goog-hash", f"md5={md5(CONTENT)}")]
+        self.assertEqual(self.check(headers, CONTENT), "crc32c")
+
+    def test_stored_compressed(self):
+        """Checksums of objects stored gzipped are of the stored bytes, not checked"""
+        headers = [("x-goog-hash", f"crc32c={crc32c(CONTENT)}"), ("x-goog-stored-content-encoding", "gzip")]
+        self.assertIsNone(self.check(headers, b"decompressed"))
+
+
+class TestAsyncStorage(unittest.TestCase):
+    """AsyncStorage unit tests against a local fake storage server"""
+
+    def setUp(self):
+        self.server = FakeStorage()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patches = [
+            mock.patch.dict(os.environ, {"STORAGE_EMULATOR_HOST": f"http://127.0.0.1:{self.server.server_port}"}),
+            mock.patch.object(storage_io, "STORAGE_IO_RETRY_DELAY", 0.01),
+            mock.patch.object(storage_io, "STORAGE_IO_RETRIES", 2),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.storage = AsyncStorage()
+        self.addCleanup(self.storage.close)
+        self.file_name = os.path.join(self.directory, "download")
+
+    def download(self, generation=None):
+        return self.storage.download_many("bucket", [("attachments/1/2/a.jpg", self.file_name, generation)])[0]
+
+    def test_download_retries_transient_errors(self):
+        good = (200, {"x-goog-hash": f"crc32c={crc32c(CONTENT)}"}, CONTENT)
+        self.server.respond("/download/storage/v1/b/bucket/o/attachments%2F1%2F2%2Fa.jpg",
+                            (503, {}, b"Unavailable"), good)
+        self.assertIsNone(self.download(generation=7))
+        with open(self.file_name, "rb") as downloaded:
+            self.assertEqual(downloaded.read(), CONTENT)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[0][1]["ifGenerationMatch"], ["7"])
+
+    def test_download_retries_corrupted_body(self):
+        headers = {"x-goog-hash": f"crc32c={crc32c(CONTENT)}"}
+        self.server.respond("/download/storage/v1/b/bucket/o/attachments%2F1%2F2%2Fa.jpg",
+                            (200, headers, CONTENT[:-1] + b"?"), (200, headers, CONTENT))
+        self.assertIsNone(self.download())
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_download_checksum_mismatch_removes_file(self):
+        headers = {"x-goog-hash": f"crc32c={crc32c(CONTENT)}"}
+        self.server.respond("/download/storage/v1/b/bucket/o/attachments%2F1%2F2%2Fa.jpg",
+                            (200, headers, CONTENT[:-1]))
+        self.assertIsInstance(self.download(), ChecksumMismatch)
+        self.assertFalse(os.path.exists(self.file_name))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_not_found_is_not_retried(self):
+        self.assertIsInstance(self.download(), NotFound)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_list_blobs_follows_pages(self):
+        self.server.respond(
+            "/storage/v1/b/bucket/o",
+            (200, {}, json.dumps({"items": [{"name": "a"}], "nextPageToken": "next"}).encode()),
+            (200, {}, json.dumps({"items": [{"name": "b"}]}).encode()),
+        )
+        items = self.storage.list_blobs("bucket", "attachments/1/", fields="items(name),nextPageToken")
+        self.assertEqual([item["name"] for item in items], ["a", "b"])
+        self.assertEqual(self.server.requests[1][1]["pageToken"], ["next"])
+
+
+if __name__ == "__main__":
+    unittest.main()
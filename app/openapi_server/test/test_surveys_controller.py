@@ -2,6 +2,7 @@
 
 from __future__ import absolute_import
 
+import json
 import unittest
 
 import adal
@@ -42,6 +43,24 @@ class TestDefaultController(BaseTestCase):
         response = self.client.open("/surveys", method="GET", headers=headers)
         self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
 
+    def test_get_forms_list_not_modified(self):
+        """Test case for get_forms_list
+
+        Revalidate the forms catalog with its ETag
+        """
+        headers = {
+            "Accept": "application/json",
+            "Authorization": "Bearer " + get_token(),
+        }
+        response = self.client.open("/surveys", method="GET", headers=headers)
+        self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
+
+        headers["If-None-Match"] = response.headers["ETag"]
+        response = self.client.open("/surveys", method="GET", headers=headers)
+        self.assertStatus(
+            response, 304, "Response body is : " + response.data.decode("utf-8")
+        )
+
     def test_get_registrations_as_csv(self):
         """Test case for get_registrations_as_csv
 
@@ -60,6 +79,41 @@ class TestDefaultController(BaseTestCase):
         )
         self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
 
+    def test_get_registrations_as_csv_selection(self):
+        """Test case for get_registrations_as_csv with fields and filter
+
+        Retrieve a csv file of some fields of some registrations
+        """
+        headers = {
+            "Accept": "text/csv",
+            "Authorization": "Bearer " + get_token(),
+        }
+        response = self.client.open(
+            "/surveys/{survey_id}/registrations/csvfiles".format(
+                survey_id=config.SURVEYS_ID
+            ),
+            method="GET",
+            headers=headers,
+            query_string=[("fields", "siteID,tMNLLocationID.*"), ("filter", "meta.registrationDate>=0")],
+        )
+        self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
+
+    def test_get_registrations_as_csv_invalid_filter(self):
+        """Test case for get_registrations_as_csv with an invalid filter"""
+        headers = {
+            "Accept": "text/csv",
+            "Authorization": "Bearer " + get_token(),
+        }
+        response = self.client.open(
+            "/surveys/{survey_id}/registrations/csvfiles".format(
+                survey_id=config.SURVEYS_ID
+            ),
+            method="GET",
+            headers=headers,
+            query_string=[("filter", "siteID")],
+        )
+        self.assert400(response, "Response body is : " + response.data.decode("utf-8"))
+
     def test_get_registrations_as_zip(self):
         """Test case for get_registrations_as_zip
 
@@ -78,6 +132,24 @@ class TestDefaultController(BaseTestCase):
         )
         self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
 
+    def test_get_bulk_registrations_as_zip(self):
+        """Test case for get_bulk_registrations_as_zip
+
+        Create a zip file of the registrations of several surveys
+        """
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + get_token(),
+        }
+        response = self.client.open(
+            "/surveys/archives",
+            method="POST",
+            headers=headers,
+            data=json.dumps({"survey_ids": [config.SURVEYS_ID]}),
+        )
+        self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
+
     def test_get_registrations_attachments(self):
         """Test case for get_registrations_attachments
 
@@ -96,6 +168,43 @@ class TestDefaultController(BaseTestCase):
         )
         self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
 
+    def test_get_registrations_attachments_urls(self):
+        """Test case for get_registrations_attachments_urls
+
+        Get signed download URLs of the fotos of a registration
+        """
+        headers = {
+            "Accept": "application/json",
+            "Authorization": "Bearer " + get_token(),
+        }
+        response = self.client.open(
+            "/surveys/{survey_id}/registrations/{registration_id}/images/urls".format(
+                survey_id=config.SURVEYS_ID, registration_id=2
+            ),
+            method="GET",
+            headers=headers,
+        )
+        self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
+
+    def test_get_registrations_attachments_previews(self):
+        """Test case for get_registrations_attachments_previews
+
+        Get signed download URLs of foto previews of a registration
+        """
+        headers = {
+            "Accept": "application/json",
+            "Authorization": "Bearer " + get_token(),
+        }
+        response = self.client.open(
+            "/surveys/{survey_id}/registrations/{registration_id}/images/previews".format(
+                survey_id=config.SURVEYS_ID, registration_id=2
+            ),
+            method="GET",
+            headers=headers,
+            query_string=[("size", 256)],
+        )
+        self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
+
     def test_get_registrations_list(self):
         """Test case for get_registrations_list
 
@@ -112,6 +221,46 @@ class TestDefaultController(BaseTestCase):
         )
         self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
 
+    def test_get_registrations_list_not_modified(self):
+        """Test case for get_registrations_list
+
+        Revalidate a list of available registrations with its ETag
+        """
+        headers = {
+            "Accept": "application/json",
+            "Authorization": "Bearer " + get_token(),
+        }
+        url = "/surveys/{survey_id}/registrations".format(survey_id=config.SURVEYS_ID)
+        response = self.client.open(url, method="GET", headers=headers)
+        self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
+        self.assertIsNotNone(response.headers.get("ETag"))
+
+        headers["If-None-Match"] = response.headers["ETag"]
+        response = self.client.open(url, method="GET", headers=headers)
+        self.assertStatus(
+            response, 304, "Response body is : " + response.data.decode("utf-8")
+        )
+
+    def test_get_registration(self):
+        """Test case for get_registration
+
+        Get a single registration
+        """
+        headers = {
+            "Accept": "application/json",
+            "Authorization": "Bearer " + get_token(),
+        }
+        response = self.client.open(
+            "/surveys/{survey_id}/registrations/{registration_id}".format(
+                survey_id=config.SURVEYS_ID, registration_id=2
+            ),
+            method="GET",
+            headers=headers,
+        )
+        self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
+        registration = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(registration["meta"]["serialNumber"], 2)
+
     def test_get_single_images_archive(self):
         """Test case for get_single_images_archive
 
@@ -130,6 +279,48 @@ class TestDefaultController(BaseTestCase):
         )
         self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
 
+    def test_get_images_archive_volumes(self):
+        """Test case for get_images_archive_volumes
+
+        Download the images of a survey as zip archives of bounded size
+        """
+        headers = {
+            "Accept": "application/json",
+            "Authorization": "Bearer " + get_token(),
+        }
+        response = self.client.open(
+            "/surveys/{survey_id}/registrations/images/archives".format(
+                survey_id=config.SURVEYS_ID
+            ),
+            method="GET",
+            headers=headers,
+            query_string=[("max_registrations", 10), ("volumes", "1")],
+        )
+        self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
+        manifest = json.loads(response.data.decode("utf-8"))
+        self.assertEqual([volume["volume"] for volume in manifest["volumes"]], [1])
+
+    def test_get_admission_status(self):
+        """Test case for get_admission_status"""
+        headers = {
+            "Accept": "application/json",
+            "Authorization": "Bearer " + get_token(),
+        }
+        response = self.client.open("/admission", method="GET", headers=headers)
+        self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
+        status = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(status["get_registrations_as_zip"]["in_flight"], 0)
+        self.assertEqual(status["all"]["queued"], 0)
+
+    def test_get_memory_profiles(self):
+        """Test case for get_memory_profiles"""
+        headers = {
+            "Accept": "application/json",
+            "Authorization": "Bearer " + get_token(),
+        }
+        response = self.client.open("/memory", method="GET", headers=headers)
+        self.assert200(response, "Response body is : " + response.data.decode("utf-8"))
+
     def test_get_surveys_nonce(self):
         """Test case for get_surveys_nonce"""
         headers = {
@@ -1,15 +1,18 @@
 import os
 import logging
 import re
-import zipfile
 import csv
+import shutil
 from collections import OrderedDict
-from tempfile import gettempdir
+from tempfile import TemporaryDirectory, gettempdir
 
-import pandas as pd
-import json
 
-from google.cloud import storage
+from settings import codec
+from settings.archive import ArchiveWriter
+from settings.chunked import export_chunk_size, write_normalized_csv, write_spilled
+from settings.memory import memory_stage
+from settings.parallel import EXPORT_CSV, EXPORT_ZIP, flatten_in_parallel, remove_parts, use_parallel
+from settings.upload import gzip_writer
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +40,8 @@ def flatten_dict(value):
     :param value:
     :return:
     """
+    import pandas as pd
+
     flat = dict()
     for key, value in value.items():
         if isinstance(value, list):
@@ -68,7 +73,22 @@ def create_csv_file(surveys):
     :param surveys:
     :return:
     """
-    list_of_registrations = []
+    import pandas as pd
+
+    with memory_stage('normalize'):
+        df = pd.io.json.json_normalize(list(csv_rows(surveys)), sep=".")
+    with memory_stage('to_csv'):
+        return df.to_csv(sep=CSV_DELIMITER)
+
+
+def csv_rows(surveys):
+    """
+    Yields the row of every registration in the csv file, before it is normalized
+    :param surveys:
+    :return:
+    """
+    import pandas as pd
+
     for k, v in surveys.items():
         data = dict()
         for key, value in v["data"].items():
@@ -82,13 +102,52 @@ def create_csv_file(surveys):
                 data[key] = flatten_dict(value)
             else:
                 data[key] = value
-        list_of_registrations.append(data)
+        yield data
 
-    df = pd.io.json.json_normalize(list_of_registrations, sep=".")
-    return df.to_csv(sep=CSV_DELIMITER)
 
-
-def create_subforms(value, reference, survey, list_of_subforms):
+def write_csv_file(surveys, file_name, compress=False):
+    """
+    Writes the csv file of create_csv_file to file_name. Surveys that do not
+    fit in the memory budget are normalized in chunks spilled to disk, large
+    numbers of registrations are flattened on several cores.
+    :param surveys:
+    :param file_name:
+    :param compress: Write it gzip compressed, to be stored with Content-Encoding: gzip
+    :return:
+    """
+    if compress:
+        with gzip_writer(file_name) as csv_file:
+            _write_csv(surveys, csv_file)
+    else:
+        _write_csv(surveys, file_name)
+    return file_name
+
+
+def _write_csv(surveys, path_or_buf):
+    import pandas as pd
+
+    if use_parallel(surveys):
+        with memory_stage('flatten', out_of_process=True):
+            parts = flatten_in_parallel(EXPORT_CSV, surveys)
+        try:
+            with memory_stage('to_csv'):
+                write_spilled([rows for rows, _ in parts], path_or_buf, sep=CSV_DELIMITER)
+        finally:
+            remove_parts(parts)
+        return
+
+    chunk_size = export_chunk_size(surveys)
+    if chunk_size is None:
+        with memory_stage('normalize'):
+            df = pd.io.json.json_normalize(list(csv_rows(surveys)), sep=".")
+        with memory_stage('to_csv'):
+            df.to_csv(path_or_buf, sep=CSV_DELIMITER)
+    else:
+        with memory_stage('normalize_chunks'):
+            write_normalized_csv(csv_rows(surveys), path_or_buf, chunk_size, sep=CSV_DELIMITER)
+
+
+def create_subforms(value, reference, survey, list_of_subforms, directory=None):
     """
     Flattens a dictionary object OR creates a subform with (nested) list values. For example:
     a_registration:  another_list_registration: {
@@ -96,12 +155,26 @@ def create_subforms(value, reference, survey, list_of_subforms):
                     }
 
     => This in a separate CSV { a_registration.another_list_registration._tt667dsfs.x.y: 'fs56df64sd3' }
+    :param directory: Directory of the intermediate CSV files, the temp dir by default
     :param list_of_subforms:
     :param survey:
     :param reference:
     :param value:
     :return:
     """
+    toadd_data = subform_row(value, survey)
+    if toadd_data:
+        write_subform_row(reference, toadd_data, list_of_subforms, directory or gettempdir())
+
+
+def subform_row(value, survey):
+    """
+    Creates the row of a sub form, with the serial number in the first column
+    :param value:
+    :param survey:
+    :return: The row, None if there is nothing to add
+    """
+    import pandas as pd
 
     toadd_data = OrderedDict()
     for key, value in value.items():
@@ -121,40 +194,128 @@ def create_subforms(value, reference, survey, list_of_subforms):
 
     if toadd_data:
         toadd_data = pd.io.json.json_normalize(toadd_data).to_dict(orient='records')[0]
-        toadd_field_names = list(toadd_data.keys())
-
         # Serial number on first column
-        toadd_field_names = ['serialNumber', *toadd_field_names]
-        toadd_data = {'serialNumber': survey, **toadd_data}
+        return {'serialNumber': survey, **toadd_data}
+    return None
 
-        should_write_header = False
 
-        if reference in list_of_subforms:
-            # Read header to check headers are the same
-            previous_reader = csv.DictReader(open(f'{gettempdir()}/{reference}.header.csv', "r"), delimiter=CSV_DELIMITER)
-            combined_field_names = [*previous_reader.fieldnames]
+def write_subform_row(reference, toadd_data, list_of_subforms, directory):
+    """
+    Adds a row to the CSV of a sub form, extending its header with new fields
+    :param reference:
+    :param toadd_data:
+    :param list_of_subforms:
+    :param directory:
+    :return:
+    """
+    toadd_field_names = list(toadd_data.keys())
+
+    should_write_header = False
+
+    if reference in list_of_subforms:
+        # Read header to check headers are the same
+        previous_reader = csv.DictReader(open(f'{directory}/{reference}.header.csv', "r"), delimiter=CSV_DELIMITER)
+        combined_field_names = [*previous_reader.fieldnames]
+
+        for toadd_field_name in toadd_field_names:
+            if toadd_field_name not in combined_field_names:
+                combined_field_names.append(toadd_field_name)
+                should_write_header = True
+        sub_forms_data_file = open(f"{directory}/{reference}.data.csv", "a")
+    else:
+        combined_field_names = toadd_field_names
+        sub_forms_data_file = open(f"{directory}/{reference}.data.csv", "w")
+        list_of_subforms.append(reference)
+        should_write_header = True
+
+    if should_write_header:
+        # (Re)write header
+        header_writer = csv.DictWriter(open(f'{directory}/{reference}.header.csv', "w"),
+                                       fieldnames=combined_field_names, delimiter=CSV_DELIMITER)
+        header_writer.writeheader()
+
+    # Add content to CSV and file to list of sub forms
+    writer = csv.DictWriter(sub_forms_data_file, fieldnames=combined_field_names, delimiter=CSV_DELIMITER)
+    writer.writerow(toadd_data)
+    sub_forms_data_file.close()
+
+
+def zip_rows(surveys, create_subform):
+    """
+    Yields the row of every registration in surveys_main.csv, before it is
+    normalized, and passes the values that make a sub form to create_subform
+    :param surveys:
+    :param create_subform: Called with the value, reference and serial number of a sub form
+    :return:
+    """
+    for k, v in surveys.items():
+        data = {'serialNumber': k}
+        for key, value in v["data"].items():
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict):
+                        create_subform(item, key, k)
+            elif isinstance(value, dict):
+                # Checks if all values have a uniform data type. These should not
+                # be made sub forms e.g 'tMNLLocationID'
+                if set(list(map(type, value.values()))).__len__() == 1:
+                    data[key] = value
+                else:
+                    create_subform(value, key, k)
+            else:
+                data[key] = value
+        yield data
 
-            for toadd_field_name in toadd_field_names:
-                if toadd_field_name not in combined_field_names:
-                    combined_field_names.append(toadd_field_name)
-                    should_write_header = True
-            sub_forms_data_file = open(f"{gettempdir()}/{reference}.data.csv", "a")
-        else:
-            combined_field_names = toadd_field_names
-            sub_forms_data_file = open(f"{gettempdir()}/{reference}.data.csv", "w")
-            list_of_subforms.append(reference)
-            should_write_header = True
 
-        if should_write_header:
-            # (Re)write header
-            header_writer = csv.DictWriter(open(f'{gettempdir()}/{reference}.header.csv', "w"),
-                                           fieldnames=combined_field_names, delimiter=CSV_DELIMITER)
-            header_writer.writeheader()
+def write_survey_files(surveys, directory):
+    """
+    Creates the CSV files of the zip file in directory: surveys_main.csv
+    with a row per registration and a CSV per sub form.
+    :param surveys:
+    :param directory:
+    :return: list of (path, name in archive) of the CSV files
+    """
+    import pandas as pd
 
-        # Add content to CSV and file to list of sub forms
-        writer = csv.DictWriter(sub_forms_data_file, fieldnames=combined_field_names, delimiter=CSV_DELIMITER)
-        writer.writerow(toadd_data)
-        sub_forms_data_file.close()
+    list_of_subforms = []
+
+    def create_subform(value, reference, survey):
+        create_subforms(value, reference, survey, list_of_subforms, directory)
+
+    main_rows = zip_rows(surveys, create_subform)
+
+    chunk_size = export_chunk_size(surveys)
+    if use_parallel(surveys):
+        with memory_stage('flatten', out_of_process=True):
+            parts = flatten_in_parallel(EXPORT_ZIP, surveys)
+        try:
+            with memory_stage('to_csv'):
+                # Sub form rows are written in order here, their headers grow with every new field
+                for _, subforms in parts:
+                    for reference, row in subforms:
+                        write_subform_row(reference, row, list_of_subforms, directory)
+                write_spilled([rows for rows, _ in parts], f"{directory}/surveys_main.csv",
+                              sep=CSV_DELIMITER, index=None)
+        finally:
+            remove_parts(parts)
+    elif chunk_size is None:
+        with memory_stage('normalize'):
+            df = pd.io.json.json_normalize(list(main_rows), sep=".")
+        with memory_stage('to_csv'):
+            df.to_csv(f"{directory}/surveys_main.csv", index=None, sep=CSV_DELIMITER)
+    else:
+        with memory_stage('normalize_chunks'):
+            write_normalized_csv(main_rows, f"{directory}/surveys_main.csv", chunk_size, sep=CSV_DELIMITER,
+                                 index=None)
+
+    survey_files = [(f"{directory}/surveys_main.csv", 'surveys_main.csv')]
+    for subform_name in list_of_subforms:
+        with open(f"{directory}/{subform_name}.csv", "w") as combined_subform_csv:
+            for part in ("header", "data"):
+                with open(f"{directory}/{subform_name}.{part}.csv", "r") as part_csv:
+                    shutil.copyfileobj(part_csv, combined_subform_csv)
+        survey_files.append((f"{directory}/{subform_name}.csv", f"{subform_name}.csv"))
+    return survey_files
 
 
 def create_zip_file(surveys, request_id):
@@ -175,64 +336,92 @@ def create_zip_file(surveys, request_id):
     :param: request_id
     :return:
     """
+    return create_bulk_zip_file([(None, surveys)], request_id)
+
+
+def create_bulk_zip_file(surveys_per_id, request_id):
+    """
+    Creates a zip file of the registrations of several surveys, with the
+    files of each survey in a folder named after the survey.
+    :param surveys_per_id: Iterable of (survey_id, surveys), a survey_id of None puts the files in the root
+    :param request_id:
+    :return:
+    """
     surveys_zip_directory = f'{gettempdir()}/{request_id}'
     try:
         os.mkdir(surveys_zip_directory)
     except OSError:
         pass
     surveys_zip_location = f"{surveys_zip_directory}/surveys.zip"
-    surveys_zip = zipfile.ZipFile(surveys_zip_location, "w")
-    list_of_registrations = []
-    list_of_subforms = []
-    for k, v in surveys.items():
-        data = {'serialNumber': k}
-        for key, value in v["data"].items():
-            if isinstance(value, list):
-                for item in value:
-                    if isinstance(item, dict):
-                        create_subforms(item, key, k, list_of_subforms)
-            elif isinstance(value, dict):
-                # Checks if all values have a uniform data type. These should not
-                # be made sub forms e.g 'tMNLLocationID'
-                if set(list(map(type, value.values()))).__len__() == 1:
-                    data[key] = value
-                else:
-                    create_subforms(value, key, k, list_of_subforms)
-            else:
-                data[key] = value
-        list_of_registrations.append(data)
 
-    df = pd.io.json.json_normalize(list_of_registrations, sep=".")
-    df.to_csv(f"{gettempdir()}/surveys_main.csv", index=None, sep=CSV_DELIMITER)
-
-    surveys_zip.write(f"{gettempdir()}/surveys_main.csv", 'surveys_main.csv')
-    for subform_name in list_of_subforms:
-        combined_subform_csv = open(f"{gettempdir()}/{subform_name}.csv", "w")
-        combined_subform_csv.write(open(f"{gettempdir()}/{subform_name}.header.csv", "r").read())
-        combined_subform_csv.write(open(f"{gettempdir()}/{subform_name}.data.csv", "r").read())
-        combined_subform_csv.close()
-        surveys_zip.write(f"{gettempdir()}/{subform_name}.csv", f"{subform_name}.csv")
-    surveys_zip.close()
+    with ArchiveWriter(surveys_zip_location) as surveys_zip:
+        for survey_id, surveys in surveys_per_id:
+            with TemporaryDirectory() as directory:
+                survey_files = write_survey_files(surveys, directory)
+                with memory_stage('archive'):
+                    for path, name in survey_files:
+                        surveys_zip.write(path, f"{survey_id}/{name}" if survey_id else name, 'text/csv')
+                    surveys_zip.flush()
 
     return surveys_zip_location
 
 
-def get_batch_registrations(bucket_name, prefix=None):
+def create_registration_list(registrations):
     """
-        lists all the surveys in the bucket
-        - Using the a stringgetter() - batch them into a single dict file
+    Creates the list of meta information of all registrations, per form
+    :param registrations:
+    :return:
+    """
+    registration_list = []
+    for k, v in registrations.items():
+        data = v["data"]
+        registration_list.append(dict(
+            serial_number=k,
+            date_of_registration=int(v["meta"]["registrationDate"]),
+            site_location=data["tMNLLocationID"]["CITY"]
+            if "tMNLLocationID" in data.keys()
+            else "",
+            site_id=data["siteID"]
+            if "siteID" in data.keys()
+            else "".join(n for n in v["info"]["formName"] if n.isdigit()),
+        ))
+    registration_lists = {}
+    for registration in registrations.values():
+        registration_lists[registration["info"]["formId"]] = registration_list
+    return codec.dumps(registration_lists)
+
+
+def get_latest_snapshot(bucket_name, prefix=None):
     """
+        Return the blob of the latest snapshot of the surveys or of the
+        registrations of a survey, or None if there is none. The blob is
+        taken from a listing, so its name and generation are known without
+        downloading it.
+    """
+    from google.cloud import storage
+
     storage_client = storage.Client(
         os.environ.get("PROJECT", "Specified environment variable is not set.")
     )
 
-    bucket = storage_client.get_bucket(bucket_name)
+    if prefix == 'surveys':
+        blobs = storage_client.list_blobs(bucket_name, prefix=f'source/{prefix}/folders')
+    else:
+        blobs = storage_client.list_blobs(bucket_name, prefix=f'source/registrations/{prefix}')
 
-    try:
-        if prefix == 'surveys':
-            latest = list(bucket.list_blobs(prefix=f'source/{prefix}/folders'))[-1].download_as_string()
-        else:
-            latest = list(bucket.list_blobs(prefix=f'source/registrations/{prefix}'))[-1].download_as_string()
-        return json.loads(latest)
-    except IndexError:
+    latest = None
+    for latest in blobs:
+        pass
+    return latest
+
+
+def get_batch_registrations(bucket_name, prefix=None, snapshot=None):
+    """
+        lists all the surveys in the bucket
+        - Using the a stringgetter() - batch them into a single dict file
+    """
+    if snapshot is None:
+        snapshot = get_latest_snapshot(bucket_name, prefix)
+    if snapshot is None:
         return None
+    return codec.loads(snapshot.download_as_string())
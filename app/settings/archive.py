@@ -0,0 +1,198 @@
+import logging
+import mimetypes
+import os
+import shutil
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+import config
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COMPRESSION_LEVEL = getattr(config, 'ARCHIVE_COMPRESSION_LEVEL', 6)
+ARCHIVE_WORKERS = getattr(config, 'ARCHIVE_WORKERS', os.cpu_count() or 1)
+# Entries from this size are deflated on the pool, smaller ones inline
+ARCHIVE_PARALLEL_MIN_SIZE = getattr(config, 'ARCHIVE_PARALLEL_MIN_SIZE', 1024 * 1024)
+# Entries that do not compress below this ratio are stored as is
+ARCHIVE_MIN_SAVING_RATIO = getattr(config, 'ARCHIVE_MIN_SAVING_RATIO', 0.9)
+
+SAMPLE_SIZE = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+SPOOL_SIZE = 8 * 1024 * 1024
+
+COMPRESSED_MIME_TYPES = {
+    'application/gzip',
+    'application/pdf',
+    'application/x-7z-compressed',
+    'application/x-bzip2',
+    'application/zip',
+    'image/gif',
+    'image/heic',
+    'image/jpeg',
+    'image/png',
+    'image/webp',
+}
+
+
+def is_compressed_mime_type(mime_type):
+    if not mime_type:
+        return False
+    return mime_type in COMPRESSED_MIME_TYPES or mime_type.split('/')[0] in ('audio', 'video')
+
+
+def is_compressible(filename, mime_type=None, level=1):
+    """
+    Decide if deflating a file is worth it, first by its MIME type and
+    otherwise by compressing a sample from the start of the file
+    :param filename: Path of the file
+    :param mime_type: MIME type of the file, guessed from its name if not given
+    :param level: Compression level of the sample
+    :return:
+    """
+    if mime_type is None:
+        mime_type, _ = mimetypes.guess_type(filename)
+    if is_compressed_mime_type(mime_type):
+        return False
+
+    with open(filename, 'rb') as file:
+        sample = file.read(SAMPLE_SIZE)
+    if not sample:
+        return False
+    return len(zlib.compress(sample, level)) < len(sample) * ARCHIVE_MIN_SAVING_RATIO
+
+
+def deflate_file(filename, level):
+    """
+    Deflate a file to a (spooled) temporary file, as it is stored in a zip entry
+    :param filename: Path of the file
+    :param level: Compression level
+    :return: Temporary file positioned at the start, CRC-32 and compressed size
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    compressed = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            compressed.write(compressor.compress(chunk))
+    compressed.write(compressor.flush())
+    compress_size = compressed.tell()
+    compressed.seek(0)
+    return compressed, crc, compress_size
+
+
+def plan_volumes(registrations, max_size=None, max_registrations=None):
+    """
+    Divide registrations over archive volumes of at most max_size bytes and
+    max_registrations registrations. The attachments of a registration are
+    never split, a registration larger than max_size gets a volume of its own.
+    :param registrations: dict of registration ID to its AttachmentEntry list
+    :param max_size: Maximum size of the attachments of a volume, unbounded if None
+    :param max_registrations: Maximum number of registrations of a volume, unbounded if None
+    :return: The registration IDs of every volume
+    """
+    volumes = []
+    volume, volume_size = [], 0
+    # Numeric IDs in numeric order
+    for registration_id in sorted(registrations, key=lambda registration_id: (len(registration_id), registration_id)):
+        size = sum(entry.size for entry in registrations[registration_id])
+        too_large = max_size and volume_size + size > max_size
+        too_many = max_registrations and len(volume) >= max_registrations
+        if volume and (too_large or too_many):
+            volumes.append(volume)
+            volume, volume_size = [], 0
+        volume.append(registration_id)
+        volume_size += size
+    if volume:
+        volumes.append(volume)
+    return volumes
+
+
+class ArchiveWriter:
+    """
+    Writes a zip file, storing entries that are already compressed (e.g. photos)
+    and deflating the others. Large entries are deflated concurrently on a
+    thread pool (zlib releases the GIL) and appended in the order they were
+    written, so the archive is identical to a sequential one.
+    """
+
+    def __init__(self, file, compresslevel=ARCHIVE_COMPRESSION_LEVEL, workers=ARCHIVE_WORKERS):
+        self.compresslevel = compresslevel
+        self._zip = zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED)
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._max_pending = max(workers, 1) * 2
+        self._pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, filename, arcname, mime_type=None):
+        """
+        Add a file to the archive
+        :param filename: Path of the file
+        :param arcname: Name of the entry in the archive
+        :param mime_type: MIME type of the file, guessed from its name if not given
+        :return:
+        """
+        zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+        if zinfo.is_dir() or not is_compressible(filename, mime_type):
+            future = Future()
+            future.set_result(None)
+        elif self._executor and zinfo.file_size >= ARCHIVE_PARALLEL_MIN_SIZE:
+            future = self._executor.submit(deflate_file, filename, self.compresslevel)
+        else:
+            future = Future()
+            future.set_result(deflate_file(filename, self.compresslevel))
+
+        self._pending.append((filename, zinfo, future))
+        self._flush(wait=len(self._pending) > self._max_pending)
+
+    def _flush(self, wait=False):
+        while self._pending and (wait or self._pending[0][2].done()):
+            filename, zinfo, future = self._pending.popleft()
+            deflated = future.result()
+            if deflated is None:
+                self._zip.write(filename, zinfo.filename, compress_type=zipfile.ZIP_STORED)
+            else:
+                self._append_deflated(zinfo, *deflated)
+            wait = wait and len(self._pending) > self._max_pending
+
+    def _append_deflated(self, zinfo, compressed, crc, compress_size):
+        """
+        Append an entry of which the data has been deflated already
+        """
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.CRC = crc
+        zinfo.compress_size = compress_size
+        zinfo.header_offset = self._zip.fp.tell()
+        self._zip._writecheck(zinfo)
+        self._zip._didModify = True
+
+        with compressed:
+            self._zip.fp.write(zinfo.FileHeader())
+            shutil.copyfileobj(compressed, self._zip.fp, CHUNK_SIZE)
+
+        self._zip.filelist.append(zinfo)
+        self._zip.NameToInfo[zinfo.filename] = zinfo
+        self._zip.start_dir = self._zip.fp.tell()
+
+    def flush(self):
+        """
+        Write all pending entries, after which their source files may be removed
+        """
+        while self._pending:
+            self._flush(wait=True)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+            self._zip.close()
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import config
+from cachetools import TTLCache
+from settings.storage_io import storage_io
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_INDEX_TTL = getattr(config, 'ATTACHMENT_INDEX_TTL', 300)
+ATTACHMENT_INDEX_MAX_SURVEYS = getattr(config, 'ATTACHMENT_INDEX_MAX_SURVEYS', 256)
+# A registration missing from an index that is older than this is a reason to relist
+ATTACHMENT_INDEX_MIN_REFRESH = getattr(config, 'ATTACHMENT_INDEX_MIN_REFRESH', 15)
+
+AttachmentEntry = namedtuple('AttachmentEntry', ['name', 'content_type', 'size', 'crc32c', 'generation'])
+
+
+class SurveyAttachments:
+    """
+    All attachments of a single survey, grouped by registration
+    """
+
+    def __init__(self, registrations, created=None):
+        self.registrations = registrations
+        self.created = created if created is not None else time.monotonic()
+
+    @property
+    def age(self):
+        return time.monotonic() - self.created
+
+    def __bool__(self):
+        return bool(self.registrations)
+
+
+class AttachmentIndex:
+    """
+    A process local index of attachments per survey. A survey is listed once
+    (paginated) under attachments/{survey_id}/ and the result is kept for a
+    limited time. Entries carry the blob generation, so a reader that finds an
+    outdated entry can invalidate the survey and list it again.
+    """
+
+    def __init__(self, ttl=ATTACHMENT_INDEX_TTL, maxsize=ATTACHMENT_INDEX_MAX_SURVEYS):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._build_locks = {}
+
+    @staticmethod
+    def _build(bucket_name, survey_id):
+        items = storage_io.list_blobs(
+            bucket_name,
+            prefix=f"attachments/{survey_id}/",
+            fields="items(name,contentType,size,crc32c,generation),nextPageToken",
+        )
+        registrations = {}
+        for item in items:
+            parts = item["name"].split("/")
+            if len(parts) < 4:
+                continue
+            registrations.setdefault(parts[2], []).append(
+                AttachmentEntry(item["name"], item.get("contentType"), int(item["size"]), item.get("crc32c"),
+                                int(item["generation"]))
+            )
+        logger.info(f"Indexed {sum(map(len, registrations.values()))} attachments of survey {survey_id}")
+        return SurveyAttachments(registrations)
+
+    def cached(self, bucket_name, survey_id):
+        """
+        Return the index of a survey if present, without listing the bucket
+        """
+        with self._lock:
+            return self._cache.get((bucket_name, str(survey_id)))
+
+    def get(self, bucket_name, survey_id):
+        """
+        Return the index of a survey, listing the bucket when not cached.
+        Concurrent misses for the same survey result in a single listing.
+        """
+        key = (bucket_name, str(survey_id))
+        with self._lock:
+            survey_attachments = self._cache.get(key)
+            if survey_attachments is not None:
+                return survey_attachments
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        with build_lock:
+            survey_attachments = self.cached(*key)
+            if survey_attachments is not None:
+                return survey_attachments
+            try:
+                survey_attachments = self._build(*key)
+                with self._lock:
+                    self._cache[key] = survey_attachments
+            finally:
+                # Only held while building, later misses create a new one
+                with self._lock:
+                    self._build_locks.pop(key, None)
+        return survey_attachments
+
+    def invalidate(self, bucket_name, survey_id):
+        with self._lock:
+            self._cache.pop((bucket_name, str(survey_id)), None)
+
+    def registration(self, bucket_name, survey_id, registration_id):
+        """
+        Return the attachments of a single registration. A registration that
+        is not in an index of some age might be new, so the survey is listed
+        again once before concluding it has no attachments.
+        """
+        survey_attachments = self.get(bucket_name, survey_id)
+        entries = survey_attachments.registrations.get(str(registration_id))
+        if entries is None and survey_attachments.age > ATTACHMENT_INDEX_MIN_REFRESH:
+            self.invalidate(bucket_name, survey_id)
+            entries = self.get(bucket_name, survey_id).registrations.get(str(registration_id))
+        return entries or []
+
+    def survey(self, bucket_name, survey_id):
+        """
+        Return the attachments of all registrations of a survey
+        """
+        survey_attachments = self.get(bucket_name, survey_id)
+        return [entry for entries in survey_attachments.registrations.values() for entry in entries]
+
+
+attachment_index = AttachmentIndex()
@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from tempfile import gettempdir
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Shared by the processes of an instance. Note that the temp dir of App Engine
+# standard is kept in memory, so the cache counts towards instance memory.
+ATTACHMENT_CACHE_DIR = getattr(config, 'ATTACHMENT_CACHE_DIR', None) or f"{gettempdir()}/attachment-cache"
+# Bytes kept in the cache, 0 (the default) disables it. Opt in only with an
+# instance class that has the memory to spare, see app.yaml.
+ATTACHMENT_CACHE_SIZE = getattr(config, 'ATTACHMENT_CACHE_SIZE', 0)
+# Evicting stops when the cache has shrunk to this fraction of its size
+ATTACHMENT_CACHE_LOW_WATER = 0.9
+# Unfinished files older than this are left behind by a stopped process
+STALE_TEMPORARY_SECONDS = 3600
+
+
+def _place(source, destination):
+    """
+    Hard link source to destination, or copy it where that is not possible
+    """
+    try:
+        os.link(source, destination)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # E.g. another file system
+        shutil.copyfile(source, destination)
+
+
+class BlobCache:
+    """
+    A size-bounded local disk cache of blobs, safe to share between processes.
+    Entries are keyed by blob name and generation (the crc32c when there is no
+    generation), so they never go stale. An entry is written under a
+    temporary name and renamed into place, and files are handed out as hard
+    links, so evicting an entry does not affect a reader that got it. The
+    modification time of an entry is its last use, entries that were used
+    least recently are evicted first.
+    """
+
+    def __init__(self, directory=ATTACHMENT_CACHE_DIR, max_size=ATTACHMENT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _path(self, bucket_name, entry):
+        version = entry.generation if entry.generation is not None else f"crc32c:{entry.crc32c}"
+        key = hashlib.sha256(f"{bucket_name}/{entry.name}#{version}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, bucket_name, entry, file_name):
+        """
+        Put the cached blob of an attachment at file_name
+        :param entry: AttachmentEntry of the blob
+        :return: Whether it was cached
+        """
+        if not self.enabled:
+            return False
+        path = self._path(bucket_name, entry)
+        try:
+            os.utime(path)
+            _place(path, file_name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, bucket_name, entry, file_name):
+        """
+        Add a downloaded blob to the cache, file_name itself is kept
+        :param entry: AttachmentEntry of the blob
+        """
+        if not self.enabled or (entry.generation is None and entry.crc32c is None):
+            return
+        path = self._path(bucket_name, entry)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _place(file_name, temporary)
+            os.replace(temporary, path)
+        except OSError as e:
+            logger.warning(f"Could not cache {entry.name}: {e}")
+
+    def trim(self):
+        """
+        Evict the least recently used entries while the cache is larger than
+        its size. A single process evicts at a time, others skip it.
+        """
+        import fcntl
+
+        if not self.enabled or not os.path.isdir(self.directory):
+            return
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = []
+            now = time.time()
+            for shard in os.scandir(self.directory):
+                if not shard.is_dir():
+                    continue
+                for item in os.scandir(shard.path):
+                    try:
+                        stat = item.stat()
+                    except FileNotFoundError:
+                        continue
+                    if item.name.endswith('.tmp'):
+                        if now - stat.st_mtime > STALE_TEMPORARY_SECONDS:
+                            self._remove(item.path)
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, item.path))
+
+            size = sum(entry_size for _, entry_size, _ in entries)
+            if size <= self.max_size:
+                return
+            evicted = 0
+            for _, entry_size, path in sorted(entries):
+                if size <= self.max_size * ATTACHMENT_CACHE_LOW_WATER:
+                    break
+                self._remove(path)
+                size -= entry_size
+                evicted += 1
+            logger.info(f"Evicted {evicted} attachments from the cache, {size} bytes remain")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+attachment_cache = BlobCache()
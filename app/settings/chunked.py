@@ -0,0 +1,285 @@
+import json
+import logging
+import pickle
+from itertools import islice
+from numbers import Integral
+import os
+from tempfile import NamedTemporaryFile
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Memory the intermediate rows of an export may take, larger exports are
+# normalized in chunks of which the rows are spilled to disk
+EXPORT_MEMORY_BUDGET = getattr(config, 'EXPORT_MEMORY_BUDGET', 256 * 1024 * 1024)
+# Memory of a flattened row and its share of the DataFrame relative to its JSON size
+EXPORT_MEMORY_FACTOR = getattr(config, 'EXPORT_MEMORY_FACTOR', 10)
+# Directory of the spilled rows, the temp dir by default. On App Engine
+# standard the temp dir is held in instance memory, so spilling only keeps
+# memory within the budget with a directory on disk.
+EXPORT_SPILL_DIR = getattr(config, 'EXPORT_SPILL_DIR', None)
+
+ESTIMATE_SAMPLE_SIZE = 100
+
+
+def _data_size(registration):
+    # Compact registrations hold their data as JSON already
+    data_json = getattr(registration, 'data_json', None)
+    if data_json is not None:
+        return len(data_json)
+    return len(json.dumps(registration["data"], default=str))
+
+
+def export_chunk_size(surveys):
+    """
+    Return the number of registrations to normalize at once to stay within
+    EXPORT_MEMORY_BUDGET, or None when all of them fit in the budget
+    :param surveys: The registrations by serial number
+    :return:
+    """
+    sample = list(islice(surveys.values(), ESTIMATE_SAMPLE_SIZE))
+    if not sample:
+        return None
+    row_size = EXPORT_MEMORY_FACTOR * sum(map(_data_size, sample)) / len(sample)
+    if row_size * len(surveys) <= EXPORT_MEMORY_BUDGET:
+        return None
+    return max(1, int(EXPORT_MEMORY_BUDGET // row_size))
+
+
+def flatten_record(record, sep='.', prefix=None):
+    """
+    Flatten nested dicts of a record into keys joined by sep, exactly like
+    json_normalize does: top level values that are not a dict keep their
+    position, flattened dicts follow in order and empty dicts are left out.
+    """
+    flat = {}
+    nested = []
+    for key, value in record.items():
+        key = str(key) if prefix is None else f"{prefix}{sep}{key}"
+        if isinstance(value, dict):
+            if prefix is None:
+                nested.append((key, value))
+            else:
+                flat.update(flatten_record(value, sep, key))
+        else:
+            flat[key] = value
+    for key, value in nested:
+        flat.update(flatten_record(value, sep, key))
+    return flat
+
+
+def _type_key(value):
+    if isinstance(value, float) and value != value:
+        return float, 'nan'
+    return type(value)
+
+
+class ColumnProfile:
+    """
+    The types of values seen in a column. Pandas infers the dtype of a
+    column from the kinds of values in it (and the range of integers), so a
+    representative per kind infers the same dtype as the whole column.
+    """
+
+    def __init__(self):
+        self.representatives = {}
+        self.missing = False
+
+    def add(self, value):
+        key = _type_key(value)
+        if isinstance(value, Integral) and not isinstance(value, bool):
+            low, high = self.representatives.get(key, (value, value))
+            self.representatives[key] = (min(low, value), max(high, value))
+        elif key not in self.representatives:
+            self.representatives[key] = (value,)
+
+    def update(self, other):
+        """
+        Add the values seen by another profile of the same column, as if its
+        rows followed the rows of this one
+        """
+        for key, values in other.representatives.items():
+            if key not in self.representatives:
+                self.representatives[key] = values
+            elif len(values) == 2:
+                low, high = self.representatives[key]
+                self.representatives[key] = (min(low, values[0]), max(high, values[1]))
+        self.missing = self.missing or other.missing
+
+    def dtype(self, column):
+        import pandas as pd
+
+        rows = [{column: value} for values in self.representatives.values() for value in values]
+        if self.missing:
+            rows.append({})
+        return pd.DataFrame(rows, columns=[column])[column].dtype
+
+
+class Spill:
+    """
+    Items pickled to a temporary file in chunks, to be read back in order.
+    A closed spill can be passed to another process, which is how the
+    partitions of a parallel export are returned.
+    """
+
+    def __init__(self, chunk_size, directory=EXPORT_SPILL_DIR):
+        self.chunk_size = chunk_size
+        self.count = 0
+        self._chunk = []
+        file = NamedTemporaryFile(dir=directory, suffix='.spill', delete=False)
+        self.name = file.name
+        self._file = file
+
+    def __getstate__(self):
+        if self._file is not None:
+            raise ValueError(f"Spill {self.name} is still open")
+        return self.__dict__
+
+    def append(self, item):
+        self._chunk.append(item)
+        self.count += 1
+        if len(self._chunk) >= self.chunk_size:
+            pickle.dump(self._chunk, self._file, pickle.HIGHEST_PROTOCOL)
+            self._chunk = []
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._chunk:
+            pickle.dump(self._chunk, self._file, pickle.HIGHEST_PROTOCOL)
+            self._chunk = []
+        self._file.close()
+        self._file = None
+
+    def chunks(self):
+        """
+        Yields the lists of items in the order they were appended
+        """
+        self.close()
+        read = 0
+        with open(self.name, 'rb') as file:
+            while read < self.count:
+                chunk = pickle.load(file)
+                read += len(chunk)
+                yield chunk
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.name)
+        except FileNotFoundError:
+            pass
+
+
+class SpilledRows(Spill):
+    """
+    Flattened rows spilled to disk, with a profile of every column in the
+    order the columns first appeared
+    """
+
+    def __init__(self, chunk_size, directory=EXPORT_SPILL_DIR):
+        super().__init__(chunk_size, directory)
+        self.columns = {}
+
+    def append(self, row):
+        flat = flatten_record(row)
+        for column, value in flat.items():
+            profile = self.columns.get(column)
+            if profile is None:
+                profile = self.columns[column] = ColumnProfile()
+                profile.missing = self.count > 0
+            profile.add(value)
+        if len(flat) < len(self.columns):
+            for column, profile in self.columns.items():
+                if column not in flat:
+                    profile.missing = True
+        super().append(flat)
+
+
+def merge_columns(parts):
+    """
+    Combine the column profiles of consecutive parts of the rows, a column
+    that did not appear in a part with rows is missing in those rows
+    :param parts: SpilledRows in the order of their rows
+    :return:
+    """
+    columns = {}
+    rows_before = 0
+    for part in parts:
+        for column, profile in part.columns.items():
+            merged = columns.get(column)
+            if merged is None:
+                merged = columns[column] = ColumnProfile()
+                merged.missing = rows_before > 0
+            merged.update(profile)
+        if part.count and len(part.columns) < len(columns):
+            for column, merged in columns.items():
+                if column not in part.columns:
+                    merged.missing = True
+        rows_before += part.count
+    return columns
+
+
+def write_spilled(parts, path_or_buf, sep, index=True):
+    """
+    Write the rows of consecutive parts to a single CSV, as if all of them
+    were normalized at once
+    :param parts: SpilledRows in the order of their rows
+    :param path_or_buf: File path or object to write to
+    :param sep: CSV delimiter
+    :param index: Write the row number as first column
+    :return:
+    """
+    import numpy as np
+    import pandas as pd
+
+    columns = merge_columns(parts)
+    dtypes = {column: profile.dtype(column) for column, profile in columns.items()}
+    row_count = sum(part.count for part in parts)
+    logger.info(f"Writing {row_count} rows with {len(columns)} columns from {len(parts)} part(s)")
+
+    if row_count == 0:
+        pd.DataFrame().to_csv(path_or_buf, sep=sep, index=index)
+    offset = 0
+    for part in parts:
+        for chunk in part.chunks():
+            chunk_index = pd.RangeIndex(offset, offset + len(chunk))
+            df = pd.DataFrame(
+                {
+                    column: pd.Series([row.get(column, np.nan) for row in chunk], dtype=dtype, index=chunk_index)
+                    for column, dtype in dtypes.items()
+                },
+                columns=list(dtypes),
+                index=chunk_index,
+            )
+            df.to_csv(path_or_buf, sep=sep, index=index, header=offset == 0, mode='w' if offset == 0 else 'a')
+            offset += len(chunk)
+
+
+def write_normalized_csv(rows, path_or_buf, chunk_size, sep, index=True, directory=EXPORT_SPILL_DIR):
+    """
+    Write rows to CSV like json_normalize(rows, sep='.').to_csv(...) does,
+    while holding only chunk_size rows in memory at a time. Rows are flattened
+    and spilled to disk first, so the columns and dtypes of all rows are known
+    before the first one is written.
+    :param rows: Iterable of (nested) dicts
+    :param path_or_buf: File path or object to write to
+    :param chunk_size: Number of rows in memory at a time
+    :param sep: CSV delimiter
+    :param index: Write the row number as first column
+    :param directory: Directory of the spilled rows
+    :return:
+    """
+    spilled = SpilledRows(chunk_size, directory)
+    try:
+        for row in rows:
+            spilled.append(row)
+        spilled.close()
+        write_spilled([spilled], path_or_buf, sep, index)
+    finally:
+        spilled.remove()
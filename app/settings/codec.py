@@ -0,0 +1,89 @@
+import json
+import logging
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# 'auto' uses orjson when it is installed, 'stdlib' always uses the json module
+JSON_CODEC = getattr(config, 'JSON_CODEC', 'auto')
+
+
+class StdlibCodec:
+    """
+    The json module, writing the same compact UTF-8 JSON as orjson does
+    """
+
+    name = 'stdlib'
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj, default=None):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=default)
+
+
+class OrjsonCodec:
+    """
+    orjson, several times faster than the json module. Its output is always
+    compact and UTF-8 instead of ASCII escaped, and NaN is written as null.
+    What it cannot handle (e.g. NaN in input, integers beyond 64 bits in
+    output) falls back to the json module.
+    """
+
+    name = 'orjson'
+
+    def __init__(self, orjson):
+        self.orjson = orjson
+
+    def loads(self, data):
+        try:
+            return self.orjson.loads(data)
+        except self.orjson.JSONDecodeError:
+            return StdlibCodec.loads(data)
+
+    def dumps(self, obj, default=None):
+        try:
+            return self.orjson.dumps(obj, default=default, option=self.orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            return StdlibCodec.dumps(obj, default)
+
+
+def create_codec(name=JSON_CODEC):
+    """
+    Create the JSON codec by name, 'auto' picks the fastest one available
+    :param name: 'auto', 'orjson' or 'stdlib'
+    :return:
+    """
+    if name == 'stdlib':
+        return StdlibCodec()
+    try:
+        import orjson
+    except ImportError:
+        if name == 'orjson':
+            raise
+        return StdlibCodec()
+    return OrjsonCodec(orjson)
+
+
+codec = create_codec()
+logger.debug(f"Using the {codec.name} JSON codec")
+
+
+def loads(data):
+    """
+    Decode JSON from str or bytes
+    """
+    return codec.loads(data)
+
+
+def dumps(obj, default=None):
+    """
+    Encode an object as JSON, like json.dumps(obj, default=default) but
+    without whitespace after separators and with non-ASCII characters as is,
+    whichever codec is used
+    :return: str
+    """
+    return codec.dumps(obj, default)
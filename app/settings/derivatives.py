@@ -0,0 +1,117 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import config
+from settings.attachments import attachment_index
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVES_PREFIX = getattr(config, 'DERIVATIVES_PREFIX', 'derivatives')
+PREVIEW_SIZES = getattr(config, 'PREVIEW_SIZES', [256, 1024])
+PREVIEW_QUALITY = getattr(config, 'PREVIEW_QUALITY', 80)
+PREVIEW_CONCURRENCY = getattr(config, 'PREVIEW_CONCURRENCY', 4)
+
+# Shared by all requests, so the number of previews generated at the same
+# time on an instance is bounded, not only per request
+preview_executor = ThreadPoolExecutor(max_workers=PREVIEW_CONCURRENCY, thread_name_prefix='preview')
+
+
+class SourceReplaced(Exception):
+    """
+    The attachment is no longer at the generation of its AttachmentEntry
+    """
+
+
+def is_image(content_type):
+    return bool(content_type) and content_type.startswith('image/')
+
+
+def preview_name(entry, size):
+    """
+    Name of the preview of an attachment. The generation of the source is part
+    of the name, so a replaced attachment never serves an outdated preview.
+    :param entry: AttachmentEntry of the source
+    :param size: Maximum width and height of the preview
+    :return:
+    """
+    return f"{DERIVATIVES_PREFIX}/{size}/{entry.name}/{entry.generation}.jpg"
+
+
+def create_preview(source, size):
+    """
+    Resize and re-encode an image to a JPEG preview that fits in size x size
+    :param source: Bytes of the source image
+    :param size: Maximum width and height of the preview
+    :return:
+    """
+    from PIL import Image, ImageOps
+
+    image = Image.open(BytesIO(source))
+    # Let the JPEG decoder downscale while decoding, much cheaper than a full decode
+    image.draft('RGB', (size, size))
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('RGB')
+    image.thumbnail((size, size), Image.LANCZOS)
+
+    preview = BytesIO()
+    image.save(preview, 'JPEG', quality=PREVIEW_QUALITY, optimize=True, progressive=True)
+    return preview.getvalue()
+
+
+def _generate_preview(bucket, entry, size):
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+
+    try:
+        source = bucket.blob(entry.name).download_as_bytes(if_generation_match=entry.generation)
+    except (NotFound, PreconditionFailed) as e:
+        raise SourceReplaced(entry.name) from e
+    try:
+        bucket.blob(preview_name(entry, size)).upload_from_string(
+            create_preview(source, size),
+            content_type='image/jpeg',
+            if_generation_match=0,
+        )
+    except PreconditionFailed:
+        # Created by a concurrent request in the meantime
+        pass
+
+
+def ensure_previews(bucket, entries, size):
+    """
+    Make sure a preview exists for every image in entries, generating the
+    missing ones concurrently. Existing previews are found with a single
+    listing of the derivatives of the registration.
+    :param bucket: Bucket holding attachments and derivatives
+    :param entries: AttachmentEntry objects of a single registration
+    :param size: Maximum width and height of the previews
+    :return: dict of attachment name to preview name, without attachments
+        that were replaced or removed since they were indexed
+    """
+    previews = {entry.name: preview_name(entry, size) for entry in entries if is_image(entry.content_type)}
+    if not previews:
+        return previews
+
+    # attachments/{survey_id}/{registration_id}/, the same for all entries however deep they are
+    registration_directory = '/'.join(entries[0].name.split('/')[:3])
+    prefix = f"{DERIVATIVES_PREFIX}/{size}/{registration_directory}/"
+    existing = {blob.name for blob in bucket.client.list_blobs(bucket, prefix=prefix, fields='items(name),nextPageToken')}
+
+    missing = [entry for entry in entries if entry.name in previews and previews[entry.name] not in existing]
+    futures = [preview_executor.submit(_generate_preview, bucket, entry, size) for entry in missing]
+    created = 0
+    for entry, future in zip(missing, futures):
+        try:
+            future.result()
+            created += 1
+        except SourceReplaced:
+            # The index is outdated, the next request lists the survey again
+            logger.info(f"{entry.name} changed since it was indexed, skipping its preview")
+            attachment_index.invalidate(bucket.name, entry.name.split('/')[1])
+            previews.pop(entry.name)
+        except Exception as e:
+            logger.error(f"Could not create preview of {entry.name}: {e}")
+            previews.pop(entry.name)
+    if missing:
+        logger.info(f"Created {created} of {len(missing)} missing previews of {size}px under {prefix}")
+    return previews
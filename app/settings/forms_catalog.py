@@ -0,0 +1,111 @@
+import hashlib
+import logging
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Seconds a catalog is served as is, an older catalog is served while it is refreshed
+FORMS_CATALOG_TTL = getattr(config, 'FORMS_CATALOG_TTL', 60)
+# Seconds after which a catalog is too old to serve, requests wait for a refresh
+FORMS_CATALOG_MAX_STALE = getattr(config, 'FORMS_CATALOG_MAX_STALE', 3600)
+
+
+class CatalogEntry:
+    """
+    A built forms catalog, the body of a /surveys response
+    """
+
+    def __init__(self, body, created=None):
+        self.body = body
+        self.etag = hashlib.sha1(body.encode('utf-8') if isinstance(body, str) else body).hexdigest()
+        self.created = created if created is not None else time.monotonic()
+
+    @property
+    def age(self):
+        return time.monotonic() - self.created
+
+
+class FormsCatalog:
+    """
+    A process local, stale-while-revalidate cache of the forms catalog per
+    bucket. A catalog younger than ttl is served as is. An older one is
+    served as well, while a single background thread builds its successor.
+    Only without a catalog, or with one older than max_stale, requests wait
+    for a build, and concurrent requests wait for the same build.
+    """
+
+    def __init__(self, ttl=FORMS_CATALOG_TTL, max_stale=FORMS_CATALOG_MAX_STALE):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._refresh_locks = {}
+
+    def _refresh_lock(self, bucket_name):
+        with self._lock:
+            return self._refresh_locks.setdefault(bucket_name, threading.Lock())
+
+    def cached(self, bucket_name):
+        """
+        Return the catalog of a bucket if present, however old it is
+        """
+        with self._lock:
+            return self._entries.get(bucket_name)
+
+    def _refresh(self, bucket_name, build):
+        body = build()
+        entry = CatalogEntry(body) if body is not None else None
+        with self._lock:
+            if entry is None:
+                self._entries.pop(bucket_name, None)
+            else:
+                self._entries[bucket_name] = entry
+        return entry
+
+    def _refresh_in_background(self, bucket_name, build):
+        refresh_lock = self._refresh_lock(bucket_name)
+        if not refresh_lock.acquire(blocking=False):
+            # Being refreshed already
+            return
+
+        def refresh():
+            began = time.monotonic()
+            try:
+                self._refresh(bucket_name, build)
+                logger.info(f"Refreshed the forms catalog of {bucket_name} in {time.monotonic() - began:.2f}s")
+            except Exception:
+                logger.exception(f"Refreshing the forms catalog of {bucket_name} failed, the stale one is kept")
+            finally:
+                refresh_lock.release()
+
+        threading.Thread(target=refresh, name='forms-catalog', daemon=True).start()
+
+    def get(self, bucket_name, build):
+        """
+        Return the catalog of a bucket
+        :param bucket_name: The bucket of the surveys
+        :param build: Function returning the body of the catalog, None when there are no forms
+        :return: CatalogEntry, None when there are no forms
+        """
+        entry = self.cached(bucket_name)
+        if entry is not None and entry.age < self.max_stale:
+            if entry.age >= self.ttl:
+                self._refresh_in_background(bucket_name, build)
+            return entry
+
+        with self._refresh_lock(bucket_name):
+            # Built by the request or refresh that held the lock
+            entry = self.cached(bucket_name)
+            if entry is None or entry.age >= self.max_stale:
+                entry = self._refresh(bucket_name, build)
+        return entry
+
+    def invalidate(self, bucket_name):
+        with self._lock:
+            self._entries.pop(bucket_name, None)
+
+
+forms_catalog = FormsCatalog()
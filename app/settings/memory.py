@@ -0,0 +1,284 @@
+import contextlib
+import functools
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+import config
+from settings import codec
+
+logger = logging.getLogger(__name__)
+
+# Opt-in, tracing allocations slows down exports considerably
+MEMORY_PROFILING = getattr(config, 'MEMORY_PROFILING', False)
+# Number of allocation sites reported per stage
+MEMORY_PROFILING_TOP = getattr(config, 'MEMORY_PROFILING_TOP', 5)
+# Frames stored per traced allocation, more frames point at callers as well
+MEMORY_PROFILING_FRAMES = getattr(config, 'MEMORY_PROFILING_FRAMES', 1)
+MEMORY_PROFILING_HISTORY = getattr(config, 'MEMORY_PROFILING_HISTORY', 50)
+
+profiles = deque(maxlen=MEMORY_PROFILING_HISTORY)
+_current = threading.local()
+_ignored_traces = [tracemalloc.Filter(False, tracemalloc.__file__)]
+# Profiles running in this process, tracing stops when the last one ends
+_active_profiles = 0
+_started_tracing = False
+_tracing_lock = threading.Lock()
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _site(frame):
+    """
+    The source location of a frame, relative to the app or to the import
+    path it was loaded from, so profiles do not reveal the layout of the instance
+    """
+    roots = sorted({APP_ROOT, *(os.path.abspath(path) for path in sys.path if path)}, key=len, reverse=True)
+    filename = frame.filename
+    for root in roots:
+        if filename.startswith(root + os.sep):
+            filename = os.path.relpath(filename, root)
+            break
+    else:
+        filename = os.path.basename(filename)
+    return f"{filename}:{frame.lineno}"
+
+
+def _status(field):
+    """
+    A memory size of /proc/self/status in bytes, None where it is not available
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS (VmHWM) of the process, possible on Linux only
+    :return: Whether it was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """
+    The peak RSS of the process in bytes, since it was last reset
+    """
+    peak = _status('VmHWM')
+    if peak is None:
+        # Kilobytes on Linux, never reset
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+
+class MemoryProfile:
+    """
+    The memory use of the stages of an export. Per stage it records the RSS,
+    the peak RSS and the allocation sites that grew most. Peaks are those of
+    the process, they include concurrent requests and exclude the processes
+    of parallel flattening.
+
+    Stages may run on several threads of the export at the same time. The
+    figures of such a stage are those of all stages it overlapped, which it
+    lists as concurrent_with, peaks are reset only when no stage is running.
+    """
+
+    def __init__(self, operation, labels):
+        self.operation = operation
+        self.labels = labels
+        self.stages = []
+        self.began = time.perf_counter()
+        self._lock = threading.Lock()
+        # The running stages, each with the names of the stages it overlapped
+        self._running = {}
+        self._peak_reset = False
+
+    @contextlib.contextmanager
+    def stage(self, name, out_of_process=False):
+        """
+        Record the memory use of a block
+        :param name: Name of the stage, e.g. normalize
+        :param out_of_process: The work of the stage is done by worker
+            processes, whose memory it does not include
+        """
+        token = object()
+        with self._lock:
+            concurrent_with = [running for running, _ in self._running.values()]
+            for _, overlapped in self._running.values():
+                overlapped.append(name)
+            if not self._running:
+                self._peak_reset = _reset_peak_rss()
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+            self._running[token] = (name, concurrent_with)
+        rss_before = _status('VmRSS')
+        before = tracemalloc.take_snapshot().filter_traces(_ignored_traces)
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - began
+            _, traced_peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot().filter_traces(_ignored_traces)
+            with self._lock:
+                _, concurrent_with = self._running.pop(token)
+                peak_reset = self._peak_reset
+            stage = {
+                'stage': name,
+                'thread': threading.current_thread().name,
+                'concurrent_with': sorted(set(concurrent_with)),
+                'out_of_process': out_of_process,
+                'seconds': round(seconds, 3),
+                'rss_before': rss_before,
+                'rss_after': _status('VmRSS'),
+                # Since the process started when it could not be reset
+                'peak_rss': peak_rss(),
+                'peak_rss_of_stage': peak_reset,
+                'traced_peak': traced_peak if hasattr(tracemalloc, 'reset_peak') else None,
+                'top_allocations': [
+                    {
+                        'site': _site(statistic.traceback[0]),
+                        'size_diff': statistic.size_diff,
+                        'count_diff': statistic.count_diff,
+                    }
+                    for statistic in after.compare_to(before, 'lineno')[:MEMORY_PROFILING_TOP]
+                ],
+            }
+            with self._lock:
+                self.stages.append(stage)
+
+    def record(self):
+        with self._lock:
+            stages = list(self.stages)
+        return {
+            'operation': self.operation,
+            **self.labels,
+            'seconds': round(time.perf_counter() - self.began, 3),
+            'peak_rss': max((stage['peak_rss'] for stage in stages), default=peak_rss()),
+            'stages': stages,
+        }
+
+
+@contextlib.contextmanager
+def memory_profile(operation, **labels):
+    """
+    Profile the memory_stage blocks run by this thread, and by the functions
+    it passes to other threads with in_memory_profile, until the block ends,
+    then log the profile and keep it with the recent profiles. Does nothing
+    unless MEMORY_PROFILING is set.
+    :param operation: Name of the export, e.g. csv
+    :param labels: Values identifying the export, e.g. the survey_id
+    """
+    if not MEMORY_PROFILING:
+        yield None
+        return
+    _start_tracing()
+    try:
+        profile = MemoryProfile(operation, labels)
+        outer = getattr(_current, 'profile', None)
+        _current.profile = profile
+        try:
+            yield profile
+        finally:
+            _current.profile = outer
+            record = profile.record()
+            profiles.append(record)
+            logger.info(f"Memory profile: {codec.dumps(record)}")
+    finally:
+        _stop_tracing()
+
+
+def _start_tracing():
+    global _active_profiles, _started_tracing
+    with _tracing_lock:
+        if _active_profiles == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_PROFILING_FRAMES)
+            _started_tracing = True
+        _active_profiles += 1
+
+
+def _stop_tracing():
+    """
+    Stop tracing when the last profile ends, so other requests do not pay
+    for it. Tracing that was started elsewhere, e.g. PYTHONTRACEMALLOC, is kept.
+    """
+    global _active_profiles, _started_tracing
+    with _tracing_lock:
+        _active_profiles -= 1
+        if _active_profiles == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def memory_stage(name, out_of_process=False):
+    """
+    Record the memory use of a block as a stage of the profile of this
+    thread, if any
+    :param name: Name of the stage, e.g. normalize
+    :param out_of_process: The work of the stage is done by worker processes
+    """
+    profile = getattr(_current, 'profile', None)
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.stage(name, out_of_process)
+
+
+def in_memory_profile(function):
+    """
+    Wrap a function to be run by an executor, so the stages it runs are
+    recorded in the profile of the thread that wraps it
+    """
+    profile = getattr(_current, 'profile', None)
+    if profile is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        outer = getattr(_current, 'profile', None)
+        _current.profile = profile
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.profile = outer
+
+    return wrapper
+
+
+def memory_profiled(operation):
+    """
+    Profile every request of a controller operation with memory_profile, the
+    path parameters become its labels
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            labels = {name: value for name, value in kwargs.items() if name in ('survey_id', 'registration_id')}
+            with memory_profile(operation, **labels):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def recent_profiles():
+    """
+    The most recent profiles of this process, the latest last
+    """
+    return list(profiles)
@@ -0,0 +1,165 @@
+import json
+import logging
+import threading
+
+import config
+from cachetools import LRUCache
+from settings import codec
+from settings.registrations import decode_snapshot, iter_element_spans, iter_elements
+
+logger = logging.getLogger(__name__)
+
+# Sidecars are stored in the bucket of the snapshot, outside the source/ prefix of the snapshots
+OFFSET_INDEX_PREFIX = 'offsets'
+OFFSET_INDEX_CACHE_SIZE = getattr(config, 'OFFSET_INDEX_CACHE_SIZE', 64)
+
+
+def build_offset_index(content, on_element=None):
+    """
+    Map the serial number of every registration in a snapshot to the byte
+    range of its element, so it can be read without parsing the snapshot
+    :param content: The snapshot as downloaded
+    :param on_element: Called with every decoded element, to use the same pass
+    :return: dict of serial number (str) to [start, end), None if the
+    snapshot is not UTF-8 encoded
+    """
+    encoding = json.detect_encoding(content)
+    if encoding not in ('utf-8', 'utf-8-sig'):
+        return None
+    text = content.decode(encoding)
+    bom = 3 if encoding == 'utf-8-sig' else 0
+    same_offsets = text.isascii()
+
+    offsets = {}
+    position, byte_position = 0, bom
+    for element, start, end in iter_element_spans(text):
+        if on_element is not None:
+            on_element(element)
+        if same_offsets:
+            byte_start, byte_end = bom + start, bom + end
+        else:
+            byte_start = byte_position + len(text[position:start].encode('utf-8'))
+            byte_end = byte_start + len(text[start:end].encode('utf-8'))
+            position, byte_position = end, byte_end
+        offsets[str(element['meta']['serialNumber'])] = [byte_start, byte_end]
+    return offsets
+
+
+def offset_index_name(snapshot):
+    """
+    Name of the sidecar blob of the offset index of a snapshot generation
+    """
+    return f"{OFFSET_INDEX_PREFIX}/{snapshot.name}/{snapshot.generation}.json"
+
+
+def store_offset_index(snapshot, offsets):
+    """
+    Upload the offset index of a snapshot as sidecar in the bucket of the
+    snapshot, unless it is already there. When it cannot be stored the index
+    is only kept in memory.
+    """
+    from google.api_core.exceptions import Forbidden, PreconditionFailed
+
+    if offsets is None:
+        return
+    sidecar = snapshot.bucket.blob(offset_index_name(snapshot))
+    try:
+        sidecar.upload_from_string(
+            codec.dumps({'snapshot': snapshot.name, 'generation': snapshot.generation, 'offsets': offsets}),
+            content_type='application/json',
+            if_generation_match=0,
+        )
+    except PreconditionFailed:
+        pass
+    except Forbidden as e:
+        logger.warning(f"Could not store the offset index of {snapshot.name}: {e}")
+
+
+class OffsetIndexes:
+    """
+    The offset indexes of recently read snapshots. An index that is not in
+    memory is downloaded from its sidecar blob, or built from the snapshot
+    and stored as sidecar for the other instances, so a snapshot is indexed
+    once.
+    """
+
+    def __init__(self, maxsize=OFFSET_INDEX_CACHE_SIZE):
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._build_locks = {}
+
+    @staticmethod
+    def _load(snapshot):
+        sidecar = snapshot.bucket.get_blob(offset_index_name(snapshot))
+        if sidecar is not None:
+            return codec.loads(sidecar.download_as_string())['offsets']
+        if snapshot.content_encoding:
+            # Ranges would be of the encoded blob
+            return None
+        offsets = build_offset_index(snapshot.download_as_string())
+        logger.info(f"Built the offset index of {snapshot.name} ({snapshot.generation})")
+        store_offset_index(snapshot, offsets)
+        return offsets
+
+    def cached(self, bucket_name, snapshot):
+        """
+        Return the index of a snapshot if it is in memory
+        """
+        with self._lock:
+            return self._cache.get((bucket_name, snapshot.name, snapshot.generation))
+
+    def put(self, bucket_name, snapshot, offsets):
+        with self._lock:
+            self._cache[(bucket_name, snapshot.name, snapshot.generation)] = offsets
+
+    def get(self, bucket_name, snapshot):
+        """
+        :return: The offsets by serial number, None if the snapshot cannot be indexed
+        """
+        key = (bucket_name, snapshot.name, snapshot.generation)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        # A single lookup builds or downloads the index, concurrent lookups wait for it
+        with build_lock:
+            with self._lock:
+                if key in self._cache:
+                    return self._cache[key]
+            try:
+                offsets = self._load(snapshot)
+                with self._lock:
+                    self._cache[key] = offsets
+            finally:
+                # Only held while building, later misses create a new one
+                with self._lock:
+                    self._build_locks.pop(key, None)
+        return offsets
+
+
+offset_indexes = OffsetIndexes()
+
+
+def read_registration(bucket_name, snapshot, serial_number):
+    """
+    Read a single registration from a snapshot with a ranged read of its
+    element. Snapshots that cannot be indexed are read in full.
+    :param bucket_name: The bucket of the snapshot
+    :param snapshot: The (listed) blob of the registrations snapshot
+    :param serial_number: The serial number of the registration
+    :return: The JSON of the registration as bytes, None if it is not in the snapshot
+    """
+    offsets = offset_indexes.get(bucket_name, snapshot)
+    if offsets is None:
+        for element in iter_elements(decode_snapshot(snapshot.download_as_string())):
+            if str(element['meta']['serialNumber']) == str(serial_number):
+                return codec.dumps(element).encode('utf-8')
+        return None
+
+    span = offsets.get(str(serial_number))
+    if span is None:
+        return None
+    start, end = span
+    # The blob is read at the listed generation, the one that was indexed.
+    # Storage returns the checksum of the whole object, not of the range.
+    return snapshot.download_as_bytes(start=start, end=end - 1, checksum=None)
@@ -0,0 +1,154 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import config
+from settings import codec
+from settings.chunked import EXPORT_SPILL_DIR, Spill, SpilledRows, export_chunk_size
+from settings.registrations import registrations_json
+
+logger = logging.getLogger(__name__)
+
+# Every worker imports pandas and holds a partition, over 100 MB each. Not
+# os.cpu_count(), which on App Engine is the CPUs of the host, not of the instance.
+EXPORT_WORKERS = getattr(config, 'EXPORT_WORKERS', 2)
+# Exports of fewer registrations are flattened in the request's own process
+EXPORT_PARALLEL_MIN_REGISTRATIONS = getattr(config, 'EXPORT_PARALLEL_MIN_REGISTRATIONS', 5000)
+
+EXPORT_CSV = 'csv'
+EXPORT_ZIP = 'zip'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    The process pool shared by all exports, started on first use. Workers are
+    spawned rather than forked, forking a threaded server is not safe.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=EXPORT_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+
+def _reset_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def use_parallel(surveys):
+    return EXPORT_WORKERS > 1 and len(surveys) >= EXPORT_PARALLEL_MIN_REGISTRATIONS
+
+
+def _flatten_partition(kind, payload, chunk_size, directory):
+    """
+    Flatten the rows of a partition of the registrations in a worker process
+    :param kind: EXPORT_CSV or EXPORT_ZIP
+    :param payload: JSON of the (serial number, registration) pairs of the partition
+    :param chunk_size: Number of rows per spilled chunk
+    :param directory: Directory of the spilled rows
+    :return: SpilledRows of the main CSV and, for EXPORT_ZIP, a Spill of (reference, row) of the sub forms
+    """
+    from settings import csv_rows, subform_row, zip_rows
+
+    surveys = dict(codec.loads(payload))
+    del payload
+    rows = SpilledRows(chunk_size, directory)
+    subforms = None
+    try:
+        if kind == EXPORT_CSV:
+            source = csv_rows(surveys)
+        else:
+            subforms = Spill(chunk_size, directory)
+
+            def create_subform(value, reference, survey):
+                row = subform_row(value, survey)
+                if row:
+                    subforms.append((reference, row))
+
+            source = zip_rows(surveys, create_subform)
+        for row in source:
+            rows.append(row)
+        rows.close()
+        if subforms is not None:
+            subforms.close()
+    except BaseException:
+        rows.remove()
+        if subforms is not None:
+            subforms.remove()
+        raise
+    return rows, subforms
+
+
+def flatten_in_parallel(kind, surveys, directory=EXPORT_SPILL_DIR):
+    """
+    Partition the registrations into consecutive ranges and flatten each on
+    the process pool. Partitions are sent as JSON, which is smaller than a
+    pickle of the decoded registrations and copies the data of compact
+    registrations without decoding it. They are returned as rows spilled to
+    disk. The caller merges them in partition order, so the output is
+    identical to flattening all registrations in a single process.
+
+    A partition is at most a worker's share of the chunks of the memory
+    budget, and only a partition per worker is encoded and in flight at a
+    time, so surveys beyond the budget are flattened within it.
+    :param kind: EXPORT_CSV or EXPORT_ZIP
+    :param surveys: The registrations by serial number
+    :param directory: Directory of the spilled rows, EXPORT_SPILL_DIR by default
+    :return: list of (SpilledRows, Spill or None) per partition, to be removed by the caller
+    """
+    items = list(surveys.items())
+    partition_size = -(-len(items) // EXPORT_WORKERS)
+    # Every worker holds a chunk of its partition in memory at the same time
+    chunk_size = export_chunk_size(surveys)
+    if chunk_size is not None:
+        partition_size = min(partition_size, max(1, chunk_size // EXPORT_WORKERS))
+    offsets = range(0, len(items), partition_size)
+    logger.info(f"Flattening {len(items)} registrations in {len(offsets)} partitions of {partition_size}")
+
+    executor = get_executor()
+    futures = []
+    try:
+        in_flight = set()
+        for offset in offsets:
+            if len(in_flight) >= EXPORT_WORKERS:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # Raises the error of a failed partition
+                    future.result()
+            payload = registrations_json(items[offset:offset + partition_size]).encode()
+            future = executor.submit(_flatten_partition, kind, payload, partition_size, directory)
+            del payload
+            futures.append(future)
+            in_flight.add(future)
+        return [future.result() for future in futures]
+    except BrokenProcessPool:
+        _reset_executor(executor)
+        raise
+    except BaseException:
+        # Remove what the partitions that did complete spilled
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        remove_parts([
+            future.result() for future in futures
+            if not future.cancelled() and future.exception() is None
+        ])
+        raise
+
+
+def remove_parts(parts):
+    for rows, subforms in parts:
+        rows.remove()
+        if subforms is not None:
+            subforms.remove()
@@ -0,0 +1,249 @@
+import datetime
+import logging
+import os
+import threading
+import uuid
+
+import config
+from settings import (create_registration_list, create_zip_file, get_batch_registrations,
+                      get_latest_snapshot, write_csv_file)
+from settings.registrations import compact_registrations, decode_snapshot
+from settings.upload import upload_file
+
+logger = logging.getLogger(__name__)
+
+PREWARM_ENABLED = getattr(config, 'PREWARM_ENABLED', False)
+PREWARM_INTERVAL = getattr(config, 'PREWARM_INTERVAL', 60)
+# Holds full copies of the registrations, so it must be private. Never the
+# nonce bucket, whose blobs are downloaded by unsigned URL. Without it
+# nothing is prebuilt.
+PREBUILT_BUCKET = getattr(config, 'PREBUILT_BUCKET', None)
+PREBUILT_PREFIX = 'prebuilt'
+# Seconds after which the claim of an unfinished build is taken over
+PREBUILT_CLAIM_LEASE = getattr(config, 'PREBUILT_CLAIM_LEASE', 30 * 60)
+
+PREBUILT_LIST = 'registrations.json'
+PREBUILT_CSV = 'registrations.csv'
+PREBUILT_ZIP = 'surveys.zip'
+
+
+def prebuilt_prefix(survey_id, snapshot=None):
+    """
+    Prefix of the prebuilt exports of a survey, of a single snapshot
+    generation when the snapshot is given
+    """
+    if snapshot is None:
+        return f"{PREBUILT_PREFIX}/{survey_id}/"
+    return f"{PREBUILT_PREFIX}/{survey_id}/{snapshot.generation}/"
+
+
+def find_prebuilt(survey_id, snapshot, artifact):
+    """
+    Return the blob of an export that was built from exactly this snapshot
+    generation, or None if it has not been built (yet)
+    :param survey_id: A form or survey ID
+    :param snapshot: The (listed) blob of the latest registrations snapshot
+    :param artifact: One of PREBUILT_LIST, PREBUILT_CSV and PREBUILT_ZIP
+    :return:
+    """
+    from google.cloud import storage
+
+    # Nothing is prebuilt when prewarming is off, so do not look for it
+    if not PREWARM_ENABLED or not PREBUILT_BUCKET:
+        return None
+    storage_client = storage.Client()
+    return storage_client.bucket(PREBUILT_BUCKET).get_blob(f"{prebuilt_prefix(survey_id, snapshot)}{artifact}")
+
+
+def claim_build(bucket, prefix):
+    """
+    Claim building the exports under prefix. A claim that is older than
+    PREBUILT_CLAIM_LEASE belongs to a build that was interrupted, it is
+    taken over by a single instance.
+    :param bucket: The prebuilt bucket
+    :param prefix: Prefix of the exports of a snapshot generation
+    :return: The claim blob, None if the exports are being built elsewhere
+    """
+    from google.api_core.exceptions import PreconditionFailed
+
+    claim = bucket.blob(f"{prefix}.claimed")
+    try:
+        claim.upload_from_string(b"", if_generation_match=0)
+        return claim
+    except PreconditionFailed:
+        pass
+
+    existing = bucket.get_blob(claim.name)
+    if existing is None:
+        # Released by a failed build, claimed again on the next poll
+        return None
+    age = (datetime.datetime.now(datetime.timezone.utc) - existing.time_created).total_seconds()
+    if age < PREBUILT_CLAIM_LEASE:
+        return None
+    try:
+        claim.upload_from_string(b"", if_generation_match=existing.generation)
+    except PreconditionFailed:
+        return None
+    logger.warning(f"Took over the claim of {prefix}, which was {age:.0f}s old")
+    return claim
+
+
+def _release_claim(claim):
+    from google.api_core.exceptions import NotFound
+
+    try:
+        claim.delete(if_generation_match=claim.generation)
+    except NotFound:
+        pass
+
+
+def prebuild(bucket_name, survey_id, snapshot):
+    """
+    Build the list, CSV and ZIP exports and the offset index of a registrations
+    snapshot. The first instance to claim a snapshot generation builds it,
+    others skip it. A failed build, and one of a snapshot without
+    registrations, releases its claim.
+    :param bucket_name: The bucket of the snapshots
+    :param survey_id: A form or survey ID
+    :param snapshot: The (listed) blob of the registrations snapshot
+    :return: Whether the snapshot is done with, because its exports are built
+        or it has no registrations, False while it is built elsewhere
+    """
+    from google.cloud import storage
+
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(PREBUILT_BUCKET)
+    prefix = prebuilt_prefix(survey_id, snapshot)
+    # The ZIP is uploaded last
+    if bucket.get_blob(f"{prefix}{PREBUILT_ZIP}") is not None:
+        return True
+    claim = claim_build(bucket, prefix)
+    if claim is None:
+        logger.info(f"Exports of {snapshot.name} ({snapshot.generation}) are built elsewhere")
+        return False
+
+    try:
+        built = _build_exports(storage_client, bucket, prefix, survey_id, snapshot)
+    except Exception:
+        _release_claim(claim)
+        raise
+    if not built:
+        # Otherwise the claim would be probed on every poll, and taken over once its lease expires
+        _release_claim(claim)
+        logger.info(f"{snapshot.name} ({snapshot.generation}) has no registrations, nothing was built")
+    return True
+
+
+def _build_exports(storage_client, bucket, prefix, survey_id, snapshot):
+    """
+    Build and upload the exports of a snapshot under prefix, then remove
+    those of older snapshots of the survey
+    :return: False if the snapshot has no registrations and nothing was built
+    """
+    from settings.offsets import build_offset_index, store_offset_index
+
+    content = snapshot.download_as_string()
+    registrations = compact_registrations(decode_snapshot(content))
+    if not registrations:
+        return False
+
+    store_offset_index(snapshot, build_offset_index(content))
+
+    bucket.blob(f"{prefix}{PREBUILT_LIST}").upload_from_string(
+        create_registration_list(registrations), content_type="application/json"
+    )
+    zip_file_name = create_zip_file(registrations, uuid.uuid4())
+    # Stored compressed like the CSV exports, copies keep the encoding
+    csv_file_name = write_csv_file(registrations, f"{os.path.dirname(zip_file_name)}/blobs.csv.gz", compress=True)
+    try:
+        upload_file(bucket, f"{prefix}{PREBUILT_CSV}", csv_file_name, "text/csv", content_encoding="gzip")
+        upload_file(bucket, f"{prefix}{PREBUILT_ZIP}", zip_file_name, "application/zip")
+    finally:
+        os.remove(csv_file_name)
+        os.remove(zip_file_name)
+        os.removedirs(os.path.dirname(zip_file_name))
+    logger.info(f"Built exports of {snapshot.name} ({snapshot.generation})")
+
+    # Exports of older snapshots are never served again
+    outdated = [
+        blob for blob in storage_client.list_blobs(bucket, prefix=prebuilt_prefix(survey_id))
+        if not blob.name.startswith(prefix)
+    ]
+    bucket.delete_blobs(outdated, on_error=lambda blob: None)
+    return True
+
+
+class SnapshotWatcher(threading.Thread):
+    """
+    Polls the bucket for new snapshots and builds their exports ahead of the
+    first request. The surveys are taken from the latest source/surveys/folders
+    snapshot, each survey's latest snapshot from source/registrations/. Both are
+    found the same way the export endpoints find them, so the storage emulator
+    (STORAGE_EMULATOR_HOST) can stand in for the bucket when running locally.
+    """
+
+    def __init__(self, bucket_name=None, interval=PREWARM_INTERVAL):
+        super().__init__(name='prewarm', daemon=True)
+        self.bucket_name = bucket_name or config.BUCKET
+        self.interval = interval
+        self.built = {}
+        self._survey_ids = (None, [])
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Polling for new snapshots failed")
+            self._stopped.wait(self.interval)
+
+    def survey_ids(self):
+        surveys_snapshot = get_latest_snapshot(self.bucket_name, 'surveys')
+        if surveys_snapshot is None:
+            return []
+        if self._survey_ids[0] != surveys_snapshot.generation:
+            forms_list = get_batch_registrations(self.bucket_name, 'surveys', snapshot=surveys_snapshot) or {}
+            self._survey_ids = (
+                surveys_snapshot.generation,
+                [form["id"] for forms in forms_list.values() for form in forms],
+            )
+        return self._survey_ids[1]
+
+    def poll(self):
+        for survey_id in self.survey_ids():
+            if self._stopped.is_set():
+                return
+            snapshot = get_latest_snapshot(self.bucket_name, survey_id)
+            if snapshot is None or self.built.get(survey_id) == snapshot.generation:
+                continue
+            try:
+                built = prebuild(self.bucket_name, survey_id, snapshot)
+            except Exception:
+                logger.exception(f"Building exports of {snapshot.name} failed")
+                continue
+            # Otherwise tried again on the next poll, empty snapshots are not tried again
+            if built:
+                self.built[survey_id] = snapshot.generation
+
+
+def start_watcher():
+    """
+    Start watching for new snapshots in the background when enabled
+    """
+    if not PREWARM_ENABLED:
+        return None
+    if not PREBUILT_BUCKET:
+        logger.warning("PREWARM_ENABLED needs a private PREBUILT_BUCKET, not prewarming")
+        return None
+    watcher = SnapshotWatcher()
+    watcher.start()
+    return watcher
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    SnapshotWatcher().run()
@@ -0,0 +1,249 @@
+import operator
+import re
+from collections.abc import Mapping
+from fnmatch import fnmatchcase
+
+PREDICATE = re.compile(r'^\s*(?P<path>[^<>=!]+?)\s*(?P<operator><=|>=|!=|=|<|>)\s*(?P<value>.*?)\s*$')
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+# Parts of a registration a predicate can test, meta first as it is decoded already
+PREDICATE_ROOTS = ('meta', 'info', 'data')
+
+MATCH_NONE = 0
+MATCH_DEEPER = 1
+MATCH_ALL = 2
+
+
+class QueryError(ValueError):
+    pass
+
+
+def split_filters(values):
+    """
+    Split the values of the filter query parameter into conditions. The
+    values arrive split on every comma, also on those inside a condition,
+    so they are joined and split again on the commas that are not escaped.
+    A backslash escapes the next character, e.g. data.remarks=a\\,b.
+    :param values: The values of the filter query parameter
+    :return: The conditions
+    """
+    if not values:
+        return []
+    filters, condition, escaped = [], [], False
+    for character in ','.join(values):
+        if escaped:
+            condition.append(character)
+            escaped = False
+        elif character == '\\':
+            escaped = True
+        elif character == ',':
+            filters.append(''.join(condition))
+            condition = []
+        else:
+            condition.append(character)
+    if escaped:
+        raise QueryError('Filter ends with an escape character')
+    filters.append(''.join(condition))
+    return filters
+
+
+def _match(pattern, path):
+    """
+    Match a dotted pattern against the path of a value
+    :param pattern: Tuple of segments, '*' matches a single key and '**' any number of keys
+    :param path: Tuple of keys
+    :return: MATCH_ALL if the value is selected with everything under it, MATCH_DEEPER
+        if values under it might be selected, MATCH_NONE otherwise
+    """
+    if not pattern:
+        return MATCH_ALL
+    if not path:
+        return MATCH_DEEPER
+    if pattern[0] == '**':
+        return max(_match(pattern[1:], path), _match(pattern, path[1:]))
+    if not fnmatchcase(str(path[0]), pattern[0]):
+        return MATCH_NONE
+    return _match(pattern[1:], path[1:])
+
+
+class Projection:
+    """
+    Selects the values of the data of registrations by dotted paths, e.g.
+    tMNLLocationID.CITY, locationSearch.* or **.name. Selecting a value
+    selects everything under it. Dicts in lists are projected like the list
+    itself, without an index in the path.
+    """
+
+    def __init__(self, fields):
+        self.patterns = [tuple(field.split('.')) for field in fields if field]
+        if not self.patterns:
+            raise QueryError('No fields selected')
+
+    def match(self, path):
+        return max(_match(pattern, path) for pattern in self.patterns)
+
+    def project(self, value, path=()):
+        """
+        Return a copy of a dict with only the selected values. Subtrees that
+        cannot contain a selected value are left out without being visited.
+        """
+        projected = {}
+        for key, item in value.items():
+            item_path = path + (key,)
+            match = self.match(item_path)
+            if match == MATCH_ALL:
+                projected[key] = item
+            elif match == MATCH_DEEPER:
+                item = self._project_nested(item, item_path)
+                if item:
+                    projected[key] = item
+        return projected
+
+    def _project_nested(self, item, path):
+        if isinstance(item, dict):
+            return self.project(item, path)
+        if isinstance(item, list):
+            items = [self.project(element, path) if isinstance(element, dict) else None for element in item]
+            return [element for element in items if element]
+        return None
+
+
+class Predicate:
+    """
+    A comparison of a value of a registration, e.g. meta.registrationDate>=1609459200000
+    or data.tMNLLocationID.CITY=Utrecht. Values that are numbers on both sides are
+    compared as numbers, others as text. A registration without the value only
+    matches !=.
+    """
+
+    def __init__(self, expression):
+        parsed = PREDICATE.match(expression)
+        if parsed is None:
+            raise QueryError(f"Invalid filter: {expression}")
+        self.path = parsed.group('path').split('.')
+        if self.path[0] not in PREDICATE_ROOTS or len(self.path) < 2:
+            raise QueryError(f"Filter should start with one of {', '.join(PREDICATE_ROOTS)}: {expression}")
+        self.operator = OPERATORS[parsed.group('operator')]
+        self.value = parsed.group('value')
+        self.number = _as_number(self.value)
+
+    def __call__(self, registration):
+        value = registration
+        for key in self.path:
+            if not isinstance(value, Mapping) or key not in value:
+                return self.operator is operator.ne
+            value = value[key]
+
+        if self.number is not None:
+            number = _as_number(value)
+            if number is not None:
+                return self.operator(number, self.number)
+        if isinstance(value, bool):
+            value = str(value).lower()
+        return self.operator(str(value), self.value)
+
+
+def _as_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ProjectedRegistration(Mapping):
+    """
+    A registration of which only the selected data is read, the data is
+    projected when it is accessed, unless it was projected already
+    """
+
+    __slots__ = ('registration', 'projection', 'projected')
+
+    def __init__(self, registration, projection, projected=None):
+        self.registration = registration
+        self.projection = projection
+        self.projected = projected
+
+    def __getitem__(self, key):
+        if key == 'data':
+            if self.projected is not None:
+                return self.projected
+            return self.projection.project(self.registration['data'])
+        return self.registration[key]
+
+    def __iter__(self):
+        return iter(self.registration)
+
+    def __len__(self):
+        return len(self.registration)
+
+
+class ExportQuery:
+    """
+    The fields and filters of an export. Registrations that do not match
+    the filters are dropped and the data of the others is projected before
+    anything is flattened, so the rest is never normalized or serialized.
+    """
+
+    def __init__(self, fields=None, filters=None):
+        self.projection = Projection(fields) if fields else None
+        predicates = [Predicate(expression) for expression in filters or []]
+        self.predicates = sorted(predicates, key=lambda predicate: PREDICATE_ROOTS.index(predicate.path[0]))
+
+    def __bool__(self):
+        return bool(self.projection or self.predicates)
+
+    def apply(self, registrations):
+        """
+        :param registrations: The registrations by serial number
+        :return: The matching registrations by serial number, projected
+        """
+        if not self:
+            return registrations
+        selected = {}
+        for serial_number, registration in registrations.items():
+            projected = None
+            if self.predicates:
+                decoded = _DecodeOnce(registration)
+                if not all(predicate(decoded) for predicate in self.predicates):
+                    continue
+                if self.projection and 'data' in decoded.parts:
+                    # Only the selected data is kept, not the decoded registration
+                    projected = self.projection.project(decoded.parts['data'])
+            if self.projection:
+                registration = ProjectedRegistration(registration, self.projection, projected)
+            selected[serial_number] = registration
+        return selected
+
+
+class _DecodeOnce(Mapping):
+    """
+    Reads the parts of a registration once while predicates test it, the data
+    of a compact registration is decoded on every access otherwise
+    """
+
+    __slots__ = ('registration', 'parts')
+
+    def __init__(self, registration):
+        self.registration = registration
+        self.parts = {}
+
+    def __getitem__(self, key):
+        if key not in self.parts:
+            self.parts[key] = self.registration[key]
+        return self.parts[key]
+
+    def __iter__(self):
+        return iter(self.registration)
+
+    def __len__(self):
+        return len(self.registration)
@@ -0,0 +1,232 @@
+import json
+import sys
+from collections.abc import Mapping
+from json.decoder import WHITESPACE
+
+from settings import codec
+
+_decoder = json.JSONDecoder()
+_fields = {}
+
+
+def _intern_fields(keys):
+    """
+    Return the shared tuple of these (interned) keys, so records with the
+    same keys do not each hold a copy of them
+    """
+    keys = tuple(keys)
+    fields = _fields.get(keys)
+    if fields is None:
+        fields = _fields.setdefault(keys, tuple(sys.intern(key) for key in keys))
+    return fields
+
+
+class Record(Mapping):
+    """
+    Read-only mapping of a flat JSON object, e.g. the meta or info of a
+    registration. The keys are shared by all records with the same keys.
+    """
+
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self, values):
+        self._keys = _intern_fields(values.keys())
+        self._values = tuple(values.values())
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return f"Record({dict(self)!r})"
+
+
+class CompactRegistration(Mapping):
+    """
+    A registration of which the data is kept as compact JSON and decoded
+    when it is accessed. It reads like the decoded registration, so
+    registration["meta"]["serialNumber"] and registration["data"].items()
+    work as before.
+    """
+
+    __slots__ = ('meta', 'info', 'data_json')
+
+    def __init__(self, element):
+        self.meta = Record(element.get('meta', {}))
+        self.info = Record(element.get('info', {}))
+        self.data_json = codec.dumps(element['data']) if 'data' in element else None
+
+    @property
+    def data(self):
+        if self.data_json is None:
+            raise KeyError('data')
+        return codec.loads(self.data_json)
+
+    def __getitem__(self, key):
+        if key == 'meta':
+            return self.meta
+        if key == 'info':
+            return self.info
+        if key == 'data':
+            return self.data
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield 'meta'
+        yield 'info'
+        if self.data_json is not None:
+            yield 'data'
+
+    def __len__(self):
+        return 2 if self.data_json is None else 3
+
+    def __repr__(self):
+        return f"CompactRegistration(meta={dict(self.meta)!r}, info={dict(self.info)!r})"
+
+
+def _skip(text, index, expected):
+    index = WHITESPACE.match(text, index).end()
+    if not text.startswith(expected, index):
+        raise json.JSONDecodeError(f"Expecting {expected!r}", text, index)
+    return WHITESPACE.match(text, index + len(expected)).end()
+
+
+def iter_element_spans(text):
+    """
+    Decode the elements of a registrations snapshot one by one, so only a
+    single element is fully decoded at a time. The stdlib decoder finds
+    where an element ends, once the spans are known compact_registrations_at
+    decodes them with the codec instead.
+    :param text: JSON of a snapshot, {"elements": [...], ...}
+    :return: Iterator of (element, start, end), the element is text[start:end]
+    """
+    index = _skip(text, 0, '{')
+    while not text.startswith('}', index):
+        key, index = _decoder.raw_decode(text, index)
+        index = _skip(text, index, ':')
+        if key != 'elements':
+            _, index = _decoder.raw_decode(text, index)
+        else:
+            index = _skip(text, index, '[')
+            while not text.startswith(']', index):
+                start = index
+                element, index = _decoder.raw_decode(text, index)
+                yield element, start, index
+                index = WHITESPACE.match(text, index).end()
+                if text.startswith(',', index):
+                    index = _skip(text, index, ',')
+            index = _skip(text, index, ']')
+        index = WHITESPACE.match(text, index).end()
+        if text.startswith(',', index):
+            index = _skip(text, index, ',')
+
+
+def iter_elements(text):
+    """
+    Decode the elements of a registrations snapshot one by one
+    :param text: JSON of a snapshot, {"elements": [...], ...}
+    :return:
+    """
+    for element, _, _ in iter_element_spans(text):
+        yield element
+
+
+def decode_snapshot(content):
+    """
+    The text of a downloaded snapshot, which may be encoded as UTF-8, -16 or -32
+    """
+    return content.decode(json.detect_encoding(content))
+
+
+def compact_registrations(text):
+    """
+    The registrations of a snapshot by serial number, as CompactRegistration
+    :param text: JSON of a snapshot
+    :return:
+    """
+    registrations = {}
+    for element in iter_elements(text):
+        registration = CompactRegistration(element)
+        registrations[registration.meta["serialNumber"]] = registration
+    return registrations
+
+
+def compact_registrations_at(content, spans):
+    """
+    The registrations of a snapshot by serial number, as CompactRegistration,
+    of which the elements are at known byte ranges
+    :param content: The snapshot as downloaded
+    :param spans: [start, end) of every element, in snapshot order
+    :return:
+    """
+    registrations = {}
+    for start, end in spans:
+        registration = CompactRegistration(codec.loads(content[start:end]))
+        registrations[registration.meta["serialNumber"]] = registration
+    return registrations
+
+
+def load_registrations(bucket_name, prefix=None, snapshot=None):
+    """
+    Download the latest registrations snapshot of a survey and index its
+    registrations by serial number, in their compact form. The elements of a
+    snapshot that was read before are decoded from the spans of its offset
+    index, the first read builds that index.
+    :return: The registrations, None if there is no snapshot
+    """
+    from settings import get_latest_snapshot
+    from settings.offsets import build_offset_index, offset_indexes
+
+    if snapshot is None:
+        snapshot = get_latest_snapshot(bucket_name, prefix)
+    if snapshot is None:
+        return None
+    content = snapshot.download_as_string()
+    if snapshot.content_encoding:
+        # Offsets would be of the decoded content, not of the blob
+        return compact_registrations(decode_snapshot(content))
+
+    offsets = offset_indexes.cached(bucket_name, snapshot)
+    if offsets is not None:
+        return compact_registrations_at(content, offsets.values())
+
+    registrations = {}
+
+    def add(element):
+        registration = CompactRegistration(element)
+        registrations[registration.meta["serialNumber"]] = registration
+
+    offsets = build_offset_index(content, add)
+    if offsets is None:
+        return compact_registrations(decode_snapshot(content))
+    offset_indexes.put(bucket_name, snapshot, offsets)
+    return registrations
+
+
+def registrations_json(items):
+    """
+    Encode (serial number, registration) pairs as a JSON list. The data of
+    compact registrations is copied as is instead of being decoded.
+    :param items: Pairs of serial number and registration
+    :return:
+    """
+    encoded = []
+    for serial_number, registration in items:
+        if isinstance(registration, CompactRegistration):
+            value = f'{{"meta":{codec.dumps(dict(registration.meta))},"info":{codec.dumps(dict(registration.info))}'
+            if registration.data_json is not None:
+                value += f',"data":{registration.data_json}'
+            value += '}'
+        else:
+            # Other mappings, e.g. the records of projected registrations, as dicts
+            value = codec.dumps(registration, default=dict)
+        encoded.append(f'[{codec.dumps(serial_number)},{value}]')
+    return f"[{','.join(encoded)}]"
@@ -0,0 +1,285 @@
+import asyncio
+import atexit
+import base64
+import hashlib
+import logging
+import os
+import random
+import threading
+from urllib.parse import quote
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Connections kept open to storage, shared by all requests of the instance
+STORAGE_IO_CONNECTIONS = getattr(config, 'STORAGE_IO_CONNECTIONS', 64)
+# Requests in flight at the same time, for all requests of the instance
+STORAGE_IO_CONCURRENCY = getattr(config, 'STORAGE_IO_CONCURRENCY', 32)
+# Seconds to connect, and between reads of a response. Not for a response as a
+# whole, downloading a large object takes longer.
+STORAGE_IO_TIMEOUT = getattr(config, 'STORAGE_IO_TIMEOUT', 60)
+# Retries of a request that failed with 408, 429, 5xx, a broken connection or a
+# checksum mismatch, with exponential backoff. Only GETs are sent, so all are idempotent.
+STORAGE_IO_RETRIES = getattr(config, 'STORAGE_IO_RETRIES', 5)
+STORAGE_IO_RETRY_DELAY = 0.5
+STORAGE_IO_RETRY_MAX_DELAY = 16
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+STORAGE_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class ChecksumMismatch(Exception):
+    """
+    The downloaded bytes differ from the checksum reported by storage
+    """
+
+
+class DownloadChecksum:
+    """
+    Checks a download against the crc32c, or else the md5, that storage
+    reports in x-goog-hash. Objects stored compressed are decompressed while
+    downloading, so their checksums cannot be checked.
+    """
+
+    def __init__(self, headers):
+        import google_crc32c
+
+        self.expected = {}
+        if headers.get('x-goog-stored-content-encoding', 'identity') == 'identity':
+            for value in headers.getall('x-goog-hash', []):
+                for item in value.split(','):
+                    name, _, digest = item.strip().partition('=')
+                    self.expected[name] = digest
+        if 'crc32c' in self.expected:
+            self.name, self._checksum = 'crc32c', google_crc32c.Checksum()
+        elif 'md5' in self.expected:
+            self.name, self._checksum = 'md5', hashlib.md5()
+        else:
+            self.name, self._checksum = None, None
+
+    def update(self, chunk):
+        if self._checksum is not None:
+            self._checksum.update(chunk)
+
+    def verify(self, description):
+        if self._checksum is None:
+            return
+        actual = base64.b64encode(self._checksum.digest()).decode('ascii')
+        if actual != self.expected[self.name]:
+            raise ChecksumMismatch(f"{description}: {self.name} is {actual}, expected {self.expected[self.name]}")
+
+
+def storage_endpoint():
+    """
+    The root URL of the storage JSON API. STORAGE_EMULATOR_HOST points to a
+    local (fake) server instead, like it does for google-cloud-storage.
+    """
+    host = os.environ.get('STORAGE_EMULATOR_HOST')
+    if host:
+        return host.rstrip('/') if '://' in host else f"http://{host}"
+    return 'https://storage.googleapis.com'
+
+
+class AsyncStorage:
+    """
+    Fans out small storage requests on an event loop running in a background
+    thread, so the synchronous handlers can use it. The loop keeps a pool of
+    HTTP connections, and a semaphore bounds the number of requests in flight
+    for the instance as a whole.
+    """
+
+    def __init__(self, connections=STORAGE_IO_CONNECTIONS, concurrency=STORAGE_IO_CONCURRENCY):
+        self.connections = connections
+        self.concurrency = concurrency
+        self._loop = None
+        self._lock = threading.Lock()
+        self._session = None
+        self._semaphore = None
+        self._credentials = None
+        self._refresh_lock = None
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='storage-io', daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def run(self, coroutine):
+        """
+        Run a coroutine on the loop of the storage I/O thread and wait for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop()).result()
+
+    def close(self):
+        """
+        Close the connections and stop the loop, if it was started
+        """
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), loop).result()
+            self._session = None
+        loop.call_soon_threadsafe(loop.stop)
+
+    async def _get_session(self):
+        import aiohttp
+
+        if self._session is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._refresh_lock = asyncio.Lock()
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections),
+                timeout=aiohttp.ClientTimeout(
+                    total=None, sock_connect=STORAGE_IO_TIMEOUT, sock_read=STORAGE_IO_TIMEOUT
+                ),
+            )
+        return self._session
+
+    async def _headers(self):
+        if 'STORAGE_EMULATOR_HOST' in os.environ:
+            return {}
+        import google.auth
+        from google.auth.transport.requests import Request
+
+        async with self._refresh_lock:
+            if self._credentials is None:
+                self._credentials, _ = google.auth.default(scopes=[STORAGE_SCOPE])
+            if not self._credentials.valid:
+                await asyncio.get_running_loop().run_in_executor(None, self._credentials.refresh, Request())
+            return {'Authorization': f"Bearer {self._credentials.token}"}
+
+    async def _request(self, path, params, handle):
+        """
+        GET path and handle the response, retrying transient failures
+        :param handle: Coroutine function of the response, run again for a retry
+        """
+        import aiohttp
+        from google.api_core.exceptions import from_http_status
+
+        session = await self._get_session()
+        delay = STORAGE_IO_RETRY_DELAY
+        for attempt in range(STORAGE_IO_RETRIES + 1):
+            retry = attempt < STORAGE_IO_RETRIES
+            headers = await self._headers()
+            try:
+                async with self._semaphore:
+                    async with session.get(f"{storage_endpoint()}{path}", params=params, headers=headers) as response:
+                        if response.status >= 400:
+                            error = from_http_status(response.status, f"GET {path}: {await response.text()}")
+                            if not retry or response.status not in RETRY_STATUSES:
+                                raise error
+                        else:
+                            return await handle(response)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError,
+                    ChecksumMismatch) as e:
+                if not retry:
+                    raise
+                error = e
+            logger.info(f"Retrying GET {path} in {delay:.1f}s after {type(error).__name__}: {error}")
+            # Not holding a slot of the semaphore while waiting
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, STORAGE_IO_RETRY_MAX_DELAY)
+
+    async def list_blobs_async(self, bucket_name, prefix, fields=None, max_results=None):
+        """
+        List objects, following the pages of the listing
+        :return: The object resources, as dicts
+        """
+        items = []
+        params = {'prefix': prefix}
+        if fields:
+            params['fields'] = fields
+        while True:
+            if max_results:
+                params['maxResults'] = str(max_results - len(items))
+            page = await self._request(f"/storage/v1/b/{quote(bucket_name, safe='')}/o", params,
+                                       lambda response: response.json(content_type=None))
+            items.extend(page.get('items', []))
+            token = page.get('nextPageToken')
+            if not token or (max_results and len(items) >= max_results):
+                return items
+            params['pageToken'] = token
+
+    async def download_async(self, bucket_name, blob_name, file_name, generation=None):
+        """
+        Download an object to a file, of the given generation only if set.
+        The file is checked against the checksum of the object, and removed
+        when the download fails.
+        """
+        params = {'alt': 'media'}
+        if generation is not None:
+            params['ifGenerationMatch'] = str(generation)
+
+        async def write(response):
+            loop = asyncio.get_running_loop()
+            checksum = DownloadChecksum(response.headers)
+
+            def write_chunk(chunk):
+                checksum.update(chunk)
+                file.write(chunk)
+
+            # File I/O and hashing off the event loop, other requests go on meanwhile
+            file = await loop.run_in_executor(None, open, file_name, 'wb')
+            try:
+                try:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        await loop.run_in_executor(None, write_chunk, chunk)
+                finally:
+                    await loop.run_in_executor(None, file.close)
+                checksum.verify(f"{bucket_name}/{blob_name}")
+            except BaseException:
+                await loop.run_in_executor(None, _remove, file_name)
+                raise
+
+        await self._request(
+            f"/download/storage/v1/b/{quote(bucket_name, safe='')}/o/{quote(blob_name, safe='')}", params, write
+        )
+
+    def list_blobs(self, bucket_name, prefix, fields=None, max_results=None):
+        return self.run(self.list_blobs_async(bucket_name, prefix, fields, max_results))
+
+    def has_blobs(self, bucket_name, prefixes):
+        """
+        Check for several prefixes at once if any object exists under it
+        :return: dict of prefix to True or False
+        """
+        async def check():
+            listings = await asyncio.gather(*[
+                self.list_blobs_async(bucket_name, prefix, fields='items(name)', max_results=1)
+                for prefix in prefixes
+            ])
+            return {prefix: bool(items) for prefix, items in zip(prefixes, listings)}
+
+        return self.run(check())
+
+    def download_many(self, bucket_name, downloads):
+        """
+        Download several objects at once. All downloads are finished or have
+        failed when this returns, failures do not cancel the others.
+        :param downloads: (blob name, file name, generation or None) of every object
+        :return: None for every successful download, the exception of a failed one
+        """
+        async def download():
+            return await asyncio.gather(
+                *[self.download_async(bucket_name, *download) for download in downloads],
+                return_exceptions=True
+            )
+
+        return self.run(download())
+
+
+def _remove(file_name):
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
+
+
+storage_io = AsyncStorage()
+atexit.register(storage_io.close)
@@ -0,0 +1,113 @@
+import contextlib
+import gzip
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Files from this size are uploaded in parts and composed in the bucket
+COMPOSITE_UPLOAD_THRESHOLD = getattr(config, 'COMPOSITE_UPLOAD_THRESHOLD', 150 * 1024 * 1024)
+COMPOSITE_UPLOAD_PART_SIZE = getattr(config, 'COMPOSITE_UPLOAD_PART_SIZE', 64 * 1024 * 1024)
+COMPOSITE_UPLOAD_CONCURRENCY = getattr(config, 'COMPOSITE_UPLOAD_CONCURRENCY', 8)
+# Compression level of objects stored with Content-Encoding: gzip
+UPLOAD_GZIP_LEVEL = getattr(config, 'UPLOAD_GZIP_LEVEL', 6)
+
+# Maximum number of source objects of a single compose request
+MAX_COMPOSE_SOURCES = 32
+
+
+def _upload_part(bucket, name, file_name, offset, size):
+    blob = bucket.blob(name)
+    with open(file_name, 'rb') as file:
+        file.seek(offset)
+        blob.upload_from_file(file, size=size, content_type='application/octet-stream', if_generation_match=0)
+    return blob
+
+
+@contextlib.contextmanager
+def gzip_writer(file_name, level=UPLOAD_GZIP_LEVEL):
+    """
+    Open a file for text that is compressed as it is written, so an export
+    to be stored with Content-Encoding: gzip is never on disk uncompressed
+    :return: A text stream
+    """
+    with open(file_name, 'wb') as destination:
+        # No file name or time in the header, so equal files compress to equal objects
+        with gzip.GzipFile(filename='', fileobj=destination, mode='wb', compresslevel=level, mtime=0) as compressed:
+            with io.TextIOWrapper(compressed, encoding='utf-8', newline='') as text:
+                yield text
+
+
+def _compose(bucket, destination, sources, content_type, created):
+    """
+    Compose sources into destination, in several steps when there are
+    more sources than a single compose request accepts
+    :param created: The names of the intermediate objects are added to it
+        before they are created, so they can be removed whatever fails
+    """
+    level = 0
+    while len(sources) > MAX_COMPOSE_SOURCES:
+        composed = []
+        for index in range(0, len(sources), MAX_COMPOSE_SOURCES):
+            intermediate = bucket.blob(f"{destination.name}.parts/composed-{level}-{index // MAX_COMPOSE_SOURCES:05d}")
+            intermediate.content_type = 'application/octet-stream'
+            created.append(intermediate.name)
+            intermediate.compose(sources[index:index + MAX_COMPOSE_SOURCES])
+            composed.append(intermediate)
+        sources = composed
+        level += 1
+
+    destination.content_type = content_type
+    destination.compose(sources)
+
+
+def upload_file(bucket, blob_name, file_name, content_type, content_encoding=None):
+    """
+    Upload a file to a bucket. Large files are split into parts that are
+    uploaded concurrently and then composed into a single object.
+    :param bucket: The destination bucket
+    :param blob_name: The name of the destination object
+    :param file_name: Path of the file to upload
+    :param content_type: Content type of the object
+    :param content_encoding: 'gzip' for a file written with gzip_writer,
+        storage decompresses it for clients that do not accept gzip
+    :return: The uploaded blob
+    """
+    file_size = os.path.getsize(file_name)
+    blob = bucket.blob(blob_name)
+    blob.content_encoding = content_encoding
+    if file_size < COMPOSITE_UPLOAD_THRESHOLD:
+        blob.upload_from_filename(file_name, content_type=content_type)
+        return blob
+
+    offsets = range(0, file_size, COMPOSITE_UPLOAD_PART_SIZE)
+    part_names = [f"{blob_name}.parts/{index:05d}" for index in range(len(offsets))]
+    logger.info(f"Uploading {file_name} ({file_size} bytes) as {len(part_names)} parts to {blob_name}")
+
+    # Every object this upload may have created, whether it failed or not
+    created = list(part_names)
+    try:
+        with ThreadPoolExecutor(max_workers=COMPOSITE_UPLOAD_CONCURRENCY) as executor:
+            futures = [
+                executor.submit(
+                    _upload_part, bucket, name, file_name, offset,
+                    min(COMPOSITE_UPLOAD_PART_SIZE, file_size - offset)
+                )
+                for name, offset in zip(part_names, offsets)
+            ]
+            try:
+                parts = [future.result() for future in futures]
+            except BaseException:
+                # Do not start the parts that are still queued
+                for future in futures:
+                    future.cancel()
+                raise
+        _compose(bucket, blob, parts, content_type, created)
+    finally:
+        # Those that failed or never started do not exist, ignore those
+        bucket.delete_blobs([bucket.blob(name) for name in created], on_error=lambda part: None)
+    return blob